@@ -0,0 +1,23 @@
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "etf_track.settings")
+
+
+@contextmanager
+def benchmark_database() -> Iterator[None]:
+    """Set up Django and run the enclosed block against a freshly created
+    test database, which is destroyed afterwards so that benchmarks never
+    touch application data
+    """
+    django.setup()
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
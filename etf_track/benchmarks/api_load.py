@@ -0,0 +1,271 @@
+"""Load test the read-only JSON API served through ASGI by uvicorn and
+through WSGI by gunicorn, at increasing numbers of concurrent clients.
+
+Each server is started on a free local port against the configured
+database, which should already hold ETFs with holdings and measurements.
+Every client keeps one HTTP/1.1 connection open and requests the list,
+detail, overview, holdings and measurements endpoints of the ETFs in turn
+for a fixed duration. Throughput, latency percentiles and errors are written
+to a JSON report. Servers started elsewhere can be tested with --url.
+
+Requires uvicorn and gunicorn to be installed.
+
+Usage (from the etf_track directory):
+    python -m benchmarks.api_load --concurrency 10 100 500 --duration 20
+    python -m benchmarks.api_load --url http://127.0.0.1:8000 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+SERVERS = {
+    "asgi": lambda port, workers, threads: [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "etf_track.asgi:application",
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+        "--no-access-log",
+        "--log-level",
+        "warning",
+    ],
+    "wsgi": lambda port, workers, threads: [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "etf_track.wsgi:application",
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+        "--log-level",
+        "warning",
+    ],
+}
+STARTUP_SECONDS = 30.0
+
+
+def free_port() -> int:
+    """Return a local port that is not in use"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@contextmanager
+def run_server(kind: str, workers: int, threads: int) -> Iterator[str]:
+    """Start a server in a subprocess and wait until it answers requests
+
+    Yields:
+        the base URL of the server
+    """
+    port = free_port()
+    process = subprocess.Popen(SERVERS[kind](port, workers, threads))
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + STARTUP_SECONDS
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"The {kind} server exited during startup")
+            try:
+                urlopen(f"{base_url}/api/etfs/?limit=1", timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"The {kind} server did not start")
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def request_paths(base_url: str, etfs: int) -> List[str]:
+    """Return the paths requested by the clients, covering every endpoint
+    of the first ``etfs`` ETFs listed by the server
+    """
+    with urlopen(f"{base_url}/api/etfs/?limit={etfs}") as response:
+        etf_ids = [etf["id"] for etf in json.load(response)["results"]]
+    if not etf_ids:
+        raise RuntimeError("The database holds no ETFs to request")
+    paths = ["/api/etfs/?limit=50"]
+    for etf_id in etf_ids:
+        paths += [
+            f"/api/etfs/{etf_id}/",
+            f"/api/etfs/{etf_id}/overview/",
+            f"/api/etfs/{etf_id}/holdings/?limit=100",
+            f"/api/etfs/{etf_id}/measurements/?limit=100",
+        ]
+    return paths
+
+
+async def _get(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str
+) -> int:
+    """Send a GET request over an open connection and read the response
+
+    Returns:
+        the status code of the response
+    """
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = dict(line.lower().split(":", 1) for line in lines[1:] if ":" in line)
+    if "content-length" not in headers:
+        raise ConnectionError("response without Content-Length")
+    await reader.readexactly(int(headers["content-length"]))
+    return status
+
+
+async def client(
+    base_url: str,
+    paths: List[str],
+    offset: int,
+    deadline: float,
+    latencies: List[float],
+    errors: Dict[str, int],
+) -> None:
+    """Request the paths in turn over one keep-alive connection until the
+    deadline, reconnecting after a failed request
+    """
+    address = urlsplit(base_url)
+    connection: Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = None
+    index = offset
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(
+                    address.hostname, address.port
+                )
+            status = await _get(*connection, address.netloc, path)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as error:
+            errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+            if connection is not None:
+                connection[1].close()
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    if connection is not None:
+        connection[1].close()
+
+
+async def load(
+    base_url: str, paths: List[str], concurrency: int, duration: float
+) -> Dict[str, Any]:
+    """Run ``concurrency`` clients against a server for ``duration`` seconds
+
+    Returns:
+        a dictionary with the throughput, latency percentiles and errors
+    """
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client(base_url, paths, offset, start + duration, latencies, errors)
+            for offset in range(concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": _percentile_ms(latencies, 0.50),
+        "p95_ms": _percentile_ms(latencies, 0.95),
+        "p99_ms": _percentile_ms(latencies, 0.99),
+        "errors": errors,
+    }
+
+
+def _percentile_ms(latencies: List[float], quantile: float) -> Optional[float]:
+    if not latencies:
+        return None
+    index = min(int(quantile * len(latencies)), len(latencies) - 1)
+    return round(latencies[index] * 1000, 2)
+
+
+def run_levels(
+    base_url: str, paths: List[str], levels: List[int], duration: float
+) -> Dict[str, Dict[str, Any]]:
+    """Load a server at each concurrency level in turn"""
+    results = {}
+    for concurrency in levels:
+        results[str(concurrency)] = asyncio.run(
+            load(base_url, paths, concurrency, duration)
+        )
+        print(
+            f"  concurrency {concurrency:>5}: {json.dumps(results[str(concurrency)])}"
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--servers", nargs="+", choices=SERVERS, default=list(SERVERS))
+    parser.add_argument("--url", help="test a running server instead")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--etfs", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--output", type=Path, default=Path("api_load_benchmark.json"))
+    args = parser.parse_args()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "etf_track.settings")
+
+    results = {}
+    if args.url:
+        print(args.url)
+        paths = request_paths(args.url, args.etfs)
+        results[args.url] = run_levels(args.url, paths, args.concurrency, args.duration)
+    for kind in [] if args.url else args.servers:
+        print(kind)
+        with run_server(kind, args.workers, args.threads) as base_url:
+            paths = request_paths(base_url, args.etfs)
+            results[kind] = run_levels(base_url, paths, args.concurrency, args.duration)
+    report = {
+        "parameters": {
+            "duration": args.duration,
+            "etfs": args.etfs,
+            "workers": args.workers,
+            "threads": args.threads,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "servers": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Compare the time and peak memory of parsing iShares holdings files with
+the original full-inference parsing path and the current typed, chunked
+path of iSharesETFReader.
+
+Usage (from the etf_track directory):
+    python -m benchmarks.csv_parsing --rows 500 5000 50000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Tuple
+
+from etfs.holdings.reader import iSharesETFReader
+from pandas import DataFrame, read_csv
+
+ISHARES_HEADER = [
+    "Ticker",
+    "Name",
+    "Sector",
+    "Asset Class",
+    "Market Value",
+    "Weight (%)",
+    "Notional Value",
+    "Shares",
+    "CUSIP",
+    "ISIN",
+    "SEDOL",
+    "Price",
+    "Location",
+    "Exchange",
+    "Currency",
+    "FX Rate",
+    "Market Currency",
+    "Accrual Date",
+]
+SECTORS = [
+    "Information Technology",
+    "Financials",
+    "Health Care",
+    "Consumer Discretionary",
+    "Industrials",
+    "Energy",
+    "Cash and/or Derivatives",
+]
+
+
+def write_holdings_file(path: Path, rows: int, seed: int = 0) -> None:
+    """Write a synthetic holdings file in the iShares CSV format
+
+    Arguments:
+        path: the path to write the file to
+        rows: the number of holdings in the file
+        seed: the seed of the random number generator
+    """
+    rng = random.Random(seed)
+    lines = [
+        'Fund Holdings as of,"Oct 14, 2022"',
+        'Inception Date,"May 15, 2000"',
+        ",".join(ISHARES_HEADER),
+    ]
+    for i in range(rows):
+        sector = SECTORS[i % len(SECTORS)]
+        lines.append(
+            f'T{i:05d},"COMPANY {i} INC",{sector},Equity,'
+            f'"{rng.uniform(1e5, 1e9):,.2f}",{rng.uniform(0, 2):.4f},'
+            f'"{rng.uniform(1e5, 1e9):,.2f}","{rng.randint(1, 10**6):,}",'
+            f"{i:09d},US{i:010d},{i:07d},{rng.uniform(1, 500):.2f},"
+            f"United States,NASDAQ,USD,1.00,USD,-"
+        )
+    lines.append("\xa0")
+    lines.append('"The content contained herein is owned or licensed by BlackRock"')
+    path.write_text("\n".join(lines) + "\n")
+
+
+def read_full_inference(path: Path) -> DataFrame:
+    """The original parsing path: every column with default type inference,
+    two boolean-mask copies, then a slice and rename copy
+    """
+    holdings = read_csv(path, skiprows=[0, 1])
+    holdings = holdings[holdings.Sector.notnull()]
+    holdings = holdings[holdings.Sector != "Cash and/or Derivatives"]
+    holdings = holdings[["Ticker", "Weight (%)"]]
+    return holdings.rename(columns={"Ticker": "ticker", "Weight (%)": "percentage"})
+
+
+def read_typed_chunks(path: Path) -> DataFrame:
+    """The current parsing path of iSharesETFReader"""
+    return iSharesETFReader({"holdings_url": path.as_uri()}).read()
+
+
+def measure(function: Callable[[Path], DataFrame], path: Path) -> Tuple[float, int]:
+    """Measure the wall time and peak traced memory of a parsing function
+
+    Returns:
+        a tuple containing the time in seconds and the peak memory in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(path)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", nargs="+", type=int, default=[500, 5000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    parsers: Dict[str, Callable[[Path], DataFrame]] = {
+        "before": read_full_inference,
+        "after": read_typed_chunks,
+    }
+    print(f"{'rows':>8} {'path':>8} {'time (ms)':>10} {'peak (MiB)':>11}")
+    with TemporaryDirectory() as directory:
+        for rows in args.rows:
+            path = Path(directory) / f"holdings_{rows}.csv"
+            write_holdings_file(path, rows)
+            for name, function in parsers.items():
+                results = [measure(function, path) for _ in range(args.repeat)]
+                elapsed = min(result[0] for result in results)
+                peak = min(result[1] for result in results)
+                print(
+                    f"{rows:>8} {name:>8} {elapsed * 1000:>10.1f}"
+                    f" {peak / 2**20:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
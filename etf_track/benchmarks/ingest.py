@@ -0,0 +1,195 @@
+"""Time the holdings ingest pipeline end to end and stage by stage against
+synthetic iShares holdings files served from a local HTTP server.
+
+Each stage records its wall time, the number of database queries and the
+peak traced memory. The results are written to a JSON report, which can be
+compared against the report of an earlier run.
+
+Usage (from the etf_track directory):
+    python -m benchmarks.ingest --etfs 50 --holdings 500 --output after.json
+    python -m benchmarks.ingest --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterator
+
+from ._database import benchmark_database
+from .csv_parsing import write_holdings_file
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """A static file handler that does not log every request"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve_directory(directory: Path) -> Iterator[str]:
+    """Serve the files in a directory over HTTP on a free local port
+
+    Yields:
+        the base URL of the server
+    """
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(directory))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_holdings_files(directory: Path, etfs: int, holdings: int, seed: int) -> None:
+    """Write one synthetic holdings file per ETF, named <index>.csv. Files
+    written again with a new seed get a later modification time, so that
+    conditional downloads see them as changed.
+    """
+    for index in range(etfs):
+        path = directory / f"{index}.csv"
+        write_holdings_file(path, holdings, seed=seed * etfs + index)
+        modified = time.time() + seed
+        os.utime(path, (modified, modified))
+
+
+def measure(function: Callable[[], Any]) -> Dict[str, float]:
+    """Run a function once and measure its wall time, database queries and
+    peak traced memory
+
+    Returns:
+        a dictionary with the keys seconds, queries and peak_mib
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as context:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": round(elapsed, 6),
+        "queries": len(context.captured_queries),
+        "peak_mib": round(peak / 2**20, 3),
+    }
+
+
+def run_stages(
+    directory: Path, base_url: str, etfs: int, holdings: int, workers: int
+) -> Dict[str, Dict[str, float]]:
+    """Create the ETFs in the benchmark database and measure each stage of
+    the ingest pipeline in order
+
+    Returns:
+        a dictionary mapping the name of each stage to its measurements
+    """
+    from django.test import override_settings
+    from etfs.fundamentals.loader import update_fundamentals
+    from etfs.holdings.loader import _update_holdings, read_all_etfs
+    from etfs.holdings.reader import iSharesETFReader
+    from etfs.models import ETF, Holdings
+    from etfs.utils import convert_queryset_to_dataframe
+
+    ETF.objects.bulk_create(
+        ETF(
+            etf_issuer="iShares",
+            name=f"Benchmark ETF {index}",
+            portfolio_url=f"{base_url}/{index}",
+            holdings_url=f"{base_url}/{index}.csv",
+        )
+        for index in range(etfs)
+    )
+    cache_settings = {"DIR": directory / "download_cache", "MAX_ENTRIES": 10**6}
+    read_all = partial(read_all_etfs, "iShares", workers=workers)
+    stages = {}
+    with override_settings(
+        HOLDINGS_DOWNLOAD_CACHE=cache_settings, HOLDINGS_HISTORY=None
+    ):
+        write_holdings_files(directory, etfs, holdings, seed=0)
+        stages["read_all_initial"] = measure(read_all)
+        stages["read_all_unchanged"] = measure(read_all)
+        write_holdings_files(directory, etfs, holdings, seed=1)
+        stages["read_all_changed"] = measure(read_all)
+
+        write_holdings_files(directory, 1, holdings, seed=2)
+        first_etf = ETF.objects.order_by("id").values("id", "holdings_url").first()
+        downloaded = iSharesETFReader(first_etf).read()
+        stages["update_holdings"] = measure(
+            partial(_update_holdings, first_etf["id"], downloaded)
+        )
+    stages["convert_queryset_to_dataframe"] = measure(
+        partial(convert_queryset_to_dataframe, Holdings.objects.all())
+    )
+    stages["update_fundamentals"] = measure(update_fundamentals)
+    return stages
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Print the measurements of a report next to those of a baseline"""
+    print(f"{'stage':<32} {'seconds':>18} {'queries':>14} {'peak (MiB)':>18}")
+    for stage, result in report["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before is None:
+            print(f"{stage:<32} (no baseline)")
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else 0
+        print(
+            f"{stage:<32} {before['seconds']:>8.3f}→{result['seconds']:<8.3f}"
+            f" {before['queries']:>6}→{result['queries']:<7}"
+            f" {before['peak_mib']:>8.1f}→{result['peak_mib']:<8.1f} x{ratio:.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--etfs", type=int, default=20)
+    parser.add_argument("--holdings", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", type=Path, default=Path("ingest_benchmark.json"))
+    parser.add_argument("--compare", type=Path, help="a report to compare against")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory, serve_directory(
+        Path(directory)
+    ) as base_url, benchmark_database():
+        stages = run_stages(
+            Path(directory), base_url, args.etfs, args.holdings, args.workers
+        )
+    report = {
+        "parameters": {
+            "etfs": args.etfs,
+            "holdings": args.holdings,
+            "workers": args.workers,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "stages": stages,
+    }
+    args.output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(report, json.loads(args.compare.read_text()))
+    else:
+        for stage, result in stages.items():
+            print(f"{stage:<32} {json.dumps(result)}")
+
+
+if __name__ == "__main__":
+    main()
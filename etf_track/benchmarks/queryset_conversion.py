@@ -0,0 +1,107 @@
+"""Compare the time and peak memory of converting the Holdings table to a
+DataFrame with the original row-by-row conversion and the current columnar
+convert_queryset_to_dataframe.
+
+The benchmark runs against a throwaway test database created from the
+configured DATABASES setting.
+
+Usage (from the etf_track directory):
+    python -m benchmarks.queryset_conversion --rows 1000000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Tuple
+
+from ._database import benchmark_database
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+def convert_row_by_row(queryset) -> "DataFrame":
+    """The original conversion: model instances, vars() and getattr"""
+    from pandas import DataFrame
+
+    result = defaultdict(list)
+    for row in queryset:
+        for field in vars(row):
+            if field == "_state" or field == "id":
+                continue
+            result[field].append(getattr(row, field))
+    return DataFrame.from_dict(result)
+
+
+def populate_holdings(rows: int, holdings_per_etf: int = 2000) -> None:
+    """Fill the Holdings table with synthetic rows"""
+    from etfs.models import ETF, Holdings
+    from etfs.tickers import TickerCache
+
+    etf_count = max(rows // holdings_per_etf, 1)
+    ETF.objects.bulk_create(
+        ETF(etf_issuer="iShares", name=f"ETF {i}", holdings_url="", portfolio_url="")
+        for i in range(etf_count)
+    )
+    etf_ids = list(ETF.objects.values_list("id", flat=True))
+    ticker_ids = TickerCache().resolve(f"T{i:05d}" for i in range(holdings_per_etf))
+    rng = random.Random(0)
+    Holdings.objects.bulk_create(
+        (
+            Holdings(
+                etf_id=etf_ids[i // holdings_per_etf % etf_count],
+                ticker_id=ticker_ids[f"T{i % holdings_per_etf:05d}"],
+                percentage=rng.uniform(0, 2),
+            )
+            for i in range(rows)
+        ),
+        batch_size=10000,
+    )
+
+
+def measure(function: Callable[[], object]) -> Tuple[float, int]:
+    """Measure the wall time and peak traced memory of a function
+
+    Returns:
+        a tuple containing the time in seconds and the peak memory in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    args = parser.parse_args()
+
+    with benchmark_database():
+        from etfs.models import Holdings
+        from etfs.utils import convert_queryset_to_dataframe
+
+        populate_holdings(args.rows)
+        queryset = Holdings.objects.all()
+        conversions = {
+            "row by row": lambda: convert_row_by_row(queryset.all()),
+            "columnar": lambda: convert_queryset_to_dataframe(
+                queryset.all(), exclude_id=True
+            ),
+            "chunked": lambda: convert_queryset_to_dataframe(
+                queryset.all(), exclude_id=True, chunk_size=args.chunk_size
+            ),
+        }
+        print(f"{args.rows} Holdings rows")
+        print(f"{'conversion':>12} {'time (s)':>9} {'peak (MiB)':>11}")
+        for name, function in conversions.items():
+            elapsed, peak = measure(function)
+            print(f"{name:>12} {elapsed:>9.2f} {peak / 2**20:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -123,6 +123,65 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Caches
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The aggregate cache (etfs.cache) sits in front of the default backend,
+# which must be shared between processes so that the invalidations of the
+# refresh commands reach the web workers. A per-process backend such as
+# LocMemCache would keep serving stale aggregates; Redis works as well.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'aggregate_cache',
+    }
+}
+
+AGGREGATE_CACHE_LOCAL_ENTRIES = 256
+AGGREGATE_CACHE_LOCAL_TTL = 60
+
+# Holdings download cache
+
+HOLDINGS_DOWNLOAD_CACHE = {
+    'DIR': BASE_DIR / 'download_cache',
+    'MAX_ENTRIES': 10000,
+}
+
+# Historical holdings snapshots, see etfs.holdings.history
+
+HOLDINGS_HISTORY = {
+    'DIR': BASE_DIR / 'holdings_history',
+    'KEYFRAME_INTERVAL': 30,
+}
+
+# Memory-mapped snapshot of all holdings shared by worker processes, see
+# etfs.holdings.snapshot. It is exported after every refresh that stores
+# holdings, and the analytics read from it instead of the database
+
+HOLDINGS_SNAPSHOT = {
+    'PATH': BASE_DIR / 'holdings_snapshot.bin',
+}
+
+# Per-stage timings of read_all, see etfs.instrumentation. Each ETF read is
+# logged as one JSON line; set PROMETHEUS_FILE to also write a metrics file
+# for the Prometheus node exporter textfile collector
+
+ETF_INSTRUMENTATION = {
+    'ENABLED': False,
+    'PROMETHEUS_FILE': None,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'etfs.instrumentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
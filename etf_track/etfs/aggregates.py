@@ -0,0 +1,88 @@
+from typing import Any, Dict, Optional
+
+import numpy as np
+from pandas import DataFrame
+
+from etfs.cache import aggregate_cache
+from etfs.holdings.snapshot import get_holdings_snapshot
+from etfs.models import Holdings, Measurement
+from etfs.utils import convert_queryset_to_dataframe
+
+TOP_HOLDINGS = 10
+# the snapshot stores float32 weights, which are rounded back to the number
+# of decimals of the holdings files
+SNAPSHOT_DECIMALS = 5
+
+
+def holdings_frame(etf_id: int) -> DataFrame:
+    """Return the holdings of an ETF as a DataFrame with the columns ticker
+    and percentage, sorted by descending percentage. The holdings are read
+    from the holdings snapshot if it has them, and from the database
+    otherwise. The frame is cached and must not be modified.
+
+    Arguments:
+        etf_id: the id of the ETF to return holdings for
+    """
+
+    def compute() -> DataFrame:
+        holdings = _snapshot_holdings(etf_id)
+        if holdings is None:
+            holdings = convert_queryset_to_dataframe(
+                Holdings.objects.filter(etf_id=etf_id),
+                fields=["ticker__symbol", "percentage"],
+            ).rename(columns={"ticker__symbol": "ticker"})
+        return holdings.sort_values(
+            "percentage", ascending=False, ignore_index=True, kind="stable"
+        )
+
+    return aggregate_cache.get_or_compute(etf_id, "holdings", compute)
+
+
+def _snapshot_holdings(etf_id: int) -> Optional[DataFrame]:
+    """Read the holdings of an ETF from the holdings snapshot
+
+    Arguments:
+        etf_id: the id of the ETF to return holdings for
+
+    Returns:
+        a DataFrame with the columns ticker and percentage, or None if no
+        snapshot is available or it has no holdings for the ETF
+    """
+    snapshot = get_holdings_snapshot()
+    holdings = snapshot.holdings(etf_id) if snapshot is not None else None
+    if holdings is None:
+        return None
+    tickers, weights = holdings
+    return DataFrame(
+        {
+            "ticker": tickers,
+            "percentage": weights.astype(np.float64).round(SNAPSHOT_DECIMALS),
+        }
+    )
+
+
+def etf_summary(etf_id: int) -> Dict[str, Any]:
+    """Return aggregate statistics of an ETF: the number and total weight of
+    its holdings, its largest holdings and its latest measurement. The
+    summary is cached and must not be modified.
+
+    Arguments:
+        etf_id: the id of the ETF to summarise
+    """
+
+    def compute() -> Dict[str, Any]:
+        holdings = holdings_frame(etf_id)
+        latest_measurement = (
+            Measurement.objects.filter(etf_id=etf_id)
+            .order_by("-date_time")
+            .values("date_time", "p_e", "ev_ebidta")
+            .first()
+        )
+        return {
+            "holdings_count": len(holdings),
+            "total_percentage": float(holdings["percentage"].sum()),
+            "top_holdings": holdings.head(TOP_HOLDINGS).to_dict("records"),
+            "latest_measurement": latest_measurement,
+        }
+
+    return aggregate_cache.get_or_compute(etf_id, "summary", compute)
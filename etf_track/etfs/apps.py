@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class EtfsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'etfs'
+
+    def ready(self):
+        from django.db.models.signals import pre_delete
+
+        from etfs.holdings.exposure import remove_deleted_etf
+        from etfs.models import ETF
+
+        # deleting an ETF cascades to its holdings, which would otherwise
+        # leave it in the reverse ticker index
+        pre_delete.connect(remove_deleted_etf, sender=ETF)
@@ -0,0 +1,158 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+_MISSING = object()
+
+
+class AggregateCache:
+    """A two-tier cache for values derived from the data of a single ETF,
+    such as aggregate statistics and holdings frames.
+
+    Values are looked up in an in-process LRU first and then in a Django
+    cache backend. Entries of the in-process LRU are trusted for
+    ``local_ttl`` seconds without any backend access, so a local hit costs
+    no round trip. On a local miss, the value is looked up under the current
+    version of its ETF, a random token kept in the backend. Invalidating an
+    ETF drops its local entries at once and replaces its version, which
+    reaches other processes, such as the web workers after a refresh
+    command, once their local entries expire and only if the backend is
+    shared between them (e.g. FileBasedCache or Redis, not LocMemCache).
+    Cached values are shared between callers and must not be modified.
+
+    Attributes:
+        max_local_entries
+        local_ttl
+        hits_local
+        hits_shared
+        misses
+
+    Methods:
+        get_or_compute
+        invalidate
+        invalidate_many
+        stats
+    """
+
+    def __init__(
+        self,
+        backend_alias: str = "default",
+        max_local_entries: int = 256,
+        local_ttl: float = 60.0,
+    ):
+        """Initialise an AggregateCache object
+
+        Arguments:
+            backend_alias: the alias of the Django cache backend to use
+            max_local_entries: the maximum number of entries in the
+                in-process LRU
+            local_ttl: the number of seconds an entry is kept in the
+                in-process LRU
+        """
+        self._backend_alias = backend_alias
+        self.max_local_entries = max_local_entries
+        self.local_ttl = local_ttl
+        self._local: "OrderedDict[Tuple[int, str], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_local = 0
+        self.hits_shared = 0
+        self.misses = 0
+
+    @property
+    def _backend(self):
+        return caches[self._backend_alias]
+
+    def get_or_compute(self, etf_id: int, name: str, compute: Callable[[], Any]) -> Any:
+        """Return a cached value for an ETF, computing and storing it if it
+        is neither in the in-process LRU nor cached under the ETF's current
+        version
+
+        Arguments:
+            etf_id: the id of the ETF the value is derived from
+            name: the name of the value, unique per ETF
+            compute: a function computing the value
+
+        Returns:
+            the cached or computed value
+        """
+        local_key = (etf_id, name)
+        with self._lock:
+            expires, value = self._local.get(local_key, (0.0, _MISSING))
+            if value is not _MISSING:
+                if expires > time.monotonic():
+                    self._local.move_to_end(local_key)
+                    self.hits_local += 1
+                    return value
+                del self._local[local_key]
+        key = f"etfs:{etf_id}:{self._version(etf_id)}:{name}"
+        value = self._backend.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self._backend.set(key, value)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.hits_shared += 1
+        self._store_local(local_key, value)
+        return value
+
+    def invalidate(self, etf_id: int) -> None:
+        """Invalidate every cached value of an ETF"""
+        self.invalidate_many([etf_id])
+
+    def invalidate_many(self, etf_ids: Iterable[int]) -> None:
+        """Invalidate every cached value of several ETFs at once"""
+        etf_ids = set(etf_ids)
+        with self._lock:
+            for local_key in [key for key in self._local if key[0] in etf_ids]:
+                del self._local[local_key]
+        self._backend.set_many(
+            {self._version_key(etf_id): uuid.uuid4().hex for etf_id in etf_ids},
+            timeout=None,
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit and miss counters of this process"""
+        with self._lock:
+            return {
+                "hits_local": self.hits_local,
+                "hits_shared": self.hits_shared,
+                "misses": self.misses,
+                "local_entries": len(self._local),
+            }
+
+    def _version_key(self, etf_id: int) -> str:
+        return f"etfs:{etf_id}:version"
+
+    def _version(self, etf_id: int) -> str:
+        """Return the current version of an ETF, creating one if the backend
+        has none
+        """
+        key = self._version_key(etf_id)
+        version = self._backend.get(key)
+        if version is None:
+            self._backend.add(key, uuid.uuid4().hex, timeout=None)
+            version = self._backend.get(key)
+        return version
+
+    def _store_local(self, key: Tuple[int, str], value: Any) -> None:
+        """Store a value in the in-process LRU, evicting the least recently
+        used entry if it is full
+        """
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+
+aggregate_cache = AggregateCache(
+    max_local_entries=getattr(settings, "AGGREGATE_CACHE_LOCAL_ENTRIES", 256),
+    local_ttl=getattr(settings, "AGGREGATE_CACHE_LOCAL_TTL", 60.0),
+)
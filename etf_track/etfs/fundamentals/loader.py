@@ -1,48 +1,171 @@
-from typing import Set
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
 
 from etfs.models import Fundamentals, Holdings
+from etfs.ratelimit import TokenBucket
+
+from .reader import FUNDAMENTALS_FIELDS, FundamentalsData, FundamentalsReader
+
+
+class RefreshResult(NamedTuple):
+    """The result of refreshing stale fundamentals"""
+
+    updated: int
+    failed_batches: int
+    failed_tickers: int
 
 
-def update_fundamentals() -> None:
+def update_fundamentals() -> Tuple[int, int]:
     """Update the Fundamentals table by comparing tickers with
-    the Holdings table.
+    the Holdings table. The comparison is done in the database, so the
+    number of queries does not grow with the number of tickers.
+
+    Returns:
+        a tuple containing the number of rows removed and added
     """
-    pass
+    with transaction.atomic():
+        removed = _remove_unused_tickers()
+        added = _add_missing_tickers()
+    return removed, added
 
 
-def _read_all_holding_tickers() -> Set[str]:
-    """Read all the tickers in the Holdings table
+def _remove_unused_tickers() -> int:
+    """Remove rows from the Fundamentals table for tickers that are not held
+    by any ETF, using a single anti-join delete.
 
     Returns:
-        A set of all the tickers in the Holdings table
+        the number of rows removed
     """
-    return {row["ticker"] for row in Holdings.objects.values("ticker")}
+    held = Holdings.objects.filter(ticker=OuterRef("ticker"))
+    deleted, _ = Fundamentals.objects.filter(~Exists(held)).delete()
+    return deleted
 
 
-def _read_all_fundamentals_tickers() -> Set[str]:
-    """Read all the tickers in the Holdings table
+def _add_missing_tickers() -> int:
+    """Add rows to the Fundamentals table for tickers that are held by an
+    ETF but have no fundamentals, using a single bulk insert.
 
     Returns:
-        A set of all the tickers in the Holdings table
+        the number of rows added, counted from the anti-join rather than
+        from bulk_create, which returns every object even when conflicting
+        rows are ignored
     """
-    return {row["ticker"] for row in Fundamentals.objects.values("ticker")}
+    known = Fundamentals.objects.filter(ticker=OuterRef("ticker"))
+    missing_ticker_ids = list(
+        Holdings.objects.filter(~Exists(known))
+        .values_list("ticker", flat=True)
+        .distinct()
+    )
+    Fundamentals.objects.bulk_create(
+        [Fundamentals(ticker_id=ticker_id) for ticker_id in missing_ticker_ids],
+        ignore_conflicts=True,
+    )
+    return len(missing_ticker_ids)
+
 
+def refresh_fundamentals(
+    reader: FundamentalsReader,
+    ttl: timedelta,
+    batch_size: int = 100,
+    workers: int = 4,
+    rate: float = 2.0,
+) -> RefreshResult:
+    """Fetch the fundamentals of every ticker whose fundamentals are older
+    than ``ttl``, or have never been fetched.
 
-def _remove_unused_tickers(unused_tickers: Set[str]) -> None:
-    """Remove rows for unused tickers from the Fundamentals table.
+    Tickers are fetched in batches by up to ``workers`` threads, with the
+    start of each request to the data source limited to ``rate`` per
+    second. Each batch is written back in the calling thread with a single
+    bulk update as soon as it completes. Tickers the reader returns empty
+    fundamentals for are marked as updated, so that they are not fetched
+    again until the TTL expires, while batches that fail and tickers that
+    fail or are missing from the reader's result are left stale to be
+    retried on the next refresh.
 
     Arguments:
-        unused_tickers: a set containing the unused tickers to remove
+        reader: the source of the fundamentals
+        ttl: the maximum age of fundamentals that are not refetched
+        batch_size: the number of tickers per batch
+        workers: the maximum number of batches fetched at the same time
+        rate: the maximum number of requests started per second
+
+    Returns:
+        the number of rows updated and the number of batches and tickers
+        that failed
     """
-    for ticker in unused_tickers:
-        Fundamentals.objects.filter(ticker=ticker).delete()
+    stale = _query_stale_fundamentals(ttl)
+    batches = [stale[i : i + batch_size] for i in range(0, len(stale), batch_size)]
+    bucket = TokenBucket(rate, capacity=workers)
 
+    def read_batch(
+        batch: List[Tuple[int, str]]
+    ) -> Dict[str, Optional[FundamentalsData]]:
+        return reader.read([ticker for _, ticker in batch], throttle=bucket.acquire)
 
-def _add_missing_tickers(missing_tickers: Set[str]) -> None:
-    """Add rows for missing tickers to the Fundamentals table.
+    updated = failed_batches = failed_tickers = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(read_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                fundamentals = future.result()
+            except Exception:
+                failed_batches += 1
+                continue
+            failed_tickers += sum(
+                fundamentals.get(ticker) is None for _, ticker in futures[future]
+            )
+            updated += _write_fundamentals(futures[future], fundamentals)
+    return RefreshResult(updated, failed_batches, failed_tickers)
+
+
+def _query_stale_fundamentals(ttl: timedelta) -> List[Tuple[int, str]]:
+    """Query the Fundamentals rows that have not been fetched within ``ttl``
+
+    Returns:
+        a list of (id, ticker) pairs
+    """
+    cutoff = timezone.now() - ttl
+    return list(
+        Fundamentals.objects.filter(
+            Q(last_updated__isnull=True) | Q(last_updated__lt=cutoff)
+        )
+        .order_by("last_updated", "id")
+        .values_list("id", "ticker__symbol")
+    )
+
+
+def _write_fundamentals(
+    batch: List[Tuple[int, str]], fundamentals: Dict[str, Optional[FundamentalsData]]
+) -> int:
+    """Write the fetched fundamentals of a batch with a single bulk update,
+    skipping the tickers that could not be fetched or are missing from the
+    result
 
     Arguments:
-        missing_tickers: a set containing the missing tickers to add
+        batch: the (id, ticker) pairs of the batch
+        fundamentals: the fundamentals returned by the reader for the batch
+
+    Returns:
+        the number of rows updated
     """
-    for ticker in missing_tickers:
-        Fundamentals.objects.create(ticker=ticker)
+    now = timezone.now()
+    rows = []
+    for fundamentals_id, ticker in batch:
+        values = fundamentals.get(ticker)
+        if values is None:
+            continue
+        rows.append(
+            Fundamentals(
+                id=fundamentals_id,
+                last_updated=now,
+                **{field: values.get(field) for field in FUNDAMENTALS_FIELDS},
+            )
+        )
+    return Fundamentals.objects.bulk_update(
+        rows, ["last_updated", *FUNDAMENTALS_FIELDS]
+    )
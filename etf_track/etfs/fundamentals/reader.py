@@ -0,0 +1,130 @@
+import json
+import logging
+import math
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FundamentalsData = Dict[str, Optional[float]]
+
+FUNDAMENTALS_FIELDS = ["eps", "p_e", "ev_ebitda"]
+
+
+class FundamentalsReader(ABC):
+    """The base class for all fundamentals readers. Fundamentals reader
+    objects fetch the fundamentals of a batch of tickers from a data source.
+
+    Methods:
+        read
+    """
+
+    @abstractmethod
+    def read(
+        self, tickers: List[str], throttle: Callable[[], None] = lambda: None
+    ) -> Dict[str, Optional[FundamentalsData]]:
+        """Fetch the fundamentals of a batch of tickers
+
+        Arguments:
+            tickers: the tickers to fetch fundamentals for
+            throttle: a function called before each request to the data
+                source, which blocks to limit the request rate
+
+        Returns:
+            A dictionary mapping each ticker the source has data for to a
+            dictionary with the keys in FUNDAMENTALS_FIELDS, and each ticker
+            that could not be fetched to None
+        """
+        pass
+
+
+class YahooFundamentalsReader(FundamentalsReader):
+    """The class for reading fundamentals from Yahoo Finance
+
+    Methods:
+        read
+    """
+
+    INFO_KEYS = {
+        "eps": "trailingEps",
+        "p_e": "trailingPE",
+        "ev_ebitda": "enterpriseToEbitda",
+    }
+
+    def read(
+        self, tickers: List[str], throttle: Callable[[], None] = lambda: None
+    ) -> Dict[str, Optional[FundamentalsData]]:
+        """Fetch the fundamentals of a batch of tickers from Yahoo Finance,
+        with one request per ticker. A ticker whose request fails is mapped
+        to None rather than failing the batch.
+        """
+        import yfinance
+
+        batch = yfinance.Tickers(" ".join(tickers))
+        fundamentals: Dict[str, Optional[FundamentalsData]] = {}
+        for ticker in tickers:
+            throttle()
+            try:
+                info = batch.tickers[ticker.upper()].info or {}
+            except Exception as error:
+                logger.warning(
+                    "Fetching the fundamentals of %s failed: %s", ticker, error
+                )
+                fundamentals[ticker] = None
+                continue
+            fundamentals[ticker] = {
+                field: _to_float(info.get(key)) for field, key in self.INFO_KEYS.items()
+            }
+        return fundamentals
+
+
+class FixtureFundamentalsReader(FundamentalsReader):
+    """The class for reading fundamentals from a local fixture, for tests and
+    benchmarks
+
+    Attributes:
+        fixture
+
+    Methods:
+        read
+    """
+
+    def __init__(self, fixture: Dict[str, FundamentalsData]):
+        """Initialise a FixtureFundamentalsReader object
+
+        Arguments:
+            fixture: a dictionary mapping tickers to their fundamentals
+        """
+        self.fixture = fixture
+
+    @classmethod
+    def from_file(cls, path: Path) -> "FixtureFundamentalsReader":
+        """Create a FixtureFundamentalsReader from a JSON file containing an
+        object mapping tickers to their fundamentals
+        """
+        with open(path) as fixture_file:
+            return cls(json.load(fixture_file))
+
+    def read(
+        self, tickers: List[str], throttle: Callable[[], None] = lambda: None
+    ) -> Dict[str, Optional[FundamentalsData]]:
+        """Look up the fundamentals of a batch of tickers in the fixture"""
+        return {
+            ticker: {
+                field: self.fixture[ticker].get(field) for field in FUNDAMENTALS_FIELDS
+            }
+            for ticker in tickers
+            if ticker in self.fixture
+        }
+
+
+def _to_float(value: object) -> Optional[float]:
+    """Convert a value from a data source to a float, or None if it is
+    missing or not a number
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
@@ -0,0 +1,167 @@
+import csv
+from io import StringIO
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+from django.db import connection
+from etfs.models import Holdings
+from etfs.tickers import TickerCache, ticker_details
+from pandas import DataFrame
+
+STAGING_TABLE = "holdings_staging"
+
+
+class HoldingsChanges(NamedTuple):
+    """The changes a merge made to the holdings of a single ETF"""
+
+    weights: Dict[int, float]
+    removed_tickers: Set[int]
+
+
+class HoldingsStage:
+    """Collects the downloaded holdings of many ETFs as CSV rows, so that
+    they can be loaded into a staging table in one bulk copy. Tickers are
+    staged as the ids of their Ticker rows, which are resolved and created
+    as holdings are added.
+
+    Attributes:
+        etf_ids
+
+    Methods:
+        add
+        rows
+        as_csv_file
+    """
+
+    def __init__(self, tickers: TickerCache):
+        """Initialise a HoldingsStage object
+
+        Arguments:
+            tickers: the ticker cache used to resolve staged tickers
+        """
+        self.etf_ids: List[int] = []
+        self._tickers = tickers
+        self._buffer = StringIO()
+
+    def add(self, etf_id: int, holdings: DataFrame) -> None:
+        """Stage the complete holdings of an ETF
+
+        Arguments:
+            etf_id: the id of the ETF
+            holdings: a DataFrame with the columns ticker and percentage, and
+                optionally the details of the tickers
+        """
+        ticker_ids = self._tickers.resolve(holdings["ticker"], ticker_details(holdings))
+        holdings = holdings[["ticker", "percentage"]].drop_duplicates(
+            "ticker", keep="last"
+        )
+        staged = DataFrame(
+            {
+                "etf_id": etf_id,
+                "ticker_id": holdings["ticker"].map(ticker_ids),
+                "percentage": holdings["percentage"],
+            }
+        )
+        staged.to_csv(self._buffer, header=False, index=False, na_rep="NaN")
+        self.etf_ids.append(etf_id)
+
+    def rows(self) -> Iterable[Tuple[int, int, float]]:
+        """Iterate over the staged rows as (etf_id, ticker_id, percentage)"""
+        self._buffer.seek(0)
+        for etf_id, ticker_id, percentage in csv.reader(self._buffer):
+            yield int(etf_id), int(ticker_id), float(percentage)
+
+    def as_csv_file(self) -> StringIO:
+        """Return the staged rows as a CSV file positioned at its start"""
+        self._buffer.seek(0)
+        return self._buffer
+
+
+def merge_staged_holdings(stage: HoldingsStage) -> Dict[int, HoldingsChanges]:
+    """Replace the holdings of every staged ETF with its staged holdings,
+    using set-based statements. The staged rows are copied into a temporary
+    table with COPY on PostgreSQL, or with a batched insert on other
+    databases, and then merged into the holdings table with one DELETE, one
+    UPDATE and one INSERT. Must be called inside a transaction.
+
+    Arguments:
+        stage: the staged holdings
+
+    Returns:
+        a dictionary mapping the id of each ETF whose holdings changed to the
+        changes made, by Ticker id
+    """
+    if not stage.etf_ids:
+        return {}
+    holdings = connection.ops.quote_name(Holdings._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {STAGING_TABLE} ("
+            "etf_id bigint NOT NULL, ticker_id bigint NOT NULL,"
+            " percentage double precision NOT NULL)"
+        )
+        _copy_into_staging(cursor, stage)
+        cursor.execute(
+            f"CREATE INDEX {STAGING_TABLE}_etf_ticker"
+            f" ON {STAGING_TABLE} (etf_id, ticker_id)"
+        )
+        staged_etfs = ", ".join("%s" for _ in stage.etf_ids)
+        matching = (
+            f"SELECT 1 FROM {STAGING_TABLE} s WHERE s.etf_id = {holdings}.etf_id"
+            f" AND s.ticker_id = {holdings}.ticker_id"
+        )
+        changes: Dict[int, HoldingsChanges] = {}
+
+        cursor.execute(
+            f"SELECT s.etf_id, s.ticker_id, s.percentage FROM {STAGING_TABLE} s"
+            f" LEFT JOIN {holdings} h"
+            " ON h.etf_id = s.etf_id AND h.ticker_id = s.ticker_id"
+            " WHERE h.id IS NULL OR h.percentage <> s.percentage"
+        )
+        for etf_id, ticker_id, percentage in cursor.fetchall():
+            changes.setdefault(etf_id, HoldingsChanges({}, set()))
+            changes[etf_id].weights[ticker_id] = percentage
+        cursor.execute(
+            f"SELECT etf_id, ticker_id FROM {holdings}"
+            f" WHERE {holdings}.etf_id IN ({staged_etfs}) AND NOT EXISTS ({matching})",
+            stage.etf_ids,
+        )
+        for etf_id, ticker_id in cursor.fetchall():
+            changes.setdefault(etf_id, HoldingsChanges({}, set()))
+            changes[etf_id].removed_tickers.add(ticker_id)
+
+        cursor.execute(
+            f"DELETE FROM {holdings}"
+            f" WHERE etf_id IN ({staged_etfs}) AND NOT EXISTS ({matching})",
+            stage.etf_ids,
+        )
+        cursor.execute(
+            f"UPDATE {holdings} SET percentage = s.percentage"
+            f" FROM {STAGING_TABLE} s"
+            f" WHERE {holdings}.etf_id = s.etf_id"
+            f" AND {holdings}.ticker_id = s.ticker_id"
+            f" AND {holdings}.percentage <> s.percentage"
+        )
+        cursor.execute(
+            f"INSERT INTO {holdings} (etf_id, ticker_id, percentage)"
+            f" SELECT s.etf_id, s.ticker_id, s.percentage FROM {STAGING_TABLE} s"
+            f" WHERE NOT EXISTS (SELECT 1 FROM {holdings} h"
+            " WHERE h.etf_id = s.etf_id AND h.ticker_id = s.ticker_id)"
+        )
+        cursor.execute(f"DROP TABLE {STAGING_TABLE}")
+    return changes
+
+
+def _copy_into_staging(cursor, stage: HoldingsStage) -> None:
+    """Load the staged rows into the staging table"""
+    if connection.vendor == "postgresql":
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} (etf_id, ticker_id, percentage)"
+            " FROM STDIN WITH (FORMAT csv)",
+            stage.as_csv_file(),
+        )
+    else:
+        cursor.executemany(
+            f"INSERT INTO {STAGING_TABLE} (etf_id, ticker_id, percentage)"
+            " VALUES (%s, %s, %s)",
+            stage.rows(),
+        )
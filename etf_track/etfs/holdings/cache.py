@@ -0,0 +1,231 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from contextlib import contextmanager
+from email.utils import formatdate
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+DOWNLOAD_TIMEOUT = 60
+
+
+def download(url: str, headers: Optional[Dict[str, str]] = None) -> Any:
+    """Open a URL for reading
+
+    Arguments:
+        url: the URL to download
+        headers: additional request headers to send
+
+    Returns:
+        the response object returned by urlopen
+    """
+    return urlopen(Request(url, headers=headers or {}), timeout=DOWNLOAD_TIMEOUT)
+
+
+class DownloadStream(io.RawIOBase):
+    """A readable stream over a response body which hashes and counts the
+    bytes as they are read, so that the body never has to be held in memory
+    as a whole.
+
+    Attributes:
+        bytes_read
+        unchanged
+
+    Methods:
+        hexdigest
+    """
+
+    def __init__(self, response: Any):
+        """Initialise a DownloadStream object
+
+        Arguments:
+            response: the response object returned by urlopen
+        """
+        super().__init__()
+        self._response = response
+        self._hash = hashlib.sha256()
+        self.bytes_read = 0
+        # set by DownloadCache once the stream is consumed
+        self.unchanged = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        size = self._response.readinto(buffer)
+        self._hash.update(memoryview(buffer)[:size])
+        self.bytes_read += size
+        return size
+
+    def hexdigest(self) -> str:
+        """Return the SHA-256 of the bytes read so far"""
+        return self._hash.hexdigest()
+
+
+@contextmanager
+def open_download(url: str) -> Iterator[DownloadStream]:
+    """Open a URL for streaming
+
+    Arguments:
+        url: the URL to download
+
+    Returns:
+        a context manager yielding a DownloadStream over the response body
+    """
+    with download(url) as response:
+        yield DownloadStream(response)
+
+
+class DownloadCache:
+    """An on-disk cache of the metadata of downloaded holdings files, keyed
+    by URL.
+
+    Each entry stores the ETag, Last-Modified header and content hash of a
+    response, which are used to make conditional requests and detect files
+    that have not changed since they were last stored. The response bodies
+    themselves are not kept. The entry of a changed file is only written
+    once ``commit`` is called for its URL, i.e. after its holdings are
+    stored, so a file whose holdings were never stored is downloaded again.
+    The least recently used entries are evicted once there are more than
+    ``max_entries``.
+
+    Attributes:
+        directory
+        max_entries
+        bypass
+
+    Methods:
+        fetch
+        commit
+        discard
+    """
+
+    def __init__(self, directory: Path, max_entries: int, bypass: bool = False):
+        """Initialise a DownloadCache object
+
+        Arguments:
+            directory: the directory to store cache entries in
+            max_entries: the maximum number of stored entries
+            bypass: if True, always download and return the full file, but
+                still refresh the cache entry
+        """
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, str]] = {}
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def fetch(self, url: str) -> Iterator[Optional[DownloadStream]]:
+        """Download a file unless it is unchanged since it was last stored.
+        The body is streamed, so whether its content changed is only known
+        once it is consumed: the ``unchanged`` attribute of the stream is set
+        when the context manager exits.
+
+        Arguments:
+            url: the URL of the file to download
+
+        Returns:
+            a context manager yielding a DownloadStream over the body of the
+            response, or None if the server reports that the file is
+            unchanged
+        """
+        entry = None if self.bypass else self._read_entry(url)
+        try:
+            response = download(url, self._conditional_headers(entry))
+        except HTTPError as error:
+            if error.code == 304 and entry is not None:
+                self._path(url).touch()
+                yield None
+                return
+            raise
+        with response:
+            stream = DownloadStream(response)
+            yield stream
+            headers = response.headers
+        metadata = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified") or formatdate(usegmt=True),
+            "content_hash": stream.hexdigest(),
+        }
+        if entry is not None and entry["content_hash"] == metadata["content_hash"]:
+            stream.unchanged = True
+            self._write_entry(url, metadata)
+            return
+        with self._lock:
+            self._pending[url] = metadata
+
+    def commit(self, url: str) -> None:
+        """Write the entry of the last file fetched from a URL, once its
+        holdings are stored
+
+        Arguments:
+            url: the URL to write the entry for
+        """
+        with self._lock:
+            metadata = self._pending.pop(url, None)
+        if metadata is not None:
+            self._write_entry(url, metadata)
+
+    def discard(self, url: str) -> None:
+        """Remove the entry for a URL, so that the next fetch downloads and
+        returns the full file
+
+        Arguments:
+            url: the URL to remove the entry for
+        """
+        with self._lock:
+            self._pending.pop(url, None)
+            self._path(url).unlink(missing_ok=True)
+
+    def _conditional_headers(self, entry: Optional[Dict[str, str]]) -> Dict[str, str]:
+        """Return the headers for a conditional request based on a cache entry"""
+        if entry is None:
+            return {}
+        headers = {"If-Modified-Since": entry["last_modified"]}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        return headers
+
+    def _path(self, url: str) -> Path:
+        """Return the path of the entry for a URL"""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.directory / (key + ".json")
+
+    def _read_entry(self, url: str) -> Optional[Dict[str, str]]:
+        """Read the entry for a URL, if there is one"""
+        try:
+            with open(self._path(url)) as metadata_file:
+                return json.load(metadata_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_entry(self, url: str, metadata: Dict[str, str]) -> None:
+        """Atomically write the entry for a URL and evict old entries if the
+        cache has grown too large
+        """
+        with self._lock:
+            path = self._path(url)
+            temporary_path = path.with_suffix(".json.tmp")
+            temporary_path.write_text(json.dumps(metadata))
+            os.replace(temporary_path, path)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until at most max_entries
+        are left
+        """
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        for _, path in sorted(entries)[: max(len(entries) - self.max_entries, 0)]:
+            path.unlink(missing_ok=True)
@@ -0,0 +1,182 @@
+from typing import TYPE_CHECKING, Dict, Iterable, Set
+
+from django.db import connection, transaction
+
+from etfs.models import Holdings, TickerExposure
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+# Statements that add or replace, and remove, the weight of one ETF in the
+# holders of many index rows and adjust their counts and totals, so that
+# only the changed keys are sent to the database instead of whole rows. The
+# right hand sides of SET see the holders before the update.
+SET_HOLDER_SQL = {
+    "postgresql": (
+        "WITH v (ticker_id, weight) AS (VALUES {values})"
+        " UPDATE {table} SET holders = jsonb_set(holders, ARRAY[%s::text],"
+        " to_jsonb(v.weight)), etf_count = etf_count"
+        " + CASE WHEN holders -> %s::text IS NULL THEN 1 ELSE 0 END,"
+        " total_percentage = total_percentage + v.weight"
+        " - COALESCE((holders ->> %s::text)::double precision, 0)"
+        " FROM v WHERE {table}.ticker_id = v.ticker_id"
+    ),
+    "sqlite": (
+        "WITH v (ticker_id, weight) AS (VALUES {values})"
+        " UPDATE {table} SET holders = json_set(holders, %s, v.weight),"
+        " etf_count = etf_count"
+        " + CASE WHEN json_type(holders, %s) IS NULL THEN 1 ELSE 0 END,"
+        " total_percentage = total_percentage + v.weight"
+        " - COALESCE(json_extract(holders, %s), 0)"
+        " FROM v WHERE {table}.ticker_id = v.ticker_id"
+    ),
+}
+REMOVE_HOLDER_SQL = {
+    "postgresql": (
+        "UPDATE {table} SET holders = holders - %s::text, etf_count = etf_count - 1,"
+        " total_percentage = total_percentage"
+        " - (holders ->> %s::text)::double precision"
+        " WHERE ticker_id IN ({ticker_ids}) AND holders -> %s::text IS NOT NULL"
+    ),
+    "sqlite": (
+        "UPDATE {table} SET holders = json_remove(holders, %s),"
+        " etf_count = etf_count - 1,"
+        " total_percentage = total_percentage - json_extract(holders, %s)"
+        " WHERE ticker_id IN ({ticker_ids}) AND json_type(holders, %s) IS NOT NULL"
+    ),
+}
+
+
+def update_exposures(
+    etf_id: int, weights: Dict[int, float], removed_tickers: Set[int]
+) -> None:
+    """Apply the changed holdings of one ETF to the reverse ticker index.
+    Only the index rows of the affected tickers are locked, and the weight
+    of the ETF is set in or removed from their holders with one set-based
+    UPDATE each, so the number of queries does not depend on the number of
+    tickers and the holders of other ETFs are never sent to the database.
+
+    Missing rows of added tickers are inserted before the rows are locked,
+    because select_for_update cannot lock rows that do not exist yet: two
+    refreshes adding the same new ticker would otherwise both build its row
+    from scratch and the later upsert would drop the other's holder entry.
+
+    Arguments:
+        etf_id: the id of the ETF whose holdings changed
+        weights: the new percentage weight of each added or changed ticker,
+            by Ticker id
+        removed_tickers: the ids of the Tickers the ETF no longer holds
+    """
+    affected = sorted(set(weights) | set(removed_tickers))
+    if not affected:
+        return
+    vendor = "postgresql" if connection.vendor == "postgresql" else "sqlite"
+    key = str(etf_id) if vendor == "postgresql" else f'$."{etf_id}"'
+    table = connection.ops.quote_name(TickerExposure._meta.db_table)
+    with transaction.atomic():
+        TickerExposure.objects.bulk_create(
+            [TickerExposure(ticker_id=ticker_id) for ticker_id in sorted(weights)],
+            ignore_conflicts=True,
+        )
+        # Rows are locked in ticker order so that concurrent refreshes
+        # cannot deadlock. Only their ids are read.
+        list(
+            TickerExposure.objects.select_for_update()
+            .filter(ticker_id__in=affected)
+            .order_by("ticker_id")
+            .values_list("id", flat=True)
+        )
+        with connection.cursor() as cursor:
+            if weights:
+                values = ", ".join("(%s, %s)" for _ in weights)
+                cursor.execute(
+                    SET_HOLDER_SQL[vendor].format(values=values, table=table),
+                    [
+                        *(value for item in weights.items() for value in item),
+                        key,
+                        key,
+                        key,
+                    ],
+                )
+            if removed_tickers:
+                ticker_ids = ", ".join("%s" for _ in removed_tickers)
+                cursor.execute(
+                    REMOVE_HOLDER_SQL[vendor].format(
+                        table=table, ticker_ids=ticker_ids
+                    ),
+                    [key, key, *removed_tickers, key],
+                )
+        if removed_tickers:
+            TickerExposure.objects.filter(
+                ticker_id__in=list(removed_tickers), etf_count=0
+            ).delete()
+
+
+def remove_deleted_etf(sender, instance, **kwargs) -> None:
+    """Remove an ETF from the reverse ticker index before it is deleted.
+    Connected to the pre_delete signal of ETF, which is sent while the
+    holdings of the ETF still exist.
+    """
+    ticker_ids = Holdings.objects.filter(etf_id=instance.id).values_list(
+        "ticker_id", flat=True
+    )
+    update_exposures(instance.id, {}, set(ticker_ids))
+
+
+def who_holds(ticker: str) -> Dict[int, float]:
+    """Return the ETFs holding a ticker
+
+    Arguments:
+        ticker: the ticker to look up
+
+    Returns:
+        a dictionary mapping the id of each ETF holding the ticker to its
+        percentage weight in that ETF
+    """
+    holders = (
+        TickerExposure.objects.filter(ticker__symbol=ticker)
+        .values_list("holders", flat=True)
+        .first()
+    )
+    return {int(etf_id): weight for etf_id, weight in (holders or {}).items()}
+
+
+def ticker_exposures(tickers: Iterable[str]) -> "DataFrame":
+    """Look up the exposure of ETFs to many tickers in a single query
+
+    Arguments:
+        tickers: the tickers to look up
+
+    Returns:
+        a DataFrame with one row per held ticker and the columns ticker,
+        etf_count and total_percentage
+    """
+    from pandas import DataFrame
+
+    rows = TickerExposure.objects.filter(
+        ticker__symbol__in=list(set(tickers))
+    ).values_list("ticker__symbol", "etf_count", "total_percentage")
+    return DataFrame.from_records(
+        list(rows), columns=["ticker", "etf_count", "total_percentage"]
+    )
+
+
+def exposure_by_etf(tickers: Iterable[str]) -> Dict[int, float]:
+    """Compute the total exposure of every ETF to a set of tickers in a
+    single query
+
+    Arguments:
+        tickers: the tickers to look up
+
+    Returns:
+        a dictionary mapping the id of each ETF holding any of the tickers to
+        the sum of their percentage weights in that ETF
+    """
+    totals: Dict[int, float] = {}
+    holders_of_tickers = TickerExposure.objects.filter(
+        ticker__symbol__in=list(set(tickers))
+    ).values_list("holders", flat=True)
+    for holders in holders_of_tickers:
+        for etf_id, weight in holders.items():
+            totals[int(etf_id)] = totals.get(int(etf_id), 0.0) + weight
+    return totals
@@ -0,0 +1,219 @@
+import os
+from datetime import date, datetime, time, timezone
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from django.conf import settings
+from pandas import DataFrame
+
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S%f"
+
+
+class HoldingsHistory:
+    """An on-disk store of historical holdings snapshots.
+
+    Each ETF has its own directory, so reconstructing one fund never reads
+    the files of another. Tickers are interned per ETF in an append-only
+    ``tickers.txt`` and snapshots are stored as compressed ``.npz`` files of
+    int32 ticker ids and float32 weights. Every ``keyframe_interval``-th
+    snapshot is a full copy of the holdings; the others only store the
+    holdings that were added or changed and the ids of the tickers that were
+    removed since the previous snapshot.
+
+    Attributes:
+        directory
+        keyframe_interval
+
+    Methods:
+        record
+        as_of
+    """
+
+    def __init__(self, directory: Path, keyframe_interval: int = 30):
+        """Initialise a HoldingsHistory object
+
+        Arguments:
+            directory: the root directory of the store
+            keyframe_interval: the number of snapshots between full copies
+        """
+        self.directory = Path(directory)
+        self.keyframe_interval = keyframe_interval
+
+    def record(self, etf_id: int, holdings: DataFrame, taken_at: datetime) -> bool:
+        """Record a snapshot of the holdings of an ETF, stored as a delta
+        against the previous snapshot
+
+        Arguments:
+            etf_id: the id of the ETF
+            holdings: a DataFrame with the columns ticker and percentage
+            taken_at: the time of the snapshot
+
+        Returns:
+            True if a snapshot was written, False if the holdings are
+            unchanged since the previous snapshot
+        """
+        etf_directory = self.directory / str(etf_id)
+        etf_directory.mkdir(parents=True, exist_ok=True)
+        tickers = self._read_tickers(etf_directory)
+        ticker_ids = self._intern(etf_directory, tickers, holdings["ticker"])
+        weights = holdings["percentage"].to_numpy(dtype=np.float32)
+
+        snapshots = self._snapshot_paths(etf_directory)
+        previous = self._reconstruct(snapshots) if snapshots else {}
+        current = dict(zip(ticker_ids.tolist(), weights.tolist()))
+        changed = [
+            ticker_id
+            for ticker_id, weight in current.items()
+            if previous.get(ticker_id) != weight
+        ]
+        removed = [ticker_id for ticker_id in previous if ticker_id not in current]
+        if snapshots and not changed and not removed:
+            return False
+
+        taken_at = taken_at.astimezone(timezone.utc)
+        is_keyframe = len(snapshots) % self.keyframe_interval == 0
+        if is_keyframe:
+            changed, removed = list(current), []
+        self._write_snapshot(
+            etf_directory / (taken_at.strftime(TIMESTAMP_FORMAT) + ".npz"),
+            full=is_keyframe,
+            ticker_ids=np.array(changed, dtype=np.int32),
+            weights=np.array([current[i] for i in changed], dtype=np.float32),
+            removed=np.array(removed, dtype=np.int32),
+        )
+        return True
+
+    def as_of(self, etf_id: int, when: datetime) -> Optional[DataFrame]:
+        """Reconstruct the holdings of an ETF as of a point in time
+
+        Arguments:
+            etf_id: the id of the ETF
+            when: the point in time
+
+        Returns:
+            a DataFrame with the columns ticker and percentage, or None if
+            there is no snapshot of the ETF at or before ``when``
+        """
+        etf_directory = self.directory / str(etf_id)
+        if not etf_directory.is_dir():
+            return None
+        cutoff = when.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+        snapshots = [
+            path for path in self._snapshot_paths(etf_directory) if path.stem <= cutoff
+        ]
+        if not snapshots:
+            return None
+        holdings = self._reconstruct(snapshots)
+        tickers = self._read_tickers(etf_directory)
+        ticker_ids = np.fromiter(holdings, dtype=np.int64, count=len(holdings))
+        return DataFrame(
+            {
+                "ticker": np.asarray(tickers, dtype=object)[ticker_ids],
+                "percentage": np.fromiter(
+                    holdings.values(), dtype=np.float32, count=len(holdings)
+                ),
+            }
+        )
+
+    def _snapshot_paths(self, etf_directory: Path) -> List[Path]:
+        """Return the snapshot files of an ETF in chronological order"""
+        return sorted(etf_directory.glob("*.npz"))
+
+    def _reconstruct(self, snapshots: List[Path]) -> dict:
+        """Apply the snapshots from the last full snapshot onwards
+
+        Returns:
+            a dictionary mapping ticker ids to float32 weights
+        """
+        start = len(snapshots) - 1
+        while start > 0 and not self._read_snapshot(snapshots[start])[0]:
+            start -= 1
+        holdings = {}
+        for path in snapshots[start:]:
+            _, ticker_ids, weights, removed = self._read_snapshot(path)
+            for ticker_id in removed.tolist():
+                holdings.pop(ticker_id, None)
+            holdings.update(zip(ticker_ids.tolist(), weights.tolist()))
+        return holdings
+
+    def _read_snapshot(
+        self, path: Path
+    ) -> Tuple[bool, np.ndarray, np.ndarray, np.ndarray]:
+        """Read a snapshot file
+
+        Returns:
+            a tuple containing whether it is a full snapshot, the ticker ids
+            and weights it stores, and the ids of the removed tickers
+        """
+        with np.load(path) as snapshot:
+            return (
+                bool(snapshot["full"]),
+                snapshot["ticker_ids"],
+                snapshot["weights"],
+                snapshot["removed"],
+            )
+
+    def _write_snapshot(self, path: Path, **arrays) -> None:
+        """Atomically write a snapshot file"""
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as snapshot_file:
+            np.savez_compressed(snapshot_file, **arrays)
+        os.replace(temporary_path, path)
+
+    def _read_tickers(self, etf_directory: Path) -> List[str]:
+        """Read the interned tickers of an ETF, in id order"""
+        try:
+            return (etf_directory / "tickers.txt").read_text().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _intern(
+        self, etf_directory: Path, tickers: List[str], new_tickers
+    ) -> np.ndarray:
+        """Return the ids of tickers, appending unknown tickers to the
+        interned tickers of an ETF
+        """
+        ticker_ids = {ticker: ticker_id for ticker_id, ticker in enumerate(tickers)}
+        unknown = [
+            ticker for ticker in dict.fromkeys(new_tickers) if ticker not in ticker_ids
+        ]
+        if unknown:
+            with open(etf_directory / "tickers.txt", "a") as tickers_file:
+                tickers_file.write("".join(ticker + "\n" for ticker in unknown))
+            for ticker in unknown:
+                ticker_ids[ticker] = len(ticker_ids)
+                tickers.append(ticker)
+        return np.array([ticker_ids[ticker] for ticker in new_tickers], dtype=np.int32)
+
+
+def get_holdings_history() -> Optional[HoldingsHistory]:
+    """Return the store configured by the HOLDINGS_HISTORY setting, or None
+    if no store is configured
+    """
+    history_settings = getattr(settings, "HOLDINGS_HISTORY", None)
+    if not history_settings:
+        return None
+    return HoldingsHistory(
+        history_settings["DIR"], history_settings.get("KEYFRAME_INTERVAL", 30)
+    )
+
+
+def holdings_as_of(etf_id: int, when: Union[date, datetime]) -> Optional[DataFrame]:
+    """Reconstruct the holdings of an ETF as of a date or point in time.
+    A date refers to the end of that day in UTC.
+
+    Arguments:
+        etf_id: the id of the ETF
+        when: the date or point in time
+
+    Returns:
+        a DataFrame with the columns ticker and percentage, or None if no
+        history is configured or recorded for the ETF at that time
+    """
+    history = get_holdings_history()
+    if history is None:
+        return None
+    if not isinstance(when, datetime):
+        when = datetime.combine(when, time.max, tzinfo=timezone.utc)
+    return history.as_of(etf_id, when)
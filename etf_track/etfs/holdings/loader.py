@@ -1,21 +1,254 @@
-from typing import Dict, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from etfs import instrumentation
+from etfs.cache import aggregate_cache
 from etfs.models import ETF, Holdings
+from etfs.tickers import TickerCache, ticker_details
 from etfs.utils import convert_queryset_to_dataframe
 from pandas import DataFrame
 
+from .bulk import HoldingsStage, merge_staged_holdings
+from .cache import DownloadCache
+from .exposure import update_exposures
+from .history import get_holdings_history
 from .reader import iSharesETFReaderCreator
+from .snapshot import refresh_holdings_snapshot
 
 ETF_PROVIDER_CREATOR_MAPPING = {"iShares": iSharesETFReaderCreator}
 
 
-def read_all_etfs(etf_provider: str) -> None:
-    """Reads each ETF associated with a given ETF provider"""
-    creator = ETF_PROVIDER_CREATOR_MAPPING[etf_provider]()
+class ReadOutcome(NamedTuple):
+    """The result of reading and storing the holdings of a single ETF"""
+
+    etf_id: int
+    name: str
+    error: Optional[Exception] = None
+    unchanged: bool = False
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+def read_all_etfs(
+    etf_provider: str, workers: int = 1, force: bool = False
+) -> List[ReadOutcome]:
+    """Reads each ETF associated with a given ETF provider
+
+    Holdings are downloaded by a pool of up to ``workers`` threads, while
+    writes to the database happen one ETF at a time in the calling thread.
+    Holdings files that are unchanged since the last run are skipped.
+
+    Arguments:
+        etf_provider: the name of the ETF provider to read ETFs for
+        workers: the maximum number of concurrent downloads
+        force: if True, read and store every ETF even if its holdings file
+            is unchanged
+
+    Returns:
+        a list containing the outcome of reading each ETF, in the order the
+        downloads completed
+    """
+    cache = _create_download_cache(bypass=force)
+    creator = ETF_PROVIDER_CREATOR_MAPPING[etf_provider](cache)
     etfs = _query_etfs_by_provider(etf_provider)
-    for etf_identifiers in etfs:
-        downloaded_holdings = creator.read(etf_identifiers)
-        _update_holdings(int(etf_identifiers["id"]), downloaded_holdings)
+    tickers = TickerCache()
+    outcomes = []
+    runs = {
+        etf_identifiers["id"]: instrumentation.start_run(
+            int(etf_identifiers["id"]), etf_identifiers["name"]
+        )
+        for etf_identifiers in etfs
+    }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                instrumentation.bind(runs[etf_identifiers["id"]], creator.read),
+                etf_identifiers,
+            ): etf_identifiers
+            for etf_identifiers in etfs
+        }
+        for future in as_completed(futures):
+            etf_identifiers = futures[future]
+            run = runs[etf_identifiers["id"]]
+            with instrumentation.activate(run), instrumentation.count_queries():
+                outcome = _store_downloaded_holdings(
+                    etf_identifiers, future.result, cache, tickers
+                )
+            instrumentation.finish_run(run, _outcome_status(outcome))
+            outcomes.append(outcome)
+    instrumentation.write_metrics(list(runs.values()))
+    _export_snapshot(outcomes)
+    return outcomes
+
+
+def refresh_etf(etf_id: int, force: bool = False) -> ReadOutcome:
+    """Download and store the holdings of a single ETF in the calling thread
+
+    Arguments:
+        etf_id: the id of the ETF to refresh
+        force: if True, store the holdings even if the holdings file is
+            unchanged
+
+    Returns:
+        the outcome of reading the ETF
+    """
+    etf_identifiers = ETF.objects.values(
+        "id", "name", "holdings_url", "etf_issuer"
+    ).get(id=etf_id)
+    cache = _create_download_cache(bypass=force)
+    creator = ETF_PROVIDER_CREATOR_MAPPING[etf_identifiers["etf_issuer"]](cache)
+    run = instrumentation.start_run(etf_id, etf_identifiers["name"])
+    with instrumentation.activate(run), instrumentation.count_queries():
+        outcome = _store_downloaded_holdings(
+            etf_identifiers,
+            partial(creator.read, etf_identifiers),
+            cache,
+            TickerCache(),
+        )
+    instrumentation.finish_run(run, _outcome_status(outcome))
+    _export_snapshot([outcome])
+    return outcome
+
+
+def refresh_provider(
+    etf_provider: str, workers: int = 1, force: bool = False
+) -> List[ReadOutcome]:
+    """Read every ETF of an ETF provider and replace their holdings in a
+    single transaction, so that readers see either none or all of the
+    refreshed holdings. All downloaded holdings are staged in one temporary
+    table, bulk loaded with COPY on PostgreSQL, and merged into the holdings
+    table with set-based statements instead of per-ETF writes.
+
+    Arguments:
+        etf_provider: the name of the ETF provider to read ETFs for
+        workers: the maximum number of concurrent downloads
+        force: if True, read and store every ETF even if its holdings file
+            is unchanged
+
+    Returns:
+        a list containing the outcome of reading each ETF, in the order the
+        downloads completed
+    """
+    cache = _create_download_cache(bypass=force)
+    creator = ETF_PROVIDER_CREATOR_MAPPING[etf_provider](cache)
+    stage = HoldingsStage(TickerCache())
+    downloaded = {}
+    outcomes = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(creator.read, etf_identifiers): etf_identifiers
+            for etf_identifiers in _query_etfs_by_provider(etf_provider)
+        }
+        for future in as_completed(futures):
+            etf_identifiers = futures[future]
+            etf_id = int(etf_identifiers["id"])
+            name = etf_identifiers["name"]
+            try:
+                holdings = future.result()
+                if holdings is not None:
+                    stage.add(etf_id, holdings)
+            except Exception as error:
+                if cache is not None:
+                    cache.discard(etf_identifiers["holdings_url"])
+                outcomes.append(ReadOutcome(etf_id, name, error))
+                continue
+            if holdings is None:
+                outcomes.append(ReadOutcome(etf_id, name, unchanged=True))
+            else:
+                downloaded[etf_id] = (etf_identifiers, holdings)
+    try:
+        with transaction.atomic():
+            changes = merge_staged_holdings(stage)
+            _mark_many_holdings_updated(list(changes))
+            for etf_id, (weights, removed_tickers) in changes.items():
+                update_exposures(etf_id, weights, removed_tickers)
+            for etf_id, (_, holdings) in downloaded.items():
+                _record_holdings_history(etf_id, holdings)
+    except Exception as error:
+        for etf_identifiers, _ in downloaded.values():
+            if cache is not None:
+                cache.discard(etf_identifiers["holdings_url"])
+        return outcomes + [
+            ReadOutcome(int(etf_identifiers["id"]), etf_identifiers["name"], error)
+            for etf_identifiers, _ in downloaded.values()
+        ]
+    if cache is not None:
+        for etf_identifiers, _ in downloaded.values():
+            cache.commit(etf_identifiers["holdings_url"])
+    stored = [
+        ReadOutcome(etf_id, etf_identifiers["name"])
+        for etf_id, (etf_identifiers, _) in downloaded.items()
+    ]
+    _export_snapshot(stored)
+    return outcomes + stored
+
+
+def _outcome_status(outcome: ReadOutcome) -> str:
+    """Describe the outcome of reading an ETF in one word"""
+    if not outcome.succeeded:
+        return "failed"
+    return "unchanged" if outcome.unchanged else "stored"
+
+
+def _create_download_cache(bypass: bool) -> Optional[DownloadCache]:
+    """Create the download cache configured by the HOLDINGS_DOWNLOAD_CACHE
+    setting
+
+    Arguments:
+        bypass: whether the cache should be bypassed for this run
+
+    Returns:
+        a DownloadCache object, or None if no cache is configured
+    """
+    cache_settings = getattr(settings, "HOLDINGS_DOWNLOAD_CACHE", None)
+    if not cache_settings:
+        return None
+    return DownloadCache(
+        cache_settings["DIR"], cache_settings["MAX_ENTRIES"], bypass=bypass
+    )
+
+
+def _store_downloaded_holdings(
+    etf_identifiers: Dict[str, str],
+    download: Callable[[], Optional[DataFrame]],
+    cache: Optional[DownloadCache],
+    tickers: TickerCache,
+) -> ReadOutcome:
+    """Write the result of a download to the holdings table. The cache entry
+    of the holdings file is written once the holdings are committed; if the
+    download or the write fails, it is discarded instead so that the file is
+    read in full on the next run.
+
+    Arguments:
+        etf_identifiers: the identifiers of the ETF that was downloaded
+        download: a callable returning the downloaded holdings, e.g. the
+            result method of the future of a finished download
+        cache: the download cache used for the download, if any
+        tickers: the ticker cache of the refresh
+
+    Returns:
+        the outcome of reading the ETF
+    """
+    etf_id = int(etf_identifiers["id"])
+    name = etf_identifiers["name"]
+    try:
+        downloaded_holdings = download()
+        if downloaded_holdings is None:
+            return ReadOutcome(etf_id, name, unchanged=True)
+        _update_holdings(etf_id, downloaded_holdings, tickers)
+    except Exception as error:
+        if cache is not None:
+            cache.discard(etf_identifiers["holdings_url"])
+        return ReadOutcome(etf_id, name, error)
+    if cache is not None:
+        transaction.on_commit(partial(cache.commit, etf_identifiers["holdings_url"]))
+    return ReadOutcome(etf_id, name)
 
 
 def _query_etfs_by_provider(etf_provider_name: str) -> Tuple[Dict[str, str]]:
@@ -41,27 +274,209 @@ def _query_holdings_by_etf_id(etf_id: int) -> Optional[DataFrame]:
         a DataFrame containing the stored holdings of the given ETF, or None if
         there are no stored holdings
     """
-    query_results = Holdings.objects.filter(etf_id=etf_id)
-    if not query_results:
+    holdings = convert_queryset_to_dataframe(
+        Holdings.objects.filter(etf_id=etf_id),
+        fields=["ticker__symbol", "percentage"],
+    ).rename(columns={"ticker__symbol": "ticker"})
+    if holdings.empty:
         return None
-    query_results = convert_queryset_to_dataframe(query_results, exclude_id=True)
-    query_results = query_results[["ticker", "percentage"]]
-    return query_results
+    return holdings
 
 
-def _update_holdings(etf_id: int, downloaded_holdings: DataFrame) -> None:
+def _query_stored_holdings(etf_id: int) -> DataFrame:
+    """Query the holdings of an ETF, including their primary keys, in a
+    single query
+
+    Arguments:
+        etf_id: the id of the ETF to return holdings for
+
+    Returns:
+        a DataFrame with the columns id, ticker_id, ticker and percentage,
+        which is empty if there are no stored holdings
+    """
+    return convert_queryset_to_dataframe(
+        Holdings.objects.filter(etf_id=etf_id),
+        fields=["id", "ticker_id", "ticker__symbol", "percentage"],
+    ).rename(columns={"ticker__symbol": "ticker"})
+
+
+def _update_holdings(
+    etf_id: int,
+    downloaded_holdings: DataFrame,
+    tickers: Optional[TickerCache] = None,
+) -> None:
     """Write the data in a 'holdings' DataFrame, obtained from an ETFReader
-    object to the holdings table
+    object to the holdings table. The stored holdings are diffed against the
+    downloaded holdings and the differences are written in bulk, so the
+    number of queries does not grow with the number of holdings.
+
+    Arguments:
+        etf_id: the id of the ETF to write holdings for
+        downloaded_holdings: a DataFrame containing tickers, their
+            percentage allocation in an ETF and optionally their details.
+        tickers: the ticker cache of the refresh, if the ETF is written as
+            part of one
+    """
+    with instrumentation.stage("resolve_tickers"):
+        ticker_ids = (tickers or TickerCache()).resolve(
+            downloaded_holdings["ticker"], ticker_details(downloaded_holdings)
+        )
+    with transaction.atomic():
+        with instrumentation.stage("query_stored"):
+            stored_holdings = _query_stored_holdings(etf_id)
+        with instrumentation.stage("diff"):
+            new_holdings, changed_holdings, orphan_tickers = _diff_holdings(
+                downloaded_holdings, stored_holdings
+            )
+        instrumentation.count("rows_created", len(new_holdings))
+        instrumentation.count("rows_updated", len(changed_holdings))
+        instrumentation.count("rows_deleted", len(orphan_tickers))
+        orphan_ticker_ids = _stored_ticker_ids(stored_holdings, orphan_tickers)
+        with instrumentation.stage("write"):
+            _delete_holdings(etf_id, orphan_ticker_ids)
+            _create_holdings(etf_id, new_holdings, ticker_ids)
+            _update_holdings_percentages(changed_holdings)
+        if orphan_tickers or not (new_holdings.empty and changed_holdings.empty):
+            _mark_holdings_updated(etf_id)
+            with instrumentation.stage("exposure"):
+                update_exposures(
+                    etf_id,
+                    _holdings_weights(new_holdings, changed_holdings, ticker_ids),
+                    orphan_ticker_ids,
+                )
+        _record_holdings_history(etf_id, downloaded_holdings)
+
+
+def _export_snapshot(outcomes: List[ReadOutcome]) -> None:
+    """Replace the holdings snapshot, if one is configured, once the stored
+    holdings are committed. The cached aggregates of the stored ETFs are
+    invalidated again after the export, because they may have been
+    recomputed from the previous snapshot in the meantime.
+
+    Arguments:
+        outcomes: the outcomes of a refresh
+    """
+    etf_ids = [o.etf_id for o in outcomes if o.succeeded and not o.unchanged]
+    if not etf_ids:
+        return
+
+    def export() -> None:
+        if refresh_holdings_snapshot() is not None:
+            aggregate_cache.invalidate_many(etf_ids)
+
+    transaction.on_commit(export)
+
+
+def _mark_holdings_updated(etf_id: int) -> None:
+    """Record that the holdings of an ETF changed and invalidate its cached
+    aggregates once the change is committed
 
     Arguments:
-        downloaded_holdings: a DataFrame containing tickers and their
-            percentage allocation in an ETF.
+        etf_id: the id of the ETF whose holdings changed
     """
-    stored_holdings = _query_holdings_by_etf_id(etf_id)
-    if stored_holdings is not None:
-        orphan_tickers = _find_orphan_tickers(downloaded_holdings, stored_holdings)
-        _delete_holdings(etf_id, orphan_tickers)
-    _add_or_update_holdings(etf_id, downloaded_holdings)
+    ETF.objects.filter(id=etf_id).update(holdings_updated=timezone.now())
+    transaction.on_commit(lambda: aggregate_cache.invalidate(etf_id))
+
+
+def _mark_many_holdings_updated(etf_ids: List[int]) -> None:
+    """Record that the holdings of several ETFs changed, in a single update,
+    and invalidate their cached aggregates once the change is committed
+
+    Arguments:
+        etf_ids: the ids of the ETFs whose holdings changed
+    """
+    if not etf_ids:
+        return
+    ETF.objects.filter(id__in=etf_ids).update(holdings_updated=timezone.now())
+    transaction.on_commit(lambda: aggregate_cache.invalidate_many(etf_ids))
+
+
+def _holdings_weights(
+    new_holdings: DataFrame, changed_holdings: DataFrame, ticker_ids: Dict[str, int]
+) -> Dict[int, float]:
+    """Combine created and changed holdings into a mapping of Ticker id to
+    percentage weight
+
+    Arguments:
+        new_holdings: a DataFrame with the columns ticker and percentage
+        changed_holdings: a DataFrame with the columns ticker and percentage
+        ticker_ids: a dictionary mapping each ticker to the id of its Ticker
+
+    Returns:
+        a dictionary mapping the Ticker id of each created or changed ticker
+        to its weight
+    """
+    weights = dict(zip(new_holdings["ticker"], new_holdings["percentage"]))
+    weights.update(zip(changed_holdings["ticker"], changed_holdings["percentage"]))
+    return {ticker_ids[ticker]: float(weight) for ticker, weight in weights.items()}
+
+
+def _stored_ticker_ids(stored_holdings: DataFrame, tickers: Set[str]) -> Set[int]:
+    """Return the Ticker ids of some of the stored holdings of an ETF
+
+    Arguments:
+        stored_holdings: a DataFrame with the columns ticker_id and ticker
+        tickers: the tickers to return ids for
+
+    Returns:
+        the set of Ticker ids of the given tickers
+    """
+    is_selected = stored_holdings["ticker"].isin(tickers)
+    return {
+        int(ticker_id) for ticker_id in stored_holdings.loc[is_selected, "ticker_id"]
+    }
+
+
+def _record_holdings_history(etf_id: int, holdings: DataFrame) -> None:
+    """Record a snapshot of the holdings of an ETF in the holdings history,
+    if one is configured, once the current transaction is committed
+
+    Arguments:
+        etf_id: the id of the ETF
+        holdings: a DataFrame with the columns ticker and percentage
+    """
+    history = get_holdings_history()
+    if history is None:
+        return
+    taken_at = timezone.now()
+    transaction.on_commit(lambda: history.record(etf_id, holdings, taken_at))
+
+
+def _diff_holdings(
+    downloaded_holdings: DataFrame, stored_holdings: DataFrame
+) -> Tuple[DataFrame, DataFrame, Set[str]]:
+    """Compare downloaded holdings against stored holdings
+
+    Arguments:
+        downloaded_holdings: a DataFrame with the columns ticker and percentage
+        stored_holdings: a DataFrame with the columns id, ticker and percentage
+
+    Returns:
+        a tuple containing a DataFrame of holdings to create (ticker,
+        percentage), a DataFrame of stored holdings whose percentage changed
+        (id, ticker, percentage) and the set of orphan tickers to delete
+    """
+    downloaded_holdings = downloaded_holdings[["ticker", "percentage"]]
+    downloaded_holdings = downloaded_holdings.drop_duplicates("ticker", keep="last")
+    merged = downloaded_holdings.merge(
+        stored_holdings,
+        on="ticker",
+        how="left",
+        suffixes=("", "_stored"),
+        indicator=True,
+    )
+    is_new = merged["_merge"] == "left_only"
+    new_holdings = merged.loc[is_new, ["ticker", "percentage"]]
+    percentage, stored_percentage = merged["percentage"], merged["percentage_stored"]
+    # NaN != NaN, so holdings without a weight on both sides are unchanged
+    is_changed = (
+        ~is_new
+        & (percentage != stored_percentage)
+        & ~(percentage.isna() & stored_percentage.isna())
+    )
+    changed_holdings = merged.loc[is_changed, ["id", "ticker", "percentage"]]
+    orphan_tickers = _find_orphan_tickers(downloaded_holdings, stored_holdings)
+    return new_holdings, changed_holdings, orphan_tickers
 
 
 def _find_orphan_tickers(
@@ -76,33 +491,58 @@ def _find_orphan_tickers(
     Returns:
         a set of orphan tickers
     """
-    downloaded_tickers = set(downloaded_holdings["ticker"])
-    stored_tickers = set(stored_holdings["ticker"])
-    return stored_tickers - downloaded_tickers
+    is_orphan = ~stored_holdings["ticker"].isin(downloaded_holdings["ticker"])
+    return set(stored_holdings.loc[is_orphan, "ticker"])
 
 
-def _add_or_update_holdings(etf_id: int, holdings_to_add: DataFrame) -> None:
-    """Create or update rows in the holdings table using data in a DataFrame
+def _create_holdings(
+    etf_id: int, new_holdings: DataFrame, ticker_ids: Dict[str, int]
+) -> None:
+    """Insert rows into the holdings table in a single bulk insert
 
     Arguments:
         etf_id: the etf id to create holdings rows for
-        holdings: the DataFrame containing holdings information
+        new_holdings: a DataFrame with the columns ticker and percentage
+        ticker_ids: a dictionary mapping each ticker to the id of its Ticker
     """
-    for _, row in holdings_to_add.iterrows():
-        Holdings.objects.update_or_create(
-            etf_id=etf_id,
-            ticker=row["ticker"],
-            defaults={"percentage": row["percentage"]},
+    if new_holdings.empty:
+        return
+    Holdings.objects.bulk_create(
+        Holdings(etf_id=etf_id, ticker_id=ticker_ids[ticker], percentage=percentage)
+        for ticker, percentage in zip(
+            new_holdings["ticker"], new_holdings["percentage"]
         )
+    )
+
+
+def _update_holdings_percentages(changed_holdings: DataFrame) -> None:
+    """Update the percentage of existing rows in the holdings table in a
+    single bulk update
+
+    Arguments:
+        changed_holdings: a DataFrame with the columns id and percentage
+    """
+    if changed_holdings.empty:
+        return
+    Holdings.objects.bulk_update(
+        [
+            Holdings(id=int(holding_id), percentage=percentage)
+            for holding_id, percentage in zip(
+                changed_holdings["id"], changed_holdings["percentage"]
+            )
+        ],
+        ["percentage"],
+    )
 
 
-def _delete_holdings(etf_id: int, tickers: Set[str]) -> None:
+def _delete_holdings(etf_id: int, ticker_ids: Set[int]) -> None:
     """Delete all rows from the holdings table with the given etf_id and
-    a value for ticker in the given set.
+    a Ticker id in the given set.
 
     Arguments:
         etf_id: the id of the ETF to delete holdings for
-        tickers: the set of tickers to delete rows for
+        ticker_ids: the set of Ticker ids to delete rows for
     """
-    for ticker in tickers:
-        Holdings.objects.filter(etf_id=etf_id, ticker=ticker).delete()
+    if not ticker_ids:
+        return
+    Holdings.objects.filter(etf_id=etf_id, ticker_id__in=ticker_ids).delete()
@@ -0,0 +1,77 @@
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+from pandas import DataFrame
+
+from etfs.tickers import ticker_values
+
+from .snapshot import load_holdings_matrix
+
+
+class LookThrough(NamedTuple):
+    """The aggregated single-stock exposure of a portfolio of ETFs"""
+
+    exposures: DataFrame
+    p_e: float
+    missing_etf_ids: List[int]
+
+
+def look_through(portfolio: Dict[int, float]) -> LookThrough:
+    """Aggregate the holdings of a portfolio of ETFs into single-stock
+    exposures. The holdings of all ETFs are loaded in a single query and the
+    exposures are computed as one product of the transposed holdings matrix
+    with the vector of portfolio weights. The symbols and P/E ratios of the
+    held tickers are looked up together by Ticker id.
+
+    Arguments:
+        portfolio: a dictionary mapping ETF ids to their weight in the
+            portfolio, as fractions summing to 1
+
+    Returns:
+        a LookThrough with a DataFrame of tickers and their percentage
+        exposure sorted by decreasing exposure, the weighted harmonic mean P/E
+        of the exposures (NaN when no ticker has a positive P/E) and the ids
+        of the ETFs without stored holdings
+    """
+    matrix = load_holdings_matrix(portfolio)
+    weights = np.array(
+        [portfolio[int(etf_id)] for etf_id in matrix.etf_ids], dtype=np.float64
+    )
+    percentages = matrix.transpose_dot(weights)
+    ticker_ids = matrix.ticker_ids.tolist()
+    tickers = ticker_values(ticker_ids, "symbol", "fundamentals__p_e")
+    p_e = np.array(
+        [tickers[ticker_id][1] for ticker_id in ticker_ids], dtype=np.float64
+    )
+    exposures = DataFrame(
+        {
+            "ticker": [tickers[ticker_id][0] for ticker_id in ticker_ids],
+            "percentage": percentages,
+        }
+    )
+    exposures = exposures.sort_values(
+        "percentage", ascending=False, ignore_index=True, kind="stable"
+    )
+    return LookThrough(
+        exposures=exposures,
+        p_e=_harmonic_p_e(percentages, p_e),
+        missing_etf_ids=sorted(set(portfolio) - set(matrix.etf_ids.tolist())),
+    )
+
+
+def _harmonic_p_e(percentages: np.ndarray, p_e: np.ndarray) -> float:
+    """Compute the exposure-weighted harmonic mean P/E of a set of tickers,
+    excluding tickers with a missing or non-positive P/E
+
+    Arguments:
+        percentages: the percentage exposure to each ticker
+        p_e: the P/E of each ticker, NaN where it is missing
+
+    Returns:
+        the weighted harmonic mean P/E, NaN when no ticker has a usable P/E
+    """
+    usable = np.isfinite(p_e) & (p_e > 0)
+    weight = percentages[usable]
+    if weight.sum() <= 0:
+        return float("nan")
+    return float(weight.sum() / (weight / p_e[usable]).sum())
@@ -0,0 +1,146 @@
+from typing import Iterable, Optional
+
+import numpy as np
+from pandas import factorize
+
+from etfs.models import Holdings
+from etfs.utils import convert_queryset_to_dataframe
+
+
+class HoldingsMatrix:
+    """A sparse ETF x ticker matrix of holdings weights, stored in compressed
+    sparse row (CSR) form: the weights of the holdings of the ETF in row
+    ``i`` are ``data[indptr[i]:indptr[i + 1]]`` and the columns of those
+    weights are ``indices[indptr[i]:indptr[i + 1]]``. Columns are identified
+    by Ticker ids; symbols are only looked up for display.
+
+    Attributes:
+        etf_ids
+        ticker_ids
+        indptr
+        indices
+        data
+
+    Methods:
+        from_database
+        select
+        dot
+        transpose_dot
+        row_indices
+    """
+
+    def __init__(
+        self,
+        etf_ids: np.ndarray,
+        ticker_ids: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        data: np.ndarray,
+    ):
+        """Initialise a HoldingsMatrix object
+
+        Arguments:
+            etf_ids: the ETF id of each row
+            ticker_ids: the Ticker id of each column
+            indptr: the offsets of the holdings of each row in indices and data
+            indices: the column of each holding
+            data: the percentage weight of each holding
+        """
+        self.etf_ids = etf_ids
+        self.ticker_ids = ticker_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_database(cls, etf_ids: Optional[Iterable[int]] = None) -> "HoldingsMatrix":
+        """Load the holdings of all ETFs, or of the given ETFs, in a single
+        query
+
+        Arguments:
+            etf_ids: the ids of the ETFs to load, defaults to all ETFs
+
+        Returns:
+            a HoldingsMatrix with one row per ETF that has holdings
+        """
+        queryset = Holdings.objects.all()
+        if etf_ids is not None:
+            queryset = queryset.filter(etf_id__in=list(etf_ids))
+        holdings = convert_queryset_to_dataframe(
+            queryset.order_by("etf_id"), fields=["etf", "ticker", "percentage"]
+        )
+        row_ids = holdings["etf_id"].to_numpy()
+        unique_etf_ids, row_counts = np.unique(row_ids, return_counts=True)
+        indptr = np.zeros(len(unique_etf_ids) + 1, dtype=np.int64)
+        np.cumsum(row_counts, out=indptr[1:])
+        indices, ticker_ids = factorize(holdings["ticker_id"].to_numpy())
+        return cls(
+            unique_etf_ids,
+            np.asarray(ticker_ids, dtype=np.int64),
+            indptr,
+            indices.astype(np.int32),
+            holdings["percentage"].to_numpy(dtype=np.float64),
+        )
+
+    def select(self, etf_ids: Iterable[int]) -> "HoldingsMatrix":
+        """Return the rows of the given ETFs, keeping only the columns of
+        the tickers they hold
+
+        Arguments:
+            etf_ids: the ids of the ETFs to select
+
+        Returns:
+            a HoldingsMatrix with one row per selected ETF that has holdings
+        """
+        rows = np.flatnonzero(np.isin(self.etf_ids, np.fromiter(etf_ids, np.int64)))
+        positions = np.flatnonzero(np.isin(self.row_indices(), rows))
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(self.indptr[rows + 1] - self.indptr[rows], out=indptr[1:])
+        columns, indices = np.unique(self.indices[positions], return_inverse=True)
+        return HoldingsMatrix(
+            self.etf_ids[rows],
+            self.ticker_ids[columns],
+            indptr,
+            indices.astype(np.int32),
+            self.data[positions].astype(np.float64),
+        )
+
+    @property
+    def shape(self):
+        return len(self.etf_ids), len(self.ticker_ids)
+
+    def row_indices(self) -> np.ndarray:
+        """Return the row of each stored holding"""
+        return np.repeat(
+            np.arange(len(self.etf_ids), dtype=np.int32), np.diff(self.indptr)
+        )
+
+    def dot(self, vector: np.ndarray) -> np.ndarray:
+        """Multiply the matrix by a vector with one value per ticker
+
+        Arguments:
+            vector: an array of length len(ticker_ids)
+
+        Returns:
+            an array with one value per ETF
+        """
+        return np.bincount(
+            self.row_indices(),
+            weights=self.data * vector[self.indices],
+            minlength=len(self.etf_ids),
+        )
+
+    def transpose_dot(self, vector: np.ndarray) -> np.ndarray:
+        """Multiply the transposed matrix by a vector with one value per ETF
+
+        Arguments:
+            vector: an array of length len(etf_ids)
+
+        Returns:
+            an array with one value per ticker
+        """
+        return np.bincount(
+            self.indices,
+            weights=self.data * vector[self.row_indices()],
+            minlength=len(self.ticker_ids),
+        )
@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Dict
+from contextlib import ExitStack, contextmanager
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
 
-from pandas import DataFrame, read_csv
+from etfs import instrumentation
+from pandas import DataFrame, concat, read_csv
+
+from .cache import DownloadCache, DownloadStream, open_download
 
 
 """--- factory method pattern code ---"""
@@ -13,35 +17,80 @@ class ETFReader(ABC):
 
     Attributes:
         _identifiers
+        _cache
 
     Methods:
-        _download
+        _fetch
+        _parse
     """
 
-    def __init__(self, identifiers: Dict[str, str]):
+    def __init__(
+        self, identifiers: Dict[str, str], cache: Optional[DownloadCache] = None
+    ):
         """Initialise an ETFReader object"""
         self._identifiers = identifiers
+        self._cache = cache
 
-    def read(self) -> DataFrame:
+    def read(self) -> Optional[DataFrame]:
         """The endpoint for reading an ETF's holdings and returning
         them in a ``DataFrame``
 
         Returns:
-            A ``DataFrame`` containing the ticker, exchange and weight of
-            the holdings of the ETF
+            A ``DataFrame`` containing the ticker and weight of the holdings
+            of the ETF, and their sector, exchange and location where the
+            source provides them, or None if the holdings are unchanged
+            since they were last read
         """
-        holdings = self._download()
-        holdings = self._clean_holdings(holdings)
-        holdings = self._transform_holdings(holdings)
+        with self._fetch(self._identifiers["holdings_url"]) as stream:
+            if stream is None:
+                return None
+            transformed = []
+            for holdings in instrumentation.timed("parse", self._parse(stream)):
+                with instrumentation.stage("clean"):
+                    holdings = self._clean_holdings(holdings)
+                with instrumentation.stage("transform"):
+                    transformed.append(self._transform_holdings(holdings))
+        if stream.unchanged:
+            return None
+        holdings = concat(transformed, ignore_index=True)
+        instrumentation.count("rows_downloaded", len(holdings))
         return holdings
 
+    @contextmanager
+    def _fetch(self, url: str) -> Iterator[Optional[DownloadStream]]:
+        """Open a file for streaming, going through the download cache if
+        there is one
+
+        Arguments:
+            url: the URL of the file to download
+
+        Returns:
+            a context manager yielding a stream over the contents of the
+            file, or None if the cache reports that the file is unchanged
+        """
+        with ExitStack() as stack:
+            with instrumentation.stage("download"):
+                stream = stack.enter_context(
+                    open_download(url)
+                    if self._cache is None
+                    else self._cache.fetch(url)
+                )
+            yield stream
+        if stream is not None:
+            instrumentation.count("bytes_downloaded", stream.bytes_read)
+
     @abstractmethod
-    def _download(self) -> DataFrame:
-        """Download and store the data for a given ETF's holdings in a
-        ``DataFrame``.
+    def _parse(self, stream: BinaryIO) -> Iterable[DataFrame]:
+        """Parse the streamed data of a given ETF's holdings into one or
+        more ``DataFrame`` chunks, which are cleaned and transformed one at
+        a time.
+
+        Arguments:
+            stream: the contents of the holdings file
 
         Returns:
-            A ``DataFrame`` containing holdings data for ETF being processed.
+            An iterable of ``DataFrame`` chunks containing holdings data for
+            ETF being processed.
         """
         pass
 
@@ -52,71 +101,124 @@ class ETFReader(ABC):
 
     @abstractmethod
     def _transform_holdings(self, holdings: DataFrame) -> DataFrame:
-        """Transform the dataframe so that it contains two columns, ticker
-        and percentage of fund
+        """Transform the dataframe so that it contains the columns ticker
+        and percentage of fund, followed by any of sector, exchange and
+        location
         """
         pass
 
 
 class iSharesETFReader(ETFReader):
-    """The class for iShares ETF readers.
+    """The class for iShares ETF readers. Only the columns that are needed
+    are parsed, with explicit types, in chunks of ``CHUNKSIZE`` rows so that
+    large holdings files (e.g. bond funds) are read in bounded memory.
 
     Attributes:
+        COLUMNS
+        DTYPES
+        CHUNKSIZE
 
     Methods:
-        _download
+        _parse
         _parse_average_price_earnings
         _parse_average_ev_ebitda
     """
 
-    def _download(self) -> DataFrame:
-        """Download and store the data for a given ETF's holdings in a
-        ``DataFrame``.
+    COLUMNS = {
+        "Ticker": "ticker",
+        "Weight (%)": "percentage",
+        "Sector": "sector",
+        "Exchange": "exchange",
+        "Location": "location",
+    }
+    DTYPES = {
+        "Ticker": "object",
+        "Sector": "category",
+        "Weight (%)": "float64",
+        "Exchange": "category",
+        "Location": "category",
+    }
+    CHUNKSIZE = 10000
+
+    def _parse(self, stream: BinaryIO) -> Iterable[DataFrame]:
+        """Parse the streamed data of a given ETF's holdings into
+        ``DataFrame`` chunks.
+
+        Arguments:
+            stream: the contents of the holdings file
 
         Returns:
-            A ``DataFrame`` containing holdings data for ETF being processed.
+            An iterable of ``DataFrame`` chunks containing holdings data for
+            ETF being processed.
         """
-        return read_csv(self._identifiers["holdings_url"], skiprows=[0, 1])
+        return read_csv(
+            stream,
+            skiprows=[0, 1],
+            # Exchange and Location are missing from some holdings files
+            usecols=lambda column: column in self.DTYPES,
+            dtype=self.DTYPES,
+            keep_default_na=False,
+            na_values={
+                "Sector": [""],
+                # placeholders for holdings without a reported weight
+                "Weight (%)": ["", "-", "--", "N/A"],
+                "Exchange": [""],
+                "Location": [""],
+            },
+            chunksize=self.CHUNKSIZE,
+        )
 
     def _clean_holdings(self, holdings) -> DataFrame:
-        """Apply data-cleaning steps to the holdings ``DataFrame``"""
-        holdings = holdings[holdings.Sector.notnull()]
-        holdings = holdings[holdings.Sector != "Cash and/or Derivatives"]
-        return holdings
+        """Drop cash, derivatives and rows without a sector from the holdings
+        ``DataFrame``, keeping only the columns in COLUMNS
+        """
+        sector = holdings["Sector"]
+        is_security = sector.notna() & (sector != "Cash and/or Derivatives")
+        columns = [column for column in self.COLUMNS if column in holdings]
+        return holdings.loc[is_security.to_numpy(), columns]
 
     def _transform_holdings(self, holdings: DataFrame) -> DataFrame:
-        """Transform the dataframe so that it contains two columns, ticker
-        and percentage of fund
+        """Transform the dataframe so that it contains the columns ticker
+        and percentage of fund, followed by the sector, exchange and
+        location columns present in the file
         """
-        holdings = holdings[["Ticker", "Weight (%)"]]
-        holdings = holdings.rename(
-            columns={"Ticker": "ticker", "Weight (%)": "percentage"}
-        )
-        return holdings
+        return holdings.rename(columns=self.COLUMNS, copy=False)
 
 
 class ETFReaderCreator(ABC):
     """The creator class for ETFReader objects.
 
     Attributes:
+        _cache
 
     Methods:
         _factory_method
         read
     """
 
+    def __init__(self, cache: Optional[DownloadCache] = None):
+        """Initialise an ETFReaderCreator object
+
+        Arguments:
+            cache: the download cache passed to each ETFReader, if any
+        """
+        self._cache = cache
+
     @staticmethod
     @abstractmethod
-    def _factory_method(identifiers: Dict[str, str]) -> ETFReader:
+    def _factory_method(
+        identifiers: Dict[str, str], cache: Optional[DownloadCache]
+    ) -> ETFReader:
         """Returns a subclass of ETFReader."""
         pass
 
-    def read(self, identifiers: Dict[str, str]) -> DataFrame:
+    def read(self, identifiers: Dict[str, str]) -> Optional[DataFrame]:
         """Create a reader using a factory method and use it to read
         from the specified ETF.
         """
-        reader = self._factory_method(identifiers)
-        return reader.read()
+        reader = self._factory_method(identifiers, self._cache)
+        with instrumentation.stage("read"):
+            return reader.read()
 
 
 class iSharesETFReaderCreator(ETFReaderCreator):
@@ -130,6 +232,8 @@ class iSharesETFReaderCreator(ETFReaderCreator):
     """
 
     @staticmethod
-    def _factory_method(identifiers: Dict[str, str]) -> ETFReader:
+    def _factory_method(
+        identifiers: Dict[str, str], cache: Optional[DownloadCache]
+    ) -> ETFReader:
         """Returns a subclass of ETFReader."""
-        return iSharesETFReader(identifiers)
+        return iSharesETFReader(identifiers, cache)
@@ -0,0 +1,146 @@
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from etfs.models import ETF, ETFSimilarity
+
+from .matrix import HoldingsMatrix
+from .snapshot import load_holdings_matrix
+
+METRICS = ["overlap", "cosine"]
+WRITE_BATCH_SIZE = 5000
+
+
+def update_similarities(full: bool = False) -> int:
+    """Recompute the stored similarities of every ETF whose holdings changed
+    since its similarities were last computed, or of every ETF if ``full``.
+
+    The holdings of all ETFs are loaded into a sparse weight matrix and the
+    weighted overlap and cosine similarity of every pair involving a changed
+    ETF are computed in one batched pass over the common holdings.
+
+    Arguments:
+        full: whether to recompute the similarities of every ETF
+
+    Returns:
+        the number of ETFs whose similarities were recomputed
+    """
+    stale = ETF.objects.all()
+    if not full:
+        stale = stale.filter(
+            Q(similarity_updated__isnull=True)
+            | Q(holdings_updated__gt=F("similarity_updated"))
+        )
+    stale_ids = np.array(list(stale.values_list("id", flat=True)), dtype=np.int64)
+    if len(stale_ids) == 0:
+        return 0
+    matrix = load_holdings_matrix()
+    left, right, overlap, cosine = pairwise_similarities(
+        matrix, np.isin(matrix.etf_ids, stale_ids)
+    )
+    similarities = (
+        ETFSimilarity(
+            etf_id=etf_id, other_id=other_id, overlap=pair_overlap, cosine=pair_cosine
+        )
+        for etf_id, other_id, pair_overlap, pair_cosine in zip(
+            matrix.etf_ids[left].tolist(),
+            matrix.etf_ids[right].tolist(),
+            overlap.tolist(),
+            cosine.tolist(),
+        )
+    )
+    with transaction.atomic():
+        ETFSimilarity.objects.filter(
+            Q(etf_id__in=stale_ids.tolist()) | Q(other_id__in=stale_ids.tolist())
+        ).delete()
+        ETFSimilarity.objects.bulk_create(similarities, batch_size=WRITE_BATCH_SIZE)
+        ETF.objects.filter(id__in=stale_ids.tolist()).update(
+            similarity_updated=timezone.now()
+        )
+    return len(stale_ids)
+
+
+def pairwise_similarities(
+    matrix: HoldingsMatrix, changed: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the weighted overlap and cosine similarity of every pair of
+    rows with a common holding where at least one row has changed.
+
+    Arguments:
+        matrix: the holdings weights
+        changed: a boolean array marking the changed rows
+
+    Returns:
+        a tuple containing the two row indices of each pair, their overlap
+        and their cosine similarity; each pair appears in both directions
+    """
+    rows = matrix.row_indices()
+    order = np.argsort(matrix.indices, kind="stable")
+    sorted_rows, sorted_columns = rows[order], matrix.indices[order]
+    sorted_weights = matrix.data[order]
+    column_sizes = np.bincount(matrix.indices, minlength=len(matrix.ticker_ids))
+    column_starts = np.cumsum(column_sizes) - column_sizes
+
+    # pair every holding of a changed row with every holding of the same
+    # ticker, which yields both directions of pairs of two changed rows
+    left = np.nonzero(changed[sorted_rows])[0]
+    sizes = column_sizes[sorted_columns[left]]
+    starts = column_starts[sorted_columns[left]]
+    left = np.repeat(left, sizes)
+    right = np.repeat(starts - (np.cumsum(sizes) - sizes), sizes) + np.arange(len(left))
+    left_rows, right_rows = sorted_rows[left], sorted_rows[right]
+    distinct = left_rows != right_rows
+    left, right = left[distinct], right[distinct]
+    left_rows, right_rows = left_rows[distinct], right_rows[distinct]
+
+    row_count = len(matrix.etf_ids)
+    pair_keys, pair_index = np.unique(
+        left_rows.astype(np.int64) * row_count + right_rows, return_inverse=True
+    )
+    overlap = np.bincount(
+        pair_index, weights=np.minimum(sorted_weights[left], sorted_weights[right])
+    )
+    dot = np.bincount(pair_index, weights=sorted_weights[left] * sorted_weights[right])
+    norms = np.sqrt(np.bincount(rows, weights=matrix.data**2, minlength=row_count))
+    pair_left, pair_right = np.divmod(pair_keys, row_count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine = np.nan_to_num(dot / (norms[pair_left] * norms[pair_right]))
+
+    # add the reverse direction of pairs where only the left row changed
+    reverse = ~changed[pair_right]
+    return (
+        np.concatenate([pair_left, pair_right[reverse]]),
+        np.concatenate([pair_right, pair_left[reverse]]),
+        np.concatenate([overlap, overlap[reverse]]),
+        np.concatenate([cosine, cosine[reverse]]),
+    )
+
+
+def similar_etfs(
+    etf_id: int, k: int = 10, metric: str = "overlap"
+) -> List[Dict[str, Any]]:
+    """Return the k ETFs most similar to an ETF from the stored similarities
+
+    Arguments:
+        etf_id: the id of the ETF
+        k: the number of ETFs to return
+        metric: overlap or cosine
+
+    Returns:
+        a list of dictionaries with the keys etf_id, name, overlap and cosine,
+        most similar first
+    """
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    similarities = (
+        ETFSimilarity.objects.filter(etf_id=etf_id)
+        .order_by(f"-{metric}")
+        .values_list("other_id", "other__name", "overlap", "cosine")[:k]
+    )
+    return [
+        {"etf_id": other_id, "name": name, "overlap": overlap, "cosine": cosine}
+        for other_id, name, overlap, cosine in similarities
+    ]
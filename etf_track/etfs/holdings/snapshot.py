@@ -0,0 +1,246 @@
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from etfs.tickers import ticker_values
+
+from .matrix import HoldingsMatrix
+
+MAGIC = b"ETFHOLD2"
+# magic, then the number of ETFs, holdings and tickers and the size of the
+# ticker table in bytes
+HEADER = struct.Struct("<8sqqqq")
+ALIGNMENT = 8
+
+
+class HoldingsSnapshot:
+    """A read-only, memory-mapped snapshot of the holdings of every ETF,
+    stored in compressed sparse row form. The arrays are views of the file,
+    so processes that open the same snapshot share its pages instead of
+    each holding a copy.
+
+    The file holds a header followed by int32 ETF ids, int64 row offsets,
+    int32 column indices, float32 weights, the int64 Ticker id of each
+    column and a table of the symbols of the columns, each section aligned
+    to 8 bytes.
+
+    Attributes:
+        path
+        etf_ids
+        indptr
+        indices
+        data
+        ticker_ids
+        tickers
+
+    Methods:
+        write
+        holdings
+        to_matrix
+    """
+
+    def __init__(self, path: Path):
+        """Open a snapshot file
+
+        Arguments:
+            path: the path of the snapshot file
+        """
+        self.path = Path(path)
+        with open(self.path, "rb") as snapshot_file:
+            header = snapshot_file.read(HEADER.size)
+        magic, etfs, holdings, tickers, tickers_size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a holdings snapshot")
+        offset = HEADER.size
+        self.etf_ids, offset = self._map(np.int32, etfs, offset)
+        self.indptr, offset = self._map(np.int64, etfs + 1, offset)
+        self.indices, offset = self._map(np.int32, holdings, offset)
+        self.data, offset = self._map(np.float32, holdings, offset)
+        self.ticker_ids, offset = self._map(np.int64, tickers, offset)
+        ticker_table, _ = self._map(np.uint8, tickers_size, offset)
+        self.tickers = np.array(
+            ticker_table.tobytes().decode().split("\n") if tickers else [],
+            dtype=object,
+        )
+
+    def _map(self, dtype, count: int, offset: int) -> Tuple[np.ndarray, int]:
+        """Map ``count`` items of a dtype at an offset of the file
+
+        Returns:
+            the mapped array and the aligned offset of the next section
+        """
+        size = np.dtype(dtype).itemsize * count
+        if count == 0:
+            array = np.empty(0, dtype=dtype)
+        else:
+            array = np.memmap(
+                self.path, dtype=dtype, mode="r", offset=offset, shape=count
+            )
+        return array, _align(offset + size)
+
+    @staticmethod
+    def write(path: Path, matrix: HoldingsMatrix, symbols: List[str]) -> None:
+        """Write a holdings matrix to a snapshot file. The file is written
+        next to its destination and then renamed over it, so readers always
+        see either the old or the new snapshot.
+
+        Arguments:
+            path: the path of the snapshot file
+            matrix: the holdings to write
+            symbols: the symbol of each column of the matrix
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        ticker_table = "\n".join(symbols).encode()
+        sections = [
+            np.ascontiguousarray(matrix.etf_ids, dtype=np.int32),
+            np.ascontiguousarray(matrix.indptr, dtype=np.int64),
+            np.ascontiguousarray(matrix.indices, dtype=np.int32),
+            np.ascontiguousarray(matrix.data, dtype=np.float32),
+            np.ascontiguousarray(matrix.ticker_ids, dtype=np.int64),
+        ]
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=path.parent, prefix=path.name, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(descriptor, "wb") as snapshot_file:
+                snapshot_file.write(
+                    HEADER.pack(
+                        MAGIC,
+                        len(matrix.etf_ids),
+                        len(matrix.data),
+                        len(matrix.ticker_ids),
+                        len(ticker_table),
+                    )
+                )
+                for section in [*(array.tobytes() for array in sections), ticker_table]:
+                    snapshot_file.write(section)
+                    snapshot_file.write(b"\0" * (_align(len(section)) - len(section)))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            # mkstemp creates files readable by their owner only
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def holdings(self, etf_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Return the holdings of an ETF
+
+        Arguments:
+            etf_id: the id of the ETF
+
+        Returns:
+            a tuple containing the tickers and weights of the ETF's holdings,
+            or None if the snapshot has no holdings for the ETF
+        """
+        row = int(np.searchsorted(self.etf_ids, etf_id))
+        if row == len(self.etf_ids) or self.etf_ids[row] != etf_id:
+            return None
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.tickers[self.indices[start:end]], self.data[start:end]
+
+    def to_matrix(self) -> HoldingsMatrix:
+        """Return a HoldingsMatrix backed by the mapped arrays"""
+        return HoldingsMatrix(
+            self.etf_ids, self.ticker_ids, self.indptr, self.indices, self.data
+        )
+
+
+def _align(offset: int) -> int:
+    """Round an offset up to the next multiple of ALIGNMENT"""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def get_snapshot_path() -> Optional[Path]:
+    """Return the snapshot path configured by the HOLDINGS_SNAPSHOT setting,
+    or None if no snapshot is configured
+    """
+    snapshot_settings = getattr(settings, "HOLDINGS_SNAPSHOT", None)
+    return Path(snapshot_settings["PATH"]) if snapshot_settings else None
+
+
+def export_holdings_snapshot(path: Optional[Path] = None) -> HoldingsMatrix:
+    """Export the current holdings of every ETF to a snapshot file
+
+    Arguments:
+        path: the path of the snapshot file, defaults to the configured path
+
+    Returns:
+        the exported holdings
+    """
+    path = path or get_snapshot_path()
+    if path is None:
+        raise ValueError("No holdings snapshot path is configured")
+    matrix = HoldingsMatrix.from_database()
+    symbols = ticker_values(matrix.ticker_ids.tolist(), "symbol")
+    HoldingsSnapshot.write(
+        path,
+        matrix,
+        [symbols[ticker_id][0] for ticker_id in matrix.ticker_ids.tolist()],
+    )
+    return matrix
+
+
+def refresh_holdings_snapshot() -> Optional[HoldingsMatrix]:
+    """Export the current holdings to the configured snapshot file, if one
+    is configured
+
+    Returns:
+        the exported holdings, or None if no snapshot is configured
+    """
+    path = get_snapshot_path()
+    if path is None:
+        return None
+    return export_holdings_snapshot(path)
+
+
+_snapshot_lock = threading.Lock()
+_open_snapshot: Optional[Tuple[Tuple[int, int], HoldingsSnapshot]] = None
+
+
+def get_holdings_snapshot() -> Optional[HoldingsSnapshot]:
+    """Return the configured snapshot, opened once per process and reopened
+    after it has been replaced by a new export
+
+    Returns:
+        the snapshot, or None if no snapshot is configured or exported yet
+    """
+    global _open_snapshot
+    path = get_snapshot_path()
+    if path is None:
+        return None
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    identity = (stat.st_ino, stat.st_mtime_ns)
+    with _snapshot_lock:
+        if _open_snapshot is None or _open_snapshot[0] != identity:
+            _open_snapshot = (identity, HoldingsSnapshot(path))
+        return _open_snapshot[1]
+
+
+def load_holdings_matrix(etf_ids: Optional[Iterable[int]] = None) -> HoldingsMatrix:
+    """Return the holdings of all ETFs, or of the given ETFs, from the
+    configured snapshot, falling back to the database when no snapshot is
+    configured or exported yet
+
+    Arguments:
+        etf_ids: the ids of the ETFs to load, defaults to all ETFs
+
+    Returns:
+        a HoldingsMatrix with one row per ETF that has holdings
+    """
+    snapshot = get_holdings_snapshot()
+    if snapshot is None:
+        return HoldingsMatrix.from_database(etf_ids)
+    matrix = snapshot.to_matrix()
+    return matrix if etf_ids is None else matrix.select(etf_ids)
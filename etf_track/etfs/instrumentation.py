@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "etf_track"
+
+_current_run: ContextVar[Optional["ETFRun"]] = ContextVar("etf_run", default=None)
+_DISABLED = nullcontext()
+_EXHAUSTED = object()
+
+
+class ETFRun:
+    """The measurements taken while reading and storing the holdings of a
+    single ETF
+
+    Attributes:
+        etf_id
+        name
+        status
+        stages
+        counters
+
+    Methods:
+        add_time
+        add
+        as_dict
+    """
+
+    def __init__(self, etf_id: int, name: str):
+        """Initialise an ETFRun object
+
+        Arguments:
+            etf_id: the id of the ETF being read
+            name: the name of the ETF being read
+        """
+        self.etf_id = etf_id
+        self.name = name
+        self.status = "pending"
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        """Add time spent in a stage"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add(self, counter: str, value: float) -> None:
+        """Add a value to a counter"""
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "etf_id": self.etf_id,
+            "name": self.name,
+            "status": self.status,
+            "stages": {stage: round(value, 6) for stage, value in self.stages.items()},
+            "counters": self.counters,
+        }
+
+
+class _Stage:
+    """Times the enclosed block and adds the time to a stage of a run"""
+
+    __slots__ = ("_run", "_name", "_start")
+
+    def __init__(self, run: ETFRun, name: str):
+        self._run = run
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._run.add_time(self._name, time.perf_counter() - self._start)
+
+
+def is_enabled() -> bool:
+    """Return whether instrumentation is enabled by the ETF_INSTRUMENTATION
+    setting
+    """
+    config = getattr(settings, "ETF_INSTRUMENTATION", None)
+    return bool(config and config.get("ENABLED"))
+
+
+def start_run(etf_id: int, name: str) -> Optional[ETFRun]:
+    """Start measuring the reading of an ETF
+
+    Returns:
+        an ETFRun object, or None if instrumentation is disabled
+    """
+    return ETFRun(etf_id, name) if is_enabled() else None
+
+
+@contextmanager
+def activate(run: Optional[ETFRun]) -> Iterator[None]:
+    """Record the stages and counters of the enclosed block in a run"""
+    token = _current_run.set(run)
+    try:
+        yield
+    finally:
+        _current_run.reset(token)
+
+
+def bind(run: Optional[ETFRun], function: Callable) -> Callable:
+    """Wrap a function so that it records into a run in whichever thread it
+    is called
+
+    Arguments:
+        run: the run to record into, or None if instrumentation is disabled
+        function: the function to wrap
+
+    Returns:
+        the wrapped function, or the function itself if run is None
+    """
+    if run is None:
+        return function
+
+    def bound(*args, **kwargs):
+        with activate(run):
+            return function(*args, **kwargs)
+
+    return bound
+
+
+def stage(name: str):
+    """Return a context manager that adds the time spent in the enclosed
+    block to a stage of the active run, which does nothing when there is no
+    active run
+    """
+    run = _current_run.get()
+    if run is None:
+        return _DISABLED
+    return _Stage(run, name)
+
+
+def count(counter: str, value: float) -> None:
+    """Add a value to a counter of the active run, if there is one"""
+    run = _current_run.get()
+    if run is not None:
+        run.add(counter, value)
+
+
+def timed(name: str, iterable: Iterable) -> Iterable:
+    """Add the time spent producing each item of an iterable, e.g. the
+    chunks of a lazily parsed file, to a stage of the active run
+    """
+    run = _current_run.get()
+    if run is None:
+        return iterable
+    return _timed(run, name, iter(iterable))
+
+
+def _timed(run: ETFRun, name: str, iterator: Iterator) -> Iterator:
+    while True:
+        with _Stage(run, name):
+            item = next(iterator, _EXHAUSTED)
+        if item is _EXHAUSTED:
+            return
+        yield item
+
+
+@contextmanager
+def count_queries() -> Iterator[None]:
+    """Count the SQL queries executed in the enclosed block, and the time
+    spent executing them, in the sql_queries and sql_seconds counters of the
+    active run
+    """
+    run = _current_run.get()
+    if run is None:
+        yield
+        return
+
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            run.add("sql_queries", 1)
+            run.add("sql_seconds", time.perf_counter() - start)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+
+def finish_run(run: Optional[ETFRun], status: str) -> None:
+    """Record the status of a finished run and emit it as a JSON log line"""
+    if run is None:
+        return
+    run.status = status
+    logger.info(json.dumps(run.as_dict()))
+
+
+def write_metrics(runs: List[Optional[ETFRun]]) -> None:
+    """Write the measurements of a set of runs to the Prometheus text file
+    configured by the ETF_INSTRUMENTATION setting, if any. The file is
+    replaced atomically so that a scraper never reads a partial file.
+
+    Arguments:
+        runs: the runs to write, where None entries are ignored
+    """
+    runs = [run for run in runs if run is not None]
+    path = (getattr(settings, "ETF_INSTRUMENTATION", None) or {}).get("PROMETHEUS_FILE")
+    if not runs or not path:
+        return
+    path = Path(path)
+    temporary_path = path.with_name(path.name + ".tmp")
+    temporary_path.write_text(format_metrics(runs))
+    os.replace(temporary_path, path)
+
+
+def format_metrics(runs: List[ETFRun]) -> str:
+    """Format the measurements of a set of runs in the Prometheus text
+    exposition format
+
+    Returns:
+        one gauge for the time spent in each stage and one gauge per counter,
+        labelled by ETF id
+    """
+    lines = [
+        f"# HELP {METRICS_PREFIX}_stage_seconds Time spent reading an ETF by stage",
+        f"# TYPE {METRICS_PREFIX}_stage_seconds gauge",
+    ]
+    for run in runs:
+        for name, seconds in sorted(run.stages.items()):
+            lines.append(
+                f'{METRICS_PREFIX}_stage_seconds{{etf_id="{run.etf_id}",'
+                f'stage="{name}"}} {seconds:.6f}'
+            )
+    counters = sorted({counter for run in runs for counter in run.counters})
+    for counter in counters:
+        lines.append(f"# TYPE {METRICS_PREFIX}_{counter} gauge")
+        for run in runs:
+            if counter in run.counters:
+                lines.append(
+                    f'{METRICS_PREFIX}_{counter}{{etf_id="{run.etf_id}"}} '
+                    f"{run.counters[counter]}"
+                )
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,19 @@
 from csv import DictReader
+from itertools import islice
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from etfs.models import ETF
 
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple
+
+from .add_etf import ARGS as ETF_ARGS
 
 ARGS = {
     "input_file_path": {"type": str, "required": True},
+    "chunk_size": {"type": int, "required": False},
 }
+DEFAULT_CHUNK_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -18,10 +24,53 @@ class Command(BaseCommand):
             parser.add_argument(
                 "--" + arg, required=ARGS[arg]["required"], type=ARGS[arg]["type"]
             )
+        parser.add_argument(
+            "--" + "bulk",
+            action="store_true",
+            help="Insert new ETFs in bulk, one chunk of rows at a time",
+        )
 
     def handle(self, *args, **options):
         self._input_file_path = options["input_file_path"]
-        self._read_etfs()
+        if options["bulk"]:
+            self._bulk_read_etfs(options["chunk_size"] or DEFAULT_CHUNK_SIZE)
+        else:
+            self._read_etfs()
+
+    def _bulk_read_etfs(self, chunk_size: int):
+        """Stream the input file in chunks of rows. Each chunk is validated
+        against the add_etf arguments and inserted with a single bulk insert
+        that skips ETFs already in the database. ETFs are identified by their
+        issuer and name, which are unique.
+        """
+        created, existing, invalid = 0, 0, []
+        seen: Set[Tuple[str, str]] = set()
+        with open(self._input_file_path, "r", newline="") as input_file:
+            rows = enumerate(DictReader(input_file), start=2)
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                etfs = []
+                for line_number, row in chunk:
+                    identifiers = _validate_row(row)
+                    if identifiers is None:
+                        invalid.append(line_number)
+                        continue
+                    key = (identifiers["etf_issuer"], identifiers["name"])
+                    if key in seen:
+                        existing += 1
+                        continue
+                    seen.add(key)
+                    etfs.append(ETF(**identifiers))
+                inserted = _insert_etfs(etfs)
+                existing += len(etfs) - inserted
+                created += inserted
+        print(
+            f"Created {created} ETFs, skipped {existing} already present,"
+            f" rejected {len(invalid)} invalid rows"
+            + (f" (lines {_format_lines(invalid)})" if invalid else "")
+        )
 
     def _read_etfs(self):
         with open(self._input_file_path, "r") as input_file:
@@ -46,3 +95,61 @@ class Command(BaseCommand):
                 f"Entry for {identifiers['name']} ({identifiers['etf_issuer']})"
                 + " already in DB, no changes made"
             )
+
+
+def _validate_row(row: Dict[str, Optional[str]]) -> Optional[Dict[str, Any]]:
+    """Validate a CSV row against the arguments of the add_etf command
+
+    Arguments:
+        row: a row read by DictReader
+
+    Returns:
+        the identifiers of the ETF converted to their argument types, or None
+        if the row has unknown columns, misses a required value or has a
+        value of the wrong type
+    """
+    if None in row or set(row) - set(ETF_ARGS):
+        return None
+    identifiers = {}
+    for arg, schema in ETF_ARGS.items():
+        value = row.get(arg)
+        if not value:
+            if schema["required"]:
+                return None
+            continue
+        try:
+            identifiers[arg] = schema["type"](value)
+        except ValueError:
+            return None
+    return identifiers
+
+
+def _insert_etfs(etfs: List[ETF]) -> int:
+    """Insert the ETFs whose issuer and name are not in the database yet
+    with a single bulk insert. Conflicting rows are skipped by the database,
+    so the number of inserted rows is the difference of two counts of the
+    ETFs with the issuers and names of the chunk.
+
+    Arguments:
+        etfs: unsaved ETF objects with distinct issuers and names
+
+    Returns:
+        the number of ETFs inserted
+    """
+    if not etfs:
+        return 0
+    matching = ETF.objects.filter(
+        etf_issuer__in={etf.etf_issuer for etf in etfs},
+        name__in={etf.name for etf in etfs},
+    )
+    with transaction.atomic():
+        before = matching.count()
+        ETF.objects.bulk_create(etfs, ignore_conflicts=True)
+        return matching.count() - before
+
+
+def _format_lines(line_numbers: Iterable[int], limit: int = 10) -> str:
+    """Format the first few of a list of line numbers for a summary"""
+    line_numbers = list(line_numbers)
+    formatted = ", ".join(str(number) for number in line_numbers[:limit])
+    return formatted + (", ..." if len(line_numbers) > limit else "")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from etfs.holdings.snapshot import export_holdings_snapshot, get_snapshot_path
+
+
+class Command(BaseCommand):
+    help = "Export the holdings of every ETF to the memory-mapped snapshot file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--" + "path",
+            type=str,
+            default=None,
+            help="The snapshot file to write, defaults to HOLDINGS_SNAPSHOT",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"] or get_snapshot_path()
+        if path is None:
+            raise CommandError("No --path given and HOLDINGS_SNAPSHOT is not set")
+        matrix = export_holdings_snapshot(path)
+        print(
+            f"Exported {len(matrix.data)} holdings of {len(matrix.etf_ids)} ETFs"
+            f" to {path}"
+        )
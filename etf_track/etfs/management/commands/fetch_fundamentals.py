@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from etfs.fundamentals.loader import refresh_fundamentals
+from etfs.fundamentals.reader import FixtureFundamentalsReader, YahooFundamentalsReader
+
+
+ARGS = {
+    "ttl_hours": {"type": float, "default": 24.0},
+    "batch_size": {"type": int, "default": 100},
+    "workers": {"type": int, "default": 4},
+    "rate": {"type": float, "default": 2.0},
+    "fixture": {"type": str, "default": None},
+}
+
+
+class Command(BaseCommand):
+    help = "Fetch the fundamentals of every ticker whose fundamentals are stale"
+
+    def add_arguments(self, parser):
+        for arg in ARGS:
+            parser.add_argument(
+                "--" + arg, type=ARGS[arg]["type"], default=ARGS[arg]["default"]
+            )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["batch_size"] < 1 or options["rate"] <= 0:
+            raise CommandError("--workers, --batch_size and --rate must be positive")
+        if options["fixture"]:
+            reader = FixtureFundamentalsReader.from_file(options["fixture"])
+        else:
+            reader = YahooFundamentalsReader()
+        result = refresh_fundamentals(
+            reader,
+            timedelta(hours=options["ttl_hours"]),
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            rate=options["rate"],
+        )
+        print(f"Updated fundamentals for {result.updated} tickers")
+        if result.failed_tickers:
+            print(f"Failed to fetch {result.failed_tickers} tickers, retried next time")
+        if result.failed_batches:
+            raise CommandError(f"{result.failed_batches} batches failed")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from etfs.holdings.lookthrough import look_through
+
+
+class Command(BaseCommand):
+    help = "Show the aggregated single-stock exposure of a portfolio of ETFs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--" + "etf",
+            action="append",
+            required=True,
+            help=(
+                "An ETF in the portfolio as <etf id>[:<weight>], repeatable. "
+                "Weights are relative and default to 1, i.e. equal weights"
+            ),
+        )
+        parser.add_argument(
+            "--" + "top",
+            type=int,
+            default=20,
+            help="The number of largest exposures to show",
+        )
+
+    def handle(self, *args, **options):
+        portfolio = {}
+        for etf in options["etf"]:
+            etf_id, _, weight = etf.partition(":")
+            try:
+                portfolio[int(etf_id)] = float(weight or 1.0)
+            except ValueError:
+                raise CommandError(f"Invalid portfolio entry: {etf}")
+            if not portfolio[int(etf_id)] >= 0:
+                raise CommandError(f"Invalid portfolio entry: {etf}")
+        total = sum(portfolio.values())
+        if not total > 0:
+            raise CommandError("The portfolio weights must not all be 0")
+        result = look_through(
+            {etf_id: weight / total for etf_id, weight in portfolio.items()}
+        )
+        if result.missing_etf_ids:
+            print(f"No holdings stored for ETFs: {result.missing_etf_ids}")
+        for ticker, percentage in result.exposures.head(options["top"]).itertuples(
+            index=False
+        ):
+            print(f"{ticker}: {percentage:.4f}%")
+        print(f"Look-through P/E: {result.p_e:.2f}")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from etfs.measurements.calculator import measure_all_etfs
+
+
+class Command(BaseCommand):
+    help = "Measure the weighted P/E and EV/EBITDA of every ETF"
+
+    def handle(self, *args, **options):
+        written = measure_all_etfs()
+        print(f"Wrote measurements for {written} ETFs")
@@ -1,6 +1,9 @@
+from typing import List
+
 from django.core.management.base import BaseCommand, CommandError
 from etfs.models import ETF
-from etfs.holdings.loader import read_all_etfs
+from etfs.holdings.loader import ReadOutcome, read_all_etfs, refresh_provider
+from etfs.holdings.snapshot import export_holdings_snapshot, get_snapshot_path
 
 
 class Command(BaseCommand):
@@ -8,11 +11,43 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--" + "etf_issuer", required=True, type=str)
+        parser.add_argument(
+            "--" + "workers",
+            default=1,
+            type=int,
+            help="The number of holdings files to download concurrently",
+        )
+        parser.add_argument(
+            "--" + "force",
+            action="store_true",
+            help="Read every holdings file, even if it is unchanged",
+        )
+        parser.add_argument(
+            "--" + "full_refresh",
+            action="store_true",
+            help="Replace the holdings of every ETF of the issuer in one bulk"
+            " transaction",
+        )
 
     def handle(self, *args, **options):
         etf_issuer = options["etf_issuer"]
         self._validate_etf(etf_issuer)
-        read_all_etfs(etf_issuer)
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        read = refresh_provider if options["full_refresh"] else read_all_etfs
+        outcomes = read(etf_issuer, workers=options["workers"], force=options["force"])
+        self._export_snapshot()
+        self._log_outcomes(outcomes)
+
+    def _export_snapshot(self) -> None:
+        """Export the holdings snapshot, if one is configured and does not
+        exist yet. The loader replaces it whenever holdings are stored.
+        """
+        path = get_snapshot_path()
+        if path is None or path.exists():
+            return
+        matrix = export_holdings_snapshot(path)
+        print(f"Exported {len(matrix.data)} holdings of {len(matrix.etf_ids)} ETFs")
 
     def _validate_etf(self, etf_issuer: str) -> None:
         """Check if the name of an ETF issuer is valid and raise an
@@ -20,3 +55,22 @@ class Command(BaseCommand):
         """
         if not ETF.objects.filter(etf_issuer=etf_issuer).exists():
             raise CommandError("ETF not found in database")
+
+    def _log_outcomes(self, outcomes: List[ReadOutcome]) -> None:
+        """Print the outcome of reading each ETF and raise an exception if
+        any of them failed
+        """
+        failures = 0
+        for outcome in outcomes:
+            if outcome.unchanged:
+                print(f"Holdings for {outcome.name} ({outcome.etf_id}) unchanged")
+            elif outcome.succeeded:
+                print(f"Updated holdings for {outcome.name} ({outcome.etf_id})")
+            else:
+                failures += 1
+                print(
+                    f"Failed to update holdings for {outcome.name}"
+                    f" ({outcome.etf_id}): {outcome.error}"
+                )
+        if failures:
+            raise CommandError(f"{failures} of {len(outcomes)} ETFs failed")
@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from etfs.measurements.series import ROLLUP_PERIODS, rollup_measurements
+
+
+class Command(BaseCommand):
+    help = "Compact old raw measurements into daily or monthly rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--" + "older_than_days", required=True, type=int)
+        parser.add_argument("--" + "period", default="day", choices=ROLLUP_PERIODS)
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options["older_than_days"])
+        rolled_up = rollup_measurements(older_than, options["period"])
+        print(f"Rolled up {rolled_up} measurements into {options['period']} rollups")
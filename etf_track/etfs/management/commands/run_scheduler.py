@@ -0,0 +1,54 @@
+import signal
+import threading
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from etfs.scheduler import FUNDAMENTALS, HOLDINGS, MEASUREMENTS, RefreshScheduler
+
+
+ARGS = {
+    "workers": {"type": int, "default": 4},
+    "holdings_interval_hours": {"type": float, "default": 24.0},
+    "fundamentals_interval_hours": {"type": float, "default": 6.0},
+    "measurement_interval_hours": {"type": float, "default": 24.0},
+    "max_backoff_hours": {"type": float, "default": 6.0},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep holdings, fundamentals and measurements fresh until stopped with"
+        " SIGINT or SIGTERM"
+    )
+
+    def add_arguments(self, parser):
+        for arg in ARGS:
+            parser.add_argument(
+                "--" + arg, type=ARGS[arg]["type"], default=ARGS[arg]["default"]
+            )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        if min(options[arg] for arg in ARGS if arg.endswith("_hours")) <= 0:
+            raise CommandError("Intervals and --max_backoff_hours must be positive")
+        scheduler = RefreshScheduler(
+            workers=options["workers"],
+            intervals={
+                HOLDINGS: timedelta(hours=options["holdings_interval_hours"]),
+                FUNDAMENTALS: timedelta(hours=options["fundamentals_interval_hours"]),
+                MEASUREMENTS: timedelta(hours=options["measurement_interval_hours"]),
+            },
+            max_backoff=timedelta(hours=options["max_backoff_hours"]),
+        )
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            print("Finishing running jobs before shutting down")
+            stop.set()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        print(f"Scheduler started with {options['workers']} workers")
+        scheduler.run(stop)
+        print("Scheduler stopped")
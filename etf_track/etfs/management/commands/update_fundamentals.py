@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from etfs.fundamentals.loader import update_fundamentals
+
+
+class Command(BaseCommand):
+    help = "Reconcile the tickers in the Fundamentals table with the Holdings table"
+
+    def handle(self, *args, **options):
+        removed, added = update_fundamentals()
+        print(f"Removed {removed} unused and added {added} missing tickers")
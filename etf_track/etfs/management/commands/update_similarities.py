@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from etfs.holdings.similarity import update_similarities
+
+
+class Command(BaseCommand):
+    help = "Recompute the similarities of ETFs whose holdings changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--" + "full",
+            action="store_true",
+            help="Recompute the similarities of every ETF",
+        )
+
+    def handle(self, *args, **options):
+        updated = update_similarities(full=options["full"])
+        print(f"Recomputed similarities for {updated} ETFs")
@@ -0,0 +1,95 @@
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from etfs.cache import aggregate_cache
+from etfs.holdings.matrix import HoldingsMatrix
+from etfs.holdings.snapshot import load_holdings_matrix
+from etfs.models import ETF, Fundamentals, Measurement
+from etfs.utils import convert_queryset_to_dataframe
+
+
+def measure_all_etfs(date_time: Optional[datetime] = None) -> int:
+    """Compute the weighted P/E and EV/EBITDA of every ETF with holdings and
+    write one Measurement row per ETF.
+
+    All holdings are loaded into a sparse ETF x ticker weight matrix and both
+    ratios are computed for every ETF at once, as matrix-vector products with
+    the fundamentals of each ticker.
+
+    Arguments:
+        date_time: the time of the measurement, defaults to now
+
+    Returns:
+        the number of Measurement rows written
+    """
+    date_time = date_time or timezone.now()
+    matrix = load_holdings_matrix()
+    fundamentals = _query_fundamentals(matrix)
+    p_e = weighted_harmonic_mean(matrix, fundamentals["p_e"])
+    ev_ebitda = weighted_harmonic_mean(matrix, fundamentals["ev_ebitda"])
+    measurements = [
+        Measurement(
+            etf_id=int(etf_id),
+            date_time=date_time,
+            p_e=_to_optional(etf_p_e),
+            ev_ebidta=_to_optional(etf_ev_ebitda),
+        )
+        for etf_id, etf_p_e, etf_ev_ebitda in zip(matrix.etf_ids, p_e, ev_ebitda)
+        if not (np.isnan(etf_p_e) and np.isnan(etf_ev_ebitda))
+    ]
+    etf_ids = [measurement.etf_id for measurement in measurements]
+    with transaction.atomic():
+        Measurement.objects.bulk_create(measurements)
+        ETF.objects.filter(id__in=etf_ids).update(measurements_updated=timezone.now())
+        transaction.on_commit(lambda: aggregate_cache.invalidate_many(etf_ids))
+    return len(measurements)
+
+
+def weighted_harmonic_mean(matrix: HoldingsMatrix, ratios: np.ndarray) -> np.ndarray:
+    """Compute the holdings-weighted harmonic mean of a per-ticker ratio for
+    every ETF in a holdings matrix. Holdings with a missing or non-positive
+    ratio (e.g. negative earnings) are excluded from both the numerator and
+    the denominator.
+
+    Arguments:
+        matrix: the holdings weights
+        ratios: the ratio of each ticker in the matrix
+
+    Returns:
+        the weighted harmonic mean for each ETF, NaN where no holding has a
+        usable ratio
+    """
+    usable = np.isfinite(ratios) & (ratios > 0)
+    covered_weight = matrix.dot(usable.astype(np.float64))
+    inverse_weight = matrix.dot(
+        np.divide(1.0, ratios, out=np.zeros_like(ratios), where=usable)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(inverse_weight > 0, covered_weight / inverse_weight, np.nan)
+
+
+def _query_fundamentals(matrix: HoldingsMatrix) -> "dict[str, np.ndarray]":
+    """Query the ratios of the tickers in a holdings matrix, aligned with its
+    columns
+
+    Returns:
+        a dictionary mapping p_e and ev_ebitda to arrays with one value per
+        ticker, NaN where the ticker has no fundamentals
+    """
+    fundamentals = convert_queryset_to_dataframe(
+        Fundamentals.objects.all(), fields=["ticker", "p_e", "ev_ebitda"]
+    ).set_index("ticker_id")
+    fundamentals = fundamentals.reindex(matrix.ticker_ids)
+    return {
+        column: fundamentals[column].to_numpy(dtype=np.float64)
+        for column in ["p_e", "ev_ebitda"]
+    }
+
+
+def _to_optional(value: float) -> Optional[float]:
+    """Convert NaN to None for writing to a nullable column"""
+    return None if np.isnan(value) else float(value)
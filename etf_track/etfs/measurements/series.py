@@ -0,0 +1,263 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable
+
+import numpy as np
+from django.db import transaction
+from django.db.models import (
+    Aggregate,
+    Count,
+    Exists,
+    Max,
+    Min,
+    OuterRef,
+    QuerySet,
+    Sum,
+)
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from pandas import DataFrame, Timestamp, concat, to_datetime
+
+from etfs.models import ETF, Measurement, MeasurementRollup
+from etfs.utils import convert_queryset_to_dataframe
+
+BUCKETS = ["day", "week", "month"]
+METRICS = ["p_e", "ev_ebidta"]
+
+# the rollup periods that can be re-bucketed exactly into each bucket size
+COMPATIBLE_PERIODS = {
+    "day": ["day"],
+    "week": ["day", "week"],
+    "month": ["day", "month"],
+}
+
+# the periods raw measurements can be rolled up into. Weekly rollups are not
+# offered: weeks straddle months and cannot be split into days, so their
+# measurements would vanish from daily and monthly series
+ROLLUP_PERIODS = ["day", "month"]
+
+ROLLUP_FIELDS = ["samples", "last_time"] + [
+    f"{metric}_{statistic}"
+    for metric in METRICS
+    for statistic in ["sum", "count", "min", "max", "last"]
+]
+
+
+def measurement_series(
+    etf_ids: Iterable[int], start: datetime, end: datetime, bucket: str = "day"
+) -> DataFrame:
+    """Query the measurements of ETFs in the range [start, end), bucketed
+    into days, weeks or months.
+
+    The bucketing and aggregation happen in SQL, over both the raw
+    measurements and the rollups that replaced older raw measurements, and
+    only one row per ETF and bucket is returned.
+
+    Arguments:
+        etf_ids: the ids of the ETFs to query
+        start: the start of the range, inclusive
+        end: the end of the range, exclusive
+        bucket: one of day, week or month
+
+    Returns:
+        a DataFrame with one row per ETF and bucket, sorted by etf_id and
+        bucket, with the columns etf_id, bucket, samples and the mean, min,
+        max and last value of p_e and ev_ebidta
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    etf_ids = list(etf_ids)
+    raw = _aggregate_raw(
+        Measurement.objects.filter(
+            etf_id__in=etf_ids, date_time__gte=start, date_time__lt=end
+        ),
+        bucket,
+    )
+    rollups = _aggregate_rollups(
+        MeasurementRollup.objects.filter(
+            etf_id__in=etf_ids,
+            period__in=COMPATIBLE_PERIODS[bucket],
+            bucket_start__gte=start,
+            bucket_start__lt=end,
+        ),
+        bucket,
+    )
+    series = _combine(concat([raw, rollups], ignore_index=True))
+    for metric in METRICS:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            series[f"{metric}_mean"] = (
+                series[f"{metric}_sum"] / series[f"{metric}_count"]
+            )
+    columns = ["etf_id", "bucket", "samples"] + [
+        f"{metric}_{statistic}"
+        for metric in METRICS
+        for statistic in ["mean", "min", "max", "last"]
+    ]
+    return series[columns].sort_values(["etf_id", "bucket"], ignore_index=True)
+
+
+def rollup_measurements(older_than: datetime, period: str = "day") -> int:
+    """Replace the raw measurements before the start of the period
+    containing ``older_than`` with one MeasurementRollup row per ETF and
+    period. Existing rollups of the same buckets are merged, so the
+    rollup can be run repeatedly. Daily rollups serve every series; monthly
+    rollups only serve monthly series.
+
+    Arguments:
+        older_than: the time before which measurements are rolled up
+        period: one of day or month
+
+    Returns:
+        the number of raw measurements rolled up
+    """
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"period must be one of {', '.join(ROLLUP_PERIODS)}")
+    cutoff = truncate(older_than, period)
+    with transaction.atomic():
+        raw_measurements = Measurement.objects.filter(date_time__lt=cutoff)
+        raw = _aggregate_raw(raw_measurements, period)
+        if raw.empty:
+            return 0
+        existing = _aggregate_rollups(
+            MeasurementRollup.objects.filter(
+                period=period,
+                bucket_start__gte=raw["bucket"].min().to_pydatetime(),
+                bucket_start__lt=cutoff,
+            ),
+            period,
+        ).merge(raw[["etf_id", "bucket"]], on=["etf_id", "bucket"])
+        rollups = _combine(concat([raw, existing], ignore_index=True))
+        MeasurementRollup.objects.bulk_create(
+            [
+                MeasurementRollup(
+                    etf_id=_to_model_value(row["etf_id"]),
+                    period=period,
+                    bucket_start=_to_model_value(row["bucket"]),
+                    **{field: _to_model_value(row[field]) for field in ROLLUP_FIELDS},
+                )
+                for row in rollups.to_dict("records")
+            ],
+            update_conflicts=True,
+            unique_fields=["etf", "bucket_start", "period"],
+            update_fields=ROLLUP_FIELDS,
+        )
+        rolled_up, _ = raw_measurements.delete()
+        ETF.objects.filter(id__in=raw["etf_id"].unique().tolist()).update(
+            measurements_updated=timezone.now()
+        )
+    return rolled_up
+
+
+def truncate(date_time: datetime, period: str) -> datetime:
+    """Return the start of the day, week (Monday) or month containing a
+    point in time
+    """
+    start = date_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        return start - timedelta(days=start.weekday())
+    if period == "month":
+        return start.replace(day=1)
+    return start
+
+
+def _aggregate_raw(measurements: QuerySet, bucket: str) -> DataFrame:
+    """Aggregate raw measurements per ETF and bucket in SQL, then fetch the
+    last value of each bucket with one more query
+    """
+    aggregates = {"samples": Count("id"), "last_time": Max("date_time")}
+    for metric in METRICS:
+        aggregates[f"{metric}_sum"] = Sum(metric)
+        aggregates[f"{metric}_count"] = Count(metric)
+        aggregates[f"{metric}_min"] = Min(metric)
+        aggregates[f"{metric}_max"] = Max(metric)
+    buckets = _aggregate(
+        measurements.annotate(bucket=Trunc("date_time", bucket)), aggregates
+    )
+    last_values = convert_queryset_to_dataframe(
+        _last_of_bucket(measurements, "date_time", "date_time", bucket),
+        fields=["etf", "date_time", *METRICS],
+    ).rename(columns={"date_time": "last_time", **{m: f"{m}_last" for m in METRICS}})
+    last_values = last_values.drop_duplicates(["etf_id", "last_time"], keep="last")
+    return buckets.merge(last_values, on=["etf_id", "last_time"], how="left")
+
+
+def _aggregate_rollups(rollups: QuerySet, bucket: str) -> DataFrame:
+    """Re-aggregate rollups per ETF and bucket in SQL, then fetch the last
+    value of each bucket with one more query
+    """
+    aggregates = {"samples": Sum("samples"), "last_time": Max("last_time")}
+    for metric in METRICS:
+        aggregates[f"{metric}_sum"] = Sum(f"{metric}_sum")
+        aggregates[f"{metric}_count"] = Sum(f"{metric}_count")
+        aggregates[f"{metric}_min"] = Min(f"{metric}_min")
+        aggregates[f"{metric}_max"] = Max(f"{metric}_max")
+    buckets = _aggregate(
+        rollups.annotate(bucket=Trunc("bucket_start", bucket)), aggregates
+    )
+    last_values = convert_queryset_to_dataframe(
+        _last_of_bucket(rollups, "bucket_start", "last_time", bucket),
+        fields=["etf", "last_time", *[f"{metric}_last" for metric in METRICS]],
+    ).drop_duplicates(["etf_id", "last_time"], keep="last")
+    return buckets.merge(last_values, on=["etf_id", "last_time"], how="left")
+
+
+def _last_of_bucket(
+    queryset: QuerySet, bucket_field: str, time_field: str, bucket: str
+) -> QuerySet:
+    """Filter a queryset down to the latest rows of each ETF and bucket,
+    i.e. the rows without a later row of the same ETF and bucket
+    """
+    later = queryset.annotate(later_bucket=Trunc(bucket_field, bucket)).filter(
+        etf_id=OuterRef("etf_id"),
+        later_bucket=OuterRef("bucket"),
+        **{f"{time_field}__gt": OuterRef(time_field)},
+    )
+    return queryset.annotate(bucket=Trunc(bucket_field, bucket)).filter(~Exists(later))
+
+
+def _aggregate(queryset: QuerySet, aggregates: Dict[str, Aggregate]) -> DataFrame:
+    """Group a queryset annotated with a bucket by ETF and bucket and
+    compute aggregates in SQL
+    """
+    rows = list(
+        queryset.order_by()
+        .values("etf_id", "bucket")
+        .annotate(**aggregates)
+        .values_list("etf_id", "bucket", *aggregates)
+    )
+    frame = DataFrame.from_records(rows, columns=["etf_id", "bucket", *aggregates])
+    for column in ["bucket", "last_time"]:
+        frame[column] = to_datetime(frame[column], utc=True)
+    return frame
+
+
+def _combine(partials: DataFrame) -> DataFrame:
+    """Combine partial aggregates of the same ETF and bucket, taking the
+    last values from the partial with the latest last_time
+    """
+    keys = ["etf_id", "bucket"]
+    partials = partials.sort_values("last_time", kind="stable")
+    grouped = partials.groupby(keys, sort=False)
+    aggregations = {"samples": "sum"}
+    for metric in METRICS:
+        aggregations[f"{metric}_sum"] = "sum"
+        aggregations[f"{metric}_count"] = "sum"
+        aggregations[f"{metric}_min"] = "min"
+        aggregations[f"{metric}_max"] = "max"
+    combined = grouped[list(aggregations)].agg(aggregations)
+    last_columns = ["last_time"] + [f"{metric}_last" for metric in METRICS]
+    latest = grouped.tail(1).set_index(keys)[last_columns]
+    combined = combined.join(latest).reset_index()
+    return combined.astype(
+        {"samples": "int64", **{f"{metric}_count": "int64" for metric in METRICS}}
+    )
+
+
+def _to_model_value(value: Any) -> Any:
+    """Convert a value from a DataFrame record for saving to a model field"""
+    if isinstance(value, Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
@@ -0,0 +1,92 @@
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def remove_orphan_and_duplicate_rows(apps, schema_editor):
+    """Remove rows that would violate the new foreign keys and unique
+    constraints: rows referencing missing ETFs, and all but the most recent
+    row for each duplicated (etf_id, ticker) holding or fundamentals ticker.
+    """
+    ETF = apps.get_model("etfs", "ETF")
+    Holdings = apps.get_model("etfs", "Holdings")
+    Fundamentals = apps.get_model("etfs", "Fundamentals")
+    Measurement = apps.get_model("etfs", "Measurement")
+
+    etf_ids = ETF.objects.values("id")
+    Holdings.objects.exclude(etf_id__in=etf_ids).delete()
+    Measurement.objects.exclude(etf_id__in=etf_ids).delete()
+
+    latest_holdings = Holdings.objects.values("etf_id", "ticker").annotate(
+        latest_id=Max("id")
+    )
+    Holdings.objects.exclude(id__in=latest_holdings.values("latest_id")).delete()
+    latest_fundamentals = Fundamentals.objects.values("ticker").annotate(
+        latest_id=Max("id")
+    )
+    Fundamentals.objects.exclude(
+        id__in=latest_fundamentals.values("latest_id")
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0004_fundamentals"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_orphan_and_duplicate_rows, migrations.RunPython.noop
+        ),
+        migrations.RenameField(
+            model_name="holdings",
+            old_name="etf_id",
+            new_name="etf",
+        ),
+        migrations.AlterField(
+            model_name="holdings",
+            name="etf",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="etfs.etf",
+            ),
+        ),
+        migrations.RenameField(
+            model_name="measurement",
+            old_name="etf_id",
+            new_name="etf",
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="etf",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="etfs.etf",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="holdings",
+            name="ticker",
+            field=models.CharField(db_index=True, max_length=14),
+        ),
+        migrations.AlterField(
+            model_name="fundamentals",
+            name="ticker",
+            field=models.CharField(max_length=14, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name="holdings",
+            constraint=models.UniqueConstraint(
+                fields=("etf", "ticker"), name="holdings_etf_ticker_unique"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="measurement",
+            index=models.Index(
+                fields=["etf", "date_time"], name="measurement_etf_date_time"
+            ),
+        ),
+    ]
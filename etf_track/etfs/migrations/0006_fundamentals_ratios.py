@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+def mark_unfetched_fundamentals(apps, schema_editor):
+    """Clear last_updated on rows that were created but never fetched, so
+    that they are picked up by the next fundamentals refresh
+    """
+    Fundamentals = apps.get_model("etfs", "Fundamentals")
+    Fundamentals.objects.filter(eps__isnull=True).update(last_updated=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0005_etf_foreign_keys_and_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="fundamentals",
+            name="last_updated",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="fundamentals",
+            name="p_e",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="fundamentals",
+            name="ev_ebitda",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_unfetched_fundamentals, migrations.RunPython.noop),
+    ]
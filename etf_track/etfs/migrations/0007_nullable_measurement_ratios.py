@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0006_fundamentals_ratios"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="measurement",
+            name="p_e",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="ev_ebidta",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0007_nullable_measurement_ratios"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etf",
+            name="holdings_updated",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.1.13 on 2026-10-17 07:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0008_etf_holdings_updated"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MeasurementRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("day", "Day"), ("week", "Week"), ("month", "Month")],
+                        max_length=5,
+                    ),
+                ),
+                ("bucket_start", models.DateTimeField()),
+                ("samples", models.PositiveIntegerField()),
+                ("last_time", models.DateTimeField()),
+                ("p_e_sum", models.FloatField(blank=True, null=True)),
+                ("p_e_count", models.PositiveIntegerField()),
+                ("p_e_min", models.FloatField(blank=True, null=True)),
+                ("p_e_max", models.FloatField(blank=True, null=True)),
+                ("p_e_last", models.FloatField(blank=True, null=True)),
+                ("ev_ebidta_sum", models.FloatField(blank=True, null=True)),
+                ("ev_ebidta_count", models.PositiveIntegerField()),
+                ("ev_ebidta_min", models.FloatField(blank=True, null=True)),
+                ("ev_ebidta_max", models.FloatField(blank=True, null=True)),
+                ("ev_ebidta_last", models.FloatField(blank=True, null=True)),
+                (
+                    "etf",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="etfs.etf",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="measurementrollup",
+            constraint=models.UniqueConstraint(
+                fields=("etf", "bucket_start", "period"),
+                name="measurement_rollup_etf_bucket_period_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.1.13 on 2026-10-17 07:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0009_measurement_rollup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etf",
+            name="similarity_updated",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="ETFSimilarity",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("overlap", models.FloatField()),
+                ("cosine", models.FloatField()),
+                (
+                    "etf",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="etfs.etf",
+                    ),
+                ),
+                (
+                    "other",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="etfs.etf",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="etfsimilarity",
+            index=models.Index(
+                fields=["etf", "-overlap"], name="etf_similarity_overlap"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="etfsimilarity",
+            index=models.Index(fields=["etf", "-cosine"], name="etf_similarity_cosine"),
+        ),
+        migrations.AddConstraint(
+            model_name="etfsimilarity",
+            constraint=models.UniqueConstraint(
+                fields=("etf", "other"), name="etf_similarity_etf_other_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.1.13 on 2026-10-17 07:43
+
+from itertools import groupby
+
+from django.db import migrations, models
+
+
+def build_ticker_exposures(apps, schema_editor):
+    """Build the reverse index from the existing holdings"""
+    Holdings = apps.get_model("etfs", "Holdings")
+    TickerExposure = apps.get_model("etfs", "TickerExposure")
+    holdings = (
+        Holdings.objects.order_by("ticker")
+        .values_list("ticker", "etf_id", "percentage")
+        .iterator(chunk_size=10000)
+    )
+    exposures = []
+    for ticker, rows in groupby(holdings, key=lambda row: row[0]):
+        holders = {str(etf_id): percentage for _, etf_id, percentage in rows}
+        exposures.append(
+            TickerExposure(
+                ticker=ticker,
+                holders=holders,
+                etf_count=len(holders),
+                total_percentage=sum(holders.values()),
+            )
+        )
+        if len(exposures) == 1000:
+            TickerExposure.objects.bulk_create(exposures)
+            exposures = []
+    TickerExposure.objects.bulk_create(exposures)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0010_etf_similarity"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TickerExposure",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("ticker", models.CharField(max_length=14, unique=True)),
+                ("holders", models.JSONField(default=dict)),
+                ("etf_count", models.PositiveIntegerField(default=0)),
+                ("total_percentage", models.FloatField(default=0.0)),
+            ],
+        ),
+        migrations.RunPython(build_ticker_exposures, migrations.RunPython.noop),
+    ]
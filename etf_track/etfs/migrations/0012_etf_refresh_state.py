@@ -0,0 +1,28 @@
+# Generated by Django 4.1.13 on 2026-10-17 07:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0011_ticker_exposure"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etf",
+            name="holdings_checked",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="etf",
+            name="next_refresh",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="etf",
+            name="refresh_failures",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
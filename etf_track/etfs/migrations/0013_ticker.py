@@ -0,0 +1,144 @@
+# Generated by Django 4.1.13 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_tickers(apps, schema_editor):
+    """Create a Ticker for every symbol in the holdings and fundamentals and
+    point the existing rows at it
+    """
+    Fundamentals = apps.get_model("etfs", "Fundamentals")
+    Holdings = apps.get_model("etfs", "Holdings")
+    Ticker = apps.get_model("etfs", "Ticker")
+    symbols = set(Holdings.objects.values_list("symbol", flat=True).distinct())
+    symbols.update(Fundamentals.objects.values_list("symbol", flat=True))
+    Ticker.objects.bulk_create(
+        (Ticker(symbol=symbol) for symbol in sorted(symbols)), batch_size=1000
+    )
+    for model in (Holdings, Fundamentals):
+        model.objects.update(
+            ticker=models.Subquery(
+                Ticker.objects.filter(symbol=models.OuterRef("symbol")).values("id")
+            )
+        )
+
+
+def restore_symbols(apps, schema_editor):
+    """Copy the symbols of the Ticker rows back into the old columns"""
+    Fundamentals = apps.get_model("etfs", "Fundamentals")
+    Holdings = apps.get_model("etfs", "Holdings")
+    Ticker = apps.get_model("etfs", "Ticker")
+    for model in (Holdings, Fundamentals):
+        model.objects.update(
+            symbol=models.Subquery(
+                Ticker.objects.filter(id=models.OuterRef("ticker")).values("symbol")
+            )
+        )
+
+
+class Migration(migrations.Migration):
+    # The backfill updates the new deferrable foreign keys of tables that are
+    # altered afterwards, which PostgreSQL refuses inside one transaction
+    # ("pending trigger events"). Schema changes therefore commit one by one
+    # and each data step runs in a transaction of its own.
+    atomic = False
+
+    dependencies = [
+        ("etfs", "0012_etf_refresh_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Ticker",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("symbol", models.CharField(max_length=14, unique=True)),
+                ("exchange", models.CharField(blank=True, max_length=255, null=True)),
+                ("sector", models.CharField(blank=True, max_length=255, null=True)),
+                ("location", models.CharField(blank=True, max_length=255, null=True)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name="holdings",
+            name="holdings_etf_ticker_unique",
+        ),
+        migrations.RenameField(
+            model_name="holdings",
+            old_name="ticker",
+            new_name="symbol",
+        ),
+        migrations.RenameField(
+            model_name="fundamentals",
+            old_name="ticker",
+            new_name="symbol",
+        ),
+        migrations.AddField(
+            model_name="holdings",
+            name="ticker",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                to="etfs.ticker",
+            ),
+        ),
+        migrations.AddField(
+            model_name="fundamentals",
+            name="ticker",
+            field=models.OneToOneField(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="etfs.ticker",
+            ),
+        ),
+        migrations.RunPython(backfill_tickers, migrations.RunPython.noop, atomic=True),
+        migrations.AlterField(
+            model_name="holdings",
+            name="ticker",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT, to="etfs.ticker"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="fundamentals",
+            name="ticker",
+            field=models.OneToOneField(
+                on_delete=django.db.models.deletion.CASCADE, to="etfs.ticker"
+            ),
+        ),
+        # the symbols are made nullable before they are removed, so that
+        # reversing the migration can add them back before restoring them
+        migrations.AlterField(
+            model_name="holdings",
+            name="symbol",
+            field=models.CharField(db_index=True, max_length=14, null=True),
+        ),
+        migrations.AlterField(
+            model_name="fundamentals",
+            name="symbol",
+            field=models.CharField(max_length=14, null=True, unique=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore_symbols, atomic=True),
+        migrations.RemoveField(
+            model_name="holdings",
+            name="symbol",
+        ),
+        migrations.RemoveField(
+            model_name="fundamentals",
+            name="symbol",
+        ),
+        migrations.AddConstraint(
+            model_name="holdings",
+            constraint=models.UniqueConstraint(
+                fields=("etf", "ticker"), name="holdings_etf_ticker_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.13 on 2026-10-17 08:28
+
+from django.db import migrations, models
+
+
+def backfill_measurements_updated(apps, schema_editor):
+    """Set the measurement update time of every ETF to the time of its
+    latest raw measurement
+    """
+    ETF = apps.get_model("etfs", "ETF")
+    Measurement = apps.get_model("etfs", "Measurement")
+    ETF.objects.update(
+        measurements_updated=models.Subquery(
+            Measurement.objects.filter(etf=models.OuterRef("id"))
+            .order_by("-date_time")
+            .values("date_time")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("etfs", "0013_ticker"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etf",
+            name="measurements_updated",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="etf",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_measurements_updated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.1.13 on 2026-10-17 14:05
+
+from itertools import groupby
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def clear_ticker_exposures(apps, schema_editor):
+    """Empty the reverse index, which is rebuilt from the holdings"""
+    TickerExposure = apps.get_model("etfs", "TickerExposure")
+    TickerExposure.objects.all().delete()
+
+
+def build_ticker_exposures(apps, schema_editor, key="ticker_id"):
+    """Build the reverse index from the existing holdings"""
+    Holdings = apps.get_model("etfs", "Holdings")
+    TickerExposure = apps.get_model("etfs", "TickerExposure")
+    field = {"ticker_id": "ticker_id", "ticker": "ticker__symbol"}[key]
+    holdings = (
+        Holdings.objects.order_by(field)
+        .values_list(field, "etf_id", "percentage")
+        .iterator(chunk_size=10000)
+    )
+    exposures = []
+    for ticker, rows in groupby(holdings, key=lambda row: row[0]):
+        holders = {str(etf_id): percentage for _, etf_id, percentage in rows}
+        exposures.append(
+            TickerExposure(
+                holders=holders,
+                etf_count=len(holders),
+                total_percentage=sum(holders.values()),
+                **{key: ticker},
+            )
+        )
+        if len(exposures) == 1000:
+            TickerExposure.objects.bulk_create(exposures)
+            exposures = []
+    TickerExposure.objects.bulk_create(exposures)
+
+
+def build_symbol_exposures(apps, schema_editor):
+    """Build the reverse index keyed by symbol, when reversing"""
+    build_ticker_exposures(apps, schema_editor, key="ticker")
+
+
+class Migration(migrations.Migration):
+    # Like 0013, schema changes commit one by one and each data step runs in
+    # a transaction of its own, so that PostgreSQL does not refuse to alter
+    # the table while foreign key checks of the rebuilt rows are pending
+    atomic = False
+
+    dependencies = [
+        ("etfs", "0014_etf_update_times"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            clear_ticker_exposures, build_symbol_exposures, atomic=True
+        ),
+        migrations.RemoveField(
+            model_name="tickerexposure",
+            name="ticker",
+        ),
+        # the index is empty here, so the column needs no default
+        migrations.AddField(
+            model_name="tickerexposure",
+            name="ticker",
+            field=models.OneToOneField(
+                on_delete=django.db.models.deletion.CASCADE, to="etfs.ticker"
+            ),
+        ),
+        migrations.RunPython(
+            build_ticker_exposures, clear_ticker_exposures, atomic=True
+        ),
+    ]
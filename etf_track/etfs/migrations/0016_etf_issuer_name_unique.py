@@ -0,0 +1,62 @@
+# Generated by Django 4.1.13 on 2026-10-17 08:51
+
+from django.db import migrations, models
+
+
+def remove_duplicate_etfs(apps, schema_editor):
+    """Keep the oldest ETF of each issuer and name and delete the others,
+    together with their holdings, measurements and similarities, and remove
+    the deleted ETFs from the reverse ticker index
+    """
+    ETF = apps.get_model("etfs", "ETF")
+    TickerExposure = apps.get_model("etfs", "TickerExposure")
+    duplicates = (
+        ETF.objects.values("etf_issuer", "name")
+        .annotate(keep=models.Min("id"), count=models.Count("id"))
+        .filter(count__gt=1)
+    )
+    removed = []
+    for duplicate in duplicates:
+        removed.extend(
+            ETF.objects.filter(
+                etf_issuer=duplicate["etf_issuer"], name=duplicate["name"]
+            )
+            .exclude(id=duplicate["keep"])
+            .values_list("id", flat=True)
+        )
+    if not removed:
+        return
+    ETF.objects.filter(id__in=removed).delete()
+    keys = [str(etf_id) for etf_id in removed]
+    for exposure in TickerExposure.objects.filter(holders__has_any_keys=keys):
+        for key in keys:
+            exposure.holders.pop(key, None)
+        if exposure.holders:
+            exposure.etf_count = len(exposure.holders)
+            exposure.total_percentage = sum(exposure.holders.values())
+            exposure.save()
+        else:
+            exposure.delete()
+
+
+class Migration(migrations.Migration):
+    # The deletes leave deferred foreign key checks pending, and PostgreSQL
+    # refuses to alter a table with pending trigger events in the same
+    # transaction, so the duplicates are removed in a transaction of their own
+    atomic = False
+
+    dependencies = [
+        ("etfs", "0015_ticker_exposure_ticker"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_etfs, migrations.RunPython.noop, atomic=True
+        ),
+        migrations.AddConstraint(
+            model_name="etf",
+            constraint=models.UniqueConstraint(
+                fields=("etf_issuer", "name"), name="etf_issuer_name_unique"
+            ),
+        ),
+    ]
@@ -8,22 +8,140 @@ class ETF(models.Model):
     holdings_url = models.CharField(max_length=255)
     sector = models.CharField(max_length=255, null=True, blank=True)
     expense_ratio = models.FloatField(null=True, blank=True)
+    # the time the holdings of the ETF last changed
+    holdings_updated = models.DateTimeField(null=True, blank=True)
+    # the time the measurements of the ETF were last written or rolled up
+    measurements_updated = models.DateTimeField(null=True, blank=True)
+    # the time the ETF row itself was last saved, e.g. after a rename
+    updated_at = models.DateTimeField(auto_now=True)
+    # the time the similarities of the ETF were last computed
+    similarity_updated = models.DateTimeField(null=True, blank=True)
+    # the refresh state of the ETF's holdings, see etfs.scheduler
+    holdings_checked = models.DateTimeField(null=True, blank=True)
+    next_refresh = models.DateTimeField(null=True, blank=True)
+    refresh_failures = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["etf_issuer", "name"], name="etf_issuer_name_unique"
+            ),
+        ]
 
 
 class Measurement(models.Model):
-    etf_id = models.PositiveIntegerField()
+    # the (etf, date_time) index also serves lookups by etf alone
+    etf = models.ForeignKey(ETF, on_delete=models.CASCADE, db_index=False)
     date_time = models.DateTimeField()
-    p_e = models.FloatField()
-    ev_ebidta = models.FloatField()
+    # None when none of the ETF's holdings have a usable ratio
+    p_e = models.FloatField(null=True, blank=True)
+    ev_ebidta = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["etf", "date_time"], name="measurement_etf_date_time"),
+        ]
+
+
+class MeasurementRollup(models.Model):
+    """Measurements of an ETF aggregated over a day, week or month, which
+    replace the raw Measurement rows once they are old enough
+    """
+
+    PERIODS = [("day", "Day"), ("week", "Week"), ("month", "Month")]
+
+    etf = models.ForeignKey(ETF, on_delete=models.CASCADE, db_index=False)
+    period = models.CharField(max_length=5, choices=PERIODS)
+    bucket_start = models.DateTimeField()
+    samples = models.PositiveIntegerField()
+    last_time = models.DateTimeField()
+    p_e_sum = models.FloatField(null=True, blank=True)
+    p_e_count = models.PositiveIntegerField()
+    p_e_min = models.FloatField(null=True, blank=True)
+    p_e_max = models.FloatField(null=True, blank=True)
+    p_e_last = models.FloatField(null=True, blank=True)
+    ev_ebidta_sum = models.FloatField(null=True, blank=True)
+    ev_ebidta_count = models.PositiveIntegerField()
+    ev_ebidta_min = models.FloatField(null=True, blank=True)
+    ev_ebidta_max = models.FloatField(null=True, blank=True)
+    ev_ebidta_last = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["etf", "bucket_start", "period"],
+                name="measurement_rollup_etf_bucket_period_unique",
+            ),
+        ]
+
+
+class Ticker(models.Model):
+    """A security held by ETFs, referenced by holdings and fundamentals
+    through its integer key instead of its symbol
+    """
+
+    symbol = models.CharField(max_length=14, unique=True)
+    exchange = models.CharField(max_length=255, null=True, blank=True)
+    sector = models.CharField(max_length=255, null=True, blank=True)
+    location = models.CharField(max_length=255, null=True, blank=True)
 
 
 class Holdings(models.Model):
-    etf_id = models.PositiveBigIntegerField()
-    ticker = models.CharField(max_length=14)
+    # the unique (etf, ticker) index also serves lookups by etf alone
+    etf = models.ForeignKey(ETF, on_delete=models.CASCADE, db_index=False)
+    ticker = models.ForeignKey(Ticker, on_delete=models.PROTECT)
     percentage = models.FloatField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["etf", "ticker"], name="holdings_etf_ticker_unique"
+            ),
+        ]
+
+
+class TickerExposure(models.Model):
+    """A reverse index from a ticker to the ETFs holding it, maintained by
+    the holdings loader
+    """
+
+    ticker = models.OneToOneField(Ticker, on_delete=models.CASCADE)
+    # a mapping from the id of each ETF holding the ticker, as a string, to
+    # its percentage weight in that ETF
+    holders = models.JSONField(default=dict)
+    etf_count = models.PositiveIntegerField(default=0)
+    total_percentage = models.FloatField(default=0.0)
+
 
 class Fundamentals(models.Model):
-    ticker = models.CharField(max_length=14)
-    last_updated = models.DateTimeField(auto_now=True, null=True, blank=True)
+    ticker = models.OneToOneField(Ticker, on_delete=models.CASCADE)
+    # the time the fundamentals were last fetched, None if never fetched
+    last_updated = models.DateTimeField(null=True, blank=True)
     eps = models.FloatField(null=True, blank=True)
+    p_e = models.FloatField(null=True, blank=True)
+    ev_ebitda = models.FloatField(null=True, blank=True)
+
+
+class ETFSimilarity(models.Model):
+    """The similarity of the holdings of one ETF to those of another. Every
+    pair of ETFs with at least one common holding is stored in both
+    directions, so the most similar ETFs to an ETF are an index range scan.
+    """
+
+    etf = models.ForeignKey(ETF, on_delete=models.CASCADE, db_index=False)
+    other = models.ForeignKey(ETF, on_delete=models.CASCADE, related_name="+")
+    # the sum over common holdings of the smaller percentage weight
+    overlap = models.FloatField()
+    # the cosine similarity of the percentage weight vectors
+    cosine = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["etf", "other"], name="etf_similarity_etf_other_unique"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["etf", "-overlap"], name="etf_similarity_overlap"),
+            models.Index(fields=["etf", "-cosine"], name="etf_similarity_cosine"),
+        ]
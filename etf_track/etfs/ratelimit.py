@@ -0,0 +1,55 @@
+import threading
+import time
+from typing import Callable
+
+
+class TokenBucket:
+    """A thread-safe token bucket rate limiter. Tokens are added at ``rate``
+    per second up to ``capacity``, and each call to ``acquire`` takes one
+    token, blocking until one is available.
+
+    Attributes:
+        rate
+        capacity
+
+    Methods:
+        acquire
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """Initialise a TokenBucket object, starting with a full bucket
+
+        Arguments:
+            rate: the number of tokens added per second
+            capacity: the maximum number of tokens in the bucket
+            clock: a monotonic clock returning seconds
+            sleep: the function used to wait for tokens
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token from the bucket, waiting until one is available"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
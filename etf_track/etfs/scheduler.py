@@ -0,0 +1,289 @@
+import heapq
+import logging
+import threading
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from etfs.models import ETF
+
+logger = logging.getLogger(__name__)
+
+HOLDINGS = "holdings"
+FUNDAMENTALS = "fundamentals"
+MEASUREMENTS = "measurements"
+CATALOGUE = "catalogue"
+
+DEFAULT_INTERVALS = {
+    HOLDINGS: timedelta(hours=24),
+    FUNDAMENTALS: timedelta(hours=6),
+    MEASUREMENTS: timedelta(hours=24),
+    CATALOGUE: timedelta(minutes=5),
+}
+# the first retry after a failure, doubled after every further failure
+RETRY_DELAY = timedelta(minutes=5)
+# ETFs that have never been refreshed are spread over this period
+INITIAL_SPREAD = timedelta(hours=1)
+# the longest the run loop sleeps before checking for a shutdown request
+POLL_SECONDS = 5.0
+
+
+class ScheduledJob(NamedTuple):
+    """A unit of work in the scheduler's priority queue, ordered by due time
+    and then by the order it was scheduled in
+    """
+
+    due: datetime
+    sequence: int
+    kind: str
+    etf_id: Optional[int] = None
+
+
+def _refresh_holdings(job: ScheduledJob) -> None:
+    from etfs.holdings.loader import refresh_etf
+
+    outcome = refresh_etf(job.etf_id)
+    if not outcome.succeeded:
+        raise outcome.error
+
+
+def _refresh_fundamentals(
+    job: ScheduledJob,
+    ttl: timedelta = DEFAULT_INTERVALS[FUNDAMENTALS],
+    workers: int = 1,
+) -> None:
+    from etfs.fundamentals.loader import refresh_fundamentals, update_fundamentals
+    from etfs.fundamentals.reader import YahooFundamentalsReader
+
+    update_fundamentals()
+    result = refresh_fundamentals(YahooFundamentalsReader(), ttl, workers=workers)
+    if result.failed_batches:
+        raise RuntimeError(f"{result.failed_batches} fundamentals batches failed")
+
+
+def _measure(job: ScheduledJob) -> None:
+    from etfs.measurements.calculator import measure_all_etfs
+
+    measure_all_etfs()
+
+
+DEFAULT_TASKS = {
+    HOLDINGS: _refresh_holdings,
+    FUNDAMENTALS: _refresh_fundamentals,
+    MEASUREMENTS: _measure,
+}
+
+
+class RefreshScheduler:
+    """Keeps the holdings of every ETF, the fundamentals of their tickers
+    and the measurements fresh. Due work is kept in a priority queue and run
+    by a bounded pool of worker threads; failed work is retried with
+    exponential backoff. The refresh state of each ETF's holdings is stored
+    on the ETF, so that a restarted scheduler continues where it stopped.
+
+    Attributes:
+        workers
+        intervals
+        max_backoff
+        tasks
+
+    Methods:
+        load
+        next_due
+        pop_due
+        complete
+        run
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        intervals: Optional[Dict[str, timedelta]] = None,
+        max_backoff: timedelta = timedelta(hours=6),
+        tasks: Optional[Dict[str, Callable[[ScheduledJob], None]]] = None,
+        clock: Callable[[], datetime] = timezone.now,
+    ):
+        """Initialise a RefreshScheduler object
+
+        Arguments:
+            workers: the maximum number of jobs run at the same time
+            intervals: the refresh interval of each kind of job, defaulting
+                to DEFAULT_INTERVALS
+            max_backoff: the longest delay before retrying a failed job
+            tasks: the function run for each kind of job, defaulting to
+                DEFAULT_TASKS
+            clock: a function returning the current time
+        """
+        self.workers = workers
+        self.intervals = {**DEFAULT_INTERVALS, **(intervals or {})}
+        self.max_backoff = max_backoff
+        # the fundamentals are refetched once per refresh interval by a
+        # single thread besides the worker running the job, so that the job
+        # does not add a pool of its own to the scheduler's threads
+        fundamentals = partial(
+            _refresh_fundamentals, ttl=self.intervals[FUNDAMENTALS], workers=1
+        )
+        self.tasks = {**DEFAULT_TASKS, FUNDAMENTALS: fundamentals, **(tasks or {})}
+        self._clock = clock
+        self._queue: List[ScheduledJob] = []
+        self._sequence = 0
+        self._failures: Dict[Tuple[str, Optional[int]], int] = {}
+        self._tracked_etf_ids: Set[int] = set()
+
+    def load(self) -> None:
+        """Schedule the refresh of every ETF and the global jobs"""
+        now = self._clock()
+        for kind in (CATALOGUE, FUNDAMENTALS, MEASUREMENTS):
+            self._schedule(kind, now)
+        self._track_new_etfs(now)
+
+    def next_due(self) -> Optional[datetime]:
+        """Return the due time of the earliest job, if there is one"""
+        return self._queue[0].due if self._queue else None
+
+    def pop_due(self, limit: int) -> List[ScheduledJob]:
+        """Remove and return up to ``limit`` jobs that are due, earliest
+        first. Catalogue jobs are handled here rather than returned.
+        """
+        now = self._clock()
+        jobs = []
+        while self._queue and self._queue[0].due <= now and len(jobs) < limit:
+            job = heapq.heappop(self._queue)
+            if job.kind == CATALOGUE:
+                self._track_new_etfs(now)
+                self._schedule(CATALOGUE, now + self.intervals[CATALOGUE])
+            else:
+                jobs.append(job)
+        return jobs
+
+    def complete(self, job: ScheduledJob, error: Optional[BaseException]) -> None:
+        """Reschedule a finished job, one interval later if it succeeded or
+        after an exponentially growing delay if it failed
+
+        Arguments:
+            job: the finished job
+            error: the exception raised by the job, if any
+        """
+        now = self._clock()
+        key = (job.kind, job.etf_id)
+        if error is None:
+            self._failures.pop(key, None)
+            due = now + self.intervals[job.kind]
+        else:
+            self._failures[key] = self._failures.get(key, 0) + 1
+            due = now + self._backoff(self._failures[key])
+            logger.warning(
+                "%s job for ETF %s failed (%d in a row): %s",
+                job.kind,
+                job.etf_id,
+                self._failures[key],
+                error,
+            )
+        if job.kind == HOLDINGS and not self._store_refresh_state(
+            job.etf_id, now, due, error
+        ):
+            # the ETF was removed from the catalogue
+            self._tracked_etf_ids.discard(job.etf_id)
+            self._failures.pop(key, None)
+            return
+        self._schedule(job.kind, due, job.etf_id)
+
+    def run(self, stop: threading.Event) -> None:
+        """Run due jobs until ``stop`` is set, then wait for the running
+        jobs to finish
+
+        Arguments:
+            stop: an event that requests a graceful shutdown when set
+        """
+        self.load()
+        running: Dict[Future, ScheduledJob] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not stop.is_set():
+                for job in self.pop_due(self.workers - len(running)):
+                    running[executor.submit(self._execute, job)] = job
+                timeout = self._seconds_until_next_due()
+                if running:
+                    done, _ = wait(
+                        running, timeout=timeout, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        self.complete(running.pop(future), future.exception())
+                else:
+                    stop.wait(timeout)
+            for future in wait(running).done:
+                self.complete(running.pop(future), future.exception())
+
+    def _execute(self, job: ScheduledJob) -> None:
+        """Run a job in a worker thread and release its database connection"""
+        try:
+            self.tasks[job.kind](job)
+        finally:
+            close_old_connections()
+
+    def _seconds_until_next_due(self) -> float:
+        """Return how long the run loop may wait for work to become due"""
+        next_due = self.next_due()
+        if next_due is None:
+            return POLL_SECONDS
+        seconds = (next_due - self._clock()).total_seconds()
+        return min(max(seconds, 0.0), POLL_SECONDS)
+
+    def _store_refresh_state(
+        self,
+        etf_id: int,
+        now: datetime,
+        due: datetime,
+        error: Optional[BaseException],
+    ) -> bool:
+        """Store the refresh state of an ETF's holdings
+
+        Returns:
+            False if the ETF no longer exists
+        """
+        state = {
+            "next_refresh": due,
+            "refresh_failures": self._failures.get((HOLDINGS, etf_id), 0),
+        }
+        if error is None:
+            state["holdings_checked"] = now
+        return ETF.objects.filter(id=etf_id).update(**state) > 0
+
+    def _backoff(self, failures: int) -> timedelta:
+        """Return the delay before retrying a job that failed ``failures``
+        times in a row
+        """
+        return min(RETRY_DELAY * 2 ** (failures - 1), self.max_backoff)
+
+    def _schedule(self, kind: str, due: datetime, etf_id: Optional[int] = None):
+        self._sequence += 1
+        heapq.heappush(self._queue, ScheduledJob(due, self._sequence, kind, etf_id))
+
+    def _track_new_etfs(self, now: datetime) -> None:
+        """Schedule the holdings refresh of ETFs that are not tracked yet.
+        ETFs with a stored next refresh keep it, while ETFs that have never
+        been refreshed are spread evenly over INITIAL_SPREAD so that a new
+        catalogue does not cause a burst of downloads.
+
+        The tracked ETFs are skipped in Python rather than excluded in the
+        query, which would grow with the catalogue, or by the highest tracked
+        id, which misses ETFs whose inserts commit out of id order.
+        """
+        etfs = ETF.objects.values_list("id", "next_refresh", "refresh_failures")
+        unscheduled = []
+        for etf_id, next_refresh, refresh_failures in etfs.order_by("id"):
+            if etf_id in self._tracked_etf_ids:
+                continue
+            self._tracked_etf_ids.add(etf_id)
+            if refresh_failures:
+                self._failures[(HOLDINGS, etf_id)] = refresh_failures
+            if next_refresh is None:
+                unscheduled.append(etf_id)
+            else:
+                self._schedule(HOLDINGS, next_refresh, etf_id)
+        spread = min(INITIAL_SPREAD, self.intervals[HOLDINGS])
+        for index, etf_id in enumerate(unscheduled):
+            self._schedule(HOLDINGS, now + spread * index / len(unscheduled), etf_id)
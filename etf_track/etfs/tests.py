@@ -1,19 +1,105 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import numpy as np
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from pandas import DataFrame
 
-from etfs.models import Holdings
+from etfs import instrumentation
+from etfs.aggregates import etf_summary, holdings_frame
+from etfs.cache import AggregateCache, aggregate_cache
+from etfs.fundamentals.loader import refresh_fundamentals, update_fundamentals
+from etfs.fundamentals.reader import FixtureFundamentalsReader, YahooFundamentalsReader
+from etfs.holdings.cache import DownloadCache
+from etfs.holdings.exposure import exposure_by_etf, ticker_exposures, who_holds
+from etfs.holdings.history import HoldingsHistory, holdings_as_of
 from etfs.holdings.loader import (
+    _diff_holdings,
     _find_orphan_tickers,
     _query_holdings_by_etf_id,
-    _add_or_update_holdings,
+    _update_holdings,
+    read_all_etfs,
+    refresh_provider,
+)
+from etfs.holdings.lookthrough import look_through
+from etfs.holdings.matrix import HoldingsMatrix
+from etfs.holdings.reader import iSharesETFReader, iSharesETFReaderCreator
+from etfs.holdings.similarity import similar_etfs, update_similarities
+from etfs.holdings.snapshot import (
+    HoldingsSnapshot,
+    export_holdings_snapshot,
+    get_holdings_snapshot,
 )
+from etfs.measurements.calculator import measure_all_etfs
+from etfs.measurements.series import measurement_series, rollup_measurements
+from etfs.models import ETF, Fundamentals, Holdings, Measurement, Ticker, TickerExposure
+from etfs.ratelimit import TokenBucket
+from etfs.scheduler import FUNDAMENTALS, HOLDINGS, RefreshScheduler, ScheduledJob
+from etfs.tickers import TickerCache, ticker_details
+from etfs.utils import convert_queryset_to_dataframe
+
+
+def create_etfs(*etf_ids):
+    """Create placeholder ETFs with the given ids"""
+    for etf_id in etf_ids:
+        ETF.objects.create(
+            id=etf_id,
+            etf_issuer="iShares",
+            name=f"ETF {etf_id}",
+            holdings_url=f"http://localhost/{etf_id}.csv",
+            portfolio_url=f"http://localhost/{etf_id}",
+        )
+
+
+# a per-process cache, so that aggregates cached on disk by earlier runs or
+# by a development server are not served to the tests
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def get_ticker(symbol):
+    """Return the Ticker with the given symbol, creating it if needed"""
+    return Ticker.objects.get_or_create(symbol=symbol)[0]
+
 
+def create_holding(etf_id, symbol, percentage):
+    """Create a holding of an ETF, creating its Ticker if needed"""
+    return Holdings.objects.create(
+        etf_id=etf_id, ticker=get_ticker(symbol), percentage=percentage
+    )
 
+
+def create_fundamentals(symbol, **values):
+    """Create the fundamentals of a ticker, creating its Ticker if needed"""
+    return Fundamentals.objects.create(ticker=get_ticker(symbol), **values)
+
+
+def get_fundamentals(symbol):
+    """Return the fundamentals of the ticker with the given symbol"""
+    return Fundamentals.objects.get(ticker__symbol=symbol)
+
+
+@override_settings(CACHES=TEST_CACHES)
 class TestUpdateHoldings(TestCase):
     def setUp(self):
-        Holdings.objects.create(etf_id=1, ticker="AAPL", percentage=13.1)
-        Holdings.objects.create(etf_id=1, ticker="TSLA", percentage=10.1)
-        Holdings.objects.create(etf_id=2, ticker="NVDA", percentage=11.2)
+        create_etfs(1, 2, 3, 4, 5)
+        create_holding(1, "AAPL", 13.1)
+        create_holding(1, "TSLA", 10.1)
+        create_holding(2, "NVDA", 11.2)
 
     def test_find_orphan_tickers(self):
         downloaded_holdings = DataFrame.from_dict(
@@ -33,13 +119,1373 @@ class TestUpdateHoldings(TestCase):
         result = _query_holdings_by_etf_id(1)
         self.assertTrue(result.equals(expected))
 
+    def test_diff_ignores_unchanged_missing_weights(self):
+        stored_holdings = DataFrame.from_dict(
+            {"id": [1, 2], "ticker": ["AAPL", "TSLA"], "percentage": [np.nan, 10.1]}
+        )
+        downloaded_holdings = DataFrame.from_dict(
+            {"ticker": ["AAPL", "TSLA"], "percentage": [np.nan, np.nan]}
+        )
+        _, changed_holdings, _ = _diff_holdings(downloaded_holdings, stored_holdings)
+        self.assertEqual(list(changed_holdings["ticker"]), ["TSLA"])
+
     def test_add_holdings(self):
-        kwargs = {
-            "etf_id": 3,
-            "holdings_to_add": DataFrame.from_dict(
-                {"ticker": ["MSFT"], "percentage": [19.8]}
+        _update_holdings(
+            3, DataFrame.from_dict({"ticker": ["MSFT"], "percentage": [19.8]})
+        )
+        result = Holdings.objects.filter(
+            etf_id=3, ticker__symbol="MSFT", percentage=19.8
+        ).exists()
+        self.assertTrue(result)
+
+    def test_update_holdings(self):
+        downloaded_holdings = DataFrame.from_dict(
+            {"ticker": ["AAPL", "MSFT"], "percentage": [14.2, 19.8]}
+        )
+        _update_holdings(1, downloaded_holdings)
+        result = set(
+            Holdings.objects.filter(etf_id=1).values_list(
+                "ticker__symbol", "percentage"
+            )
+        )
+        expected = {("AAPL", 14.2), ("MSFT", 19.8)}
+        self.assertEqual(result, expected)
+        self.assertTrue(
+            Holdings.objects.filter(etf_id=2, ticker__symbol="NVDA").exists()
+        )
+
+    def test_update_holdings_query_count_is_constant(self):
+        def count_queries(etf_id, n_holdings):
+            tickers = [f"T{i}" for i in range(n_holdings)]
+            Holdings.objects.bulk_create(
+                Holdings(etf_id=etf_id, ticker=get_ticker(ticker), percentage=1.0)
+                for ticker in tickers[: n_holdings // 2]
+            )
+            downloaded_holdings = DataFrame.from_dict(
+                {"ticker": tickers[1:], "percentage": [2.0] * (n_holdings - 1)}
+            )
+            with CaptureQueriesContext(connection) as context:
+                _update_holdings(etf_id, downloaded_holdings)
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(4, 10), count_queries(5, 200))
+
+
+class StubETFReaderCreator:
+    """An ETFReaderCreator that returns canned holdings instead of
+    downloading them
+    """
+
+    def __init__(self, cache=None):
+        pass
+
+    def read(self, identifiers):
+        if identifiers["name"] == "Broken":
+            raise IOError("download failed")
+        return DataFrame.from_dict(
+            {"ticker": ["AAPL", identifiers["name"]], "percentage": [50.0, 50.0]}
+        )
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_DOWNLOAD_CACHE=None)
+class TestReadAllEtfs(TestCase):
+    def setUp(self):
+        for name in ["AAA", "BBB", "Broken"]:
+            ETF.objects.create(
+                etf_issuer="Stub",
+                name=name,
+                holdings_url=f"http://localhost/{name}.csv",
+                portfolio_url=f"http://localhost/{name}",
+            )
+
+    @patch.dict(
+        "etfs.holdings.loader.ETF_PROVIDER_CREATOR_MAPPING",
+        {"Stub": StubETFReaderCreator},
+    )
+    def test_read_all_etfs_concurrently(self):
+        outcomes = read_all_etfs("Stub", workers=3)
+        succeeded = {o.name for o in outcomes if o.succeeded}
+        failed = {o.name for o in outcomes if not o.succeeded}
+        self.assertEqual(succeeded, {"AAA", "BBB"})
+        self.assertEqual(failed, {"Broken"})
+        self.assertEqual(Holdings.objects.filter(ticker__symbol="AAPL").count(), 2)
+
+
+ISHARES_CSV = (
+    'Fund Holdings as of,"Oct 14, 2022"\n'
+    'Inception Date,"May 15, 2000"\n'
+    "Ticker,Name,Sector,Weight (%)\n"
+    "AAPL,APPLE INC,Information Technology,6.5\n"
+    "MSFT,MICROSOFT CORP,Information Technology,5.5\n"
+    "USD,USD CASH,Cash and/or Derivatives,0.1\n"
+)
+
+
+class StubHoldingsHandler(BaseHTTPRequestHandler):
+    """Serves the files in the server's ``files`` mapping, honouring
+    If-None-Match with ETags derived from the file contents unless the
+    server's ``etag`` flag is cleared
+    """
+
+    def do_GET(self):
+        body = self.server.files[self.path].encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        self.server.requests += 1
+        if self.server.etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadCache(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHoldingsHandler)
+        self.server.files = {"/a.csv": ISHARES_CSV, "/b.csv": ISHARES_CSV}
+        self.server.requests = 0
+        self.server.etag = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_directory = TemporaryDirectory()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_directory.cleanup()
+
+    def fetch(self, cache, url):
+        with cache.fetch(url) as stream:
+            body = None if stream is None else stream.read()
+        return None if stream is None or stream.unchanged else body
+
+    def test_fetch_skips_unchanged_files(self):
+        cache = DownloadCache(self.cache_directory.name, max_entries=10)
+        url = self.base_url + "/a.csv"
+        self.assertEqual(self.fetch(cache, url), ISHARES_CSV.encode())
+        cache.commit(url)
+        self.assertIsNone(self.fetch(cache, url))
+        self.server.etag = False
+        self.assertIsNone(self.fetch(cache, url))
+        self.server.files["/a.csv"] = ISHARES_CSV + "TSLA,TESLA,Consumer,1.0\n"
+        self.assertEqual(self.fetch(cache, url), self.server.files["/a.csv"].encode())
+        files = Path(self.cache_directory.name).iterdir()
+        self.assertEqual([path.suffix for path in files], [".json"])
+
+    def test_fetch_without_commit(self):
+        cache = DownloadCache(self.cache_directory.name, max_entries=10)
+        url = self.base_url + "/a.csv"
+        self.fetch(cache, url)
+        self.assertEqual(self.fetch(cache, url), ISHARES_CSV.encode())
+
+    def test_fetch_with_bypass(self):
+        url = self.base_url + "/a.csv"
+        cache = DownloadCache(self.cache_directory.name, max_entries=10)
+        self.fetch(cache, url)
+        cache.commit(url)
+        cache = DownloadCache(self.cache_directory.name, max_entries=10, bypass=True)
+        self.assertEqual(self.fetch(cache, url), ISHARES_CSV.encode())
+
+    def test_fetch_after_discard(self):
+        cache = DownloadCache(self.cache_directory.name, max_entries=10)
+        url = self.base_url + "/a.csv"
+        self.fetch(cache, url)
+        cache.commit(url)
+        cache.discard(url)
+        self.assertEqual(self.fetch(cache, url), ISHARES_CSV.encode())
+
+    def test_eviction(self):
+        cache = DownloadCache(self.cache_directory.name, max_entries=1)
+        for path in ["/a.csv", "/b.csv"]:
+            self.fetch(cache, self.base_url + path)
+            cache.commit(self.base_url + path)
+        self.assertEqual(
+            self.fetch(cache, self.base_url + "/a.csv"), ISHARES_CSV.encode()
+        )
+        self.assertEqual(self.server.requests, 3)
+
+    def test_reader_returns_none_for_unchanged_holdings(self):
+        cache = DownloadCache(self.cache_directory.name, max_entries=10)
+        creator = iSharesETFReaderCreator(cache)
+        identifiers = {"id": "1", "name": "A", "holdings_url": self.base_url + "/a.csv"}
+        holdings = creator.read(identifiers)
+        self.assertEqual(list(holdings["ticker"]), ["AAPL", "MSFT"])
+        cache.commit(identifiers["holdings_url"])
+        self.assertIsNone(creator.read(identifiers))
+
+
+class TestiSharesETFReader(SimpleTestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        path = Path(self.directory.name) / "holdings.csv"
+        path.write_text(
+            ISHARES_CSV
+            + "NA,NATIONAL BANK,Financials,1.0\n"
+            + "XYZ,NO SECTOR,,1.0\n"
+            + "FUT,FUTURE,Cash and/or Derivatives,-\n"
+            + '\xa0\n"The content contained herein, is owned by BlackRock"\n'
+        )
+        self.identifiers = {"id": "1", "name": "A", "holdings_url": path.as_uri()}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read(self):
+        expected = DataFrame.from_dict(
+            {"ticker": ["AAPL", "MSFT", "NA"], "percentage": [6.5, 5.5, 1.0]}
+        )
+        result = iSharesETFReader(self.identifiers).read()
+        self.assertTrue(result[["ticker", "percentage"]].equals(expected))
+        self.assertEqual(
+            list(result["sector"]),
+            ["Information Technology", "Information Technology", "Financials"],
+        )
+        self.assertNotIn("exchange", result)
+
+    @patch.object(iSharesETFReader, "CHUNKSIZE", 2)
+    def test_read_in_chunks(self):
+        result = iSharesETFReader(self.identifiers).read()
+        self.assertEqual(list(result["ticker"]), ["AAPL", "MSFT", "NA"])
+        self.assertEqual(list(result.index), [0, 1, 2])
+
+
+class TestConvertQuerysetToDataframe(TestCase):
+    def setUp(self):
+        create_etfs(1, 2)
+        create_holding(1, "AAPL", 13.1)
+        create_holding(1, "TSLA", 10.1)
+        create_holding(2, "NVDA", 11.2)
+        create_fundamentals("AAPL", eps=6.1)
+        create_fundamentals("TSLA")
+
+    def test_convert_all_fields(self):
+        result = convert_queryset_to_dataframe(Holdings.objects.order_by("id"))
+        self.assertEqual(
+            list(result.columns), ["id", "etf_id", "ticker_id", "percentage"]
+        )
+        self.assertEqual(result["ticker_id"].dtype, "int64")
+        self.assertEqual(result["etf_id"].dtype, "int64")
+        self.assertEqual(result["percentage"].dtype, "float64")
+
+    def test_convert_in_chunks(self):
+        queryset = Holdings.objects.order_by("id")
+        expected = convert_queryset_to_dataframe(queryset, exclude_id=True)
+        result = convert_queryset_to_dataframe(queryset, exclude_id=True, chunk_size=2)
+        self.assertTrue(result.equals(expected))
+
+    def test_convert_nullable_fields(self):
+        result = convert_queryset_to_dataframe(
+            Fundamentals.objects.order_by("ticker__symbol"),
+            fields=["ticker__symbol", "eps", "last_updated"],
+        )
+        self.assertEqual(list(result["ticker__symbol"]), ["AAPL", "TSLA"])
+        self.assertEqual(result["eps"].iloc[0], 6.1)
+        self.assertTrue(result["eps"].isna().iloc[1])
+        self.assertEqual(str(result["last_updated"].dtype), "datetime64[ns, UTC]")
+
+    def test_convert_empty_queryset(self):
+        result = convert_queryset_to_dataframe(
+            Holdings.objects.none(), fields=["ticker__symbol", "percentage"]
+        )
+        self.assertTrue(result.empty)
+        self.assertEqual(list(result.columns), ["ticker__symbol", "percentage"])
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_HISTORY=None)
+class TestQueryPlans(TestCase):
+    """Check that the queries issued by the hot loader paths are answered
+    from indexes rather than by scanning whole tables
+    """
+
+    INDEX_MARKERS = {
+        "sqlite": ["USING INDEX", "USING COVERING INDEX", "USING INTEGER PRIMARY KEY"],
+        "postgresql": ["Index Scan", "Index Only Scan", "Bitmap Index Scan"],
+    }
+    EXPLAIN = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN "}
+
+    def setUp(self):
+        if connection.vendor not in self.INDEX_MARKERS:
+            self.skipTest(f"no query plan markers for {connection.vendor}")
+        if connection.vendor == "postgresql":
+            # the tables are tiny, so make the planner prefer any usable index
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        create_etfs(1, 2)
+        for etf_id in (1, 2):
+            for ticker, percentage in [("AAPL", 40.0), ("MSFT", 30.0), ("TSLA", 30.0)]:
+                create_holding(etf_id, ticker, percentage)
+
+    def assertQueriesUseIndexes(self, table, run):
+        """Run a function and check the plan of every filtered query it
+        issues against a table
+        """
+        with CaptureQueriesContext(connection) as context:
+            run()
+        queries = [
+            query["sql"]
+            for query in context.captured_queries
+            if table in query["sql"]
+            and " WHERE " in query["sql"]
+            and query["sql"].startswith(("SELECT", "UPDATE", "DELETE", "WITH"))
+        ]
+        self.assertTrue(queries)
+        markers = self.INDEX_MARKERS[connection.vendor]
+        for sql in queries:
+            with connection.cursor() as cursor:
+                cursor.execute(self.EXPLAIN[connection.vendor] + sql)
+                plan = "\n".join(str(row[-1]) for row in cursor.fetchall())
+            self.assertTrue(any(marker in plan for marker in markers), sql + plan)
+
+    def test_update_holdings(self):
+        downloaded_holdings = DataFrame.from_dict(
+            {"ticker": ["AAPL", "MSFT", "NVDA"], "percentage": [50.0, 30.0, 20.0]}
+        )
+        self.assertQueriesUseIndexes(
+            "etfs_holdings", lambda: _update_holdings(1, downloaded_holdings)
+        )
+
+    def test_update_exposures(self):
+        downloaded_holdings = DataFrame.from_dict(
+            {"ticker": ["AAPL", "NVDA"], "percentage": [50.0, 50.0]}
+        )
+        self.assertQueriesUseIndexes(
+            "etfs_tickerexposure", lambda: _update_holdings(1, downloaded_holdings)
+        )
+
+    def test_resolve_tickers(self):
+        self.assertQueriesUseIndexes(
+            "etfs_ticker", lambda: TickerCache().resolve(["AAPL", "NVDA"])
+        )
+
+    def test_update_fundamentals(self):
+        self.assertQueriesUseIndexes("etfs_holdings", update_fundamentals)
+
+    def test_measurement_series(self):
+        start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        self.assertQueriesUseIndexes(
+            "etfs_measurement",
+            lambda: measurement_series([1], start, start + timedelta(days=7)),
+        )
+
+
+class TestUpdateFundamentals(TestCase):
+    def setUp(self):
+        create_etfs(1, 2)
+        create_holding(1, "AAPL", 13.1)
+        create_holding(1, "TSLA", 10.1)
+        create_holding(2, "AAPL", 11.2)
+        create_fundamentals("AAPL", eps=6.1)
+        create_fundamentals("GE", eps=1.2)
+
+    def test_update_fundamentals(self):
+        result = update_fundamentals()
+        self.assertEqual(result, (1, 1))
+        tickers = set(Fundamentals.objects.values_list("ticker__symbol", flat=True))
+        self.assertEqual(tickers, {"AAPL", "TSLA"})
+        self.assertEqual(get_fundamentals("AAPL").eps, 6.1)
+        self.assertEqual(update_fundamentals(), (0, 0))
+
+    def test_update_fundamentals_query_count(self):
+        Holdings.objects.bulk_create(
+            Holdings(etf_id=2, ticker=get_ticker(f"T{i}"), percentage=1.0)
+            for i in range(100)
+        )
+        with self.assertNumQueries(5):
+            update_fundamentals()
+
+
+class FailingFundamentalsReader(FixtureFundamentalsReader):
+    """A fixture reader that fails for batches containing FAIL and for the
+    ticker BAD alone
+    """
+
+    def read(self, tickers, throttle=lambda: None):
+        if "FAIL" in tickers:
+            raise IOError("request failed")
+        fundamentals = super().read(tickers, throttle)
+        if "BAD" in tickers:
+            fundamentals["BAD"] = None
+        return fundamentals
+
+
+class TestRefreshFundamentals(TestCase):
+    def setUp(self):
+        now = datetime.now(timezone.utc)
+        create_fundamentals("AAPL")
+        Fundamentals.objects.create(
+            ticker=get_ticker("MSFT"), last_updated=now - timedelta(days=2)
+        )
+        create_fundamentals("TSLA", last_updated=now, eps=4.1)
+        create_fundamentals("GONE")
+        self.reader = FailingFundamentalsReader(
+            {
+                "AAPL": {"eps": 6.1, "p_e": 24.0, "ev_ebitda": 18.5},
+                "MSFT": {"eps": 9.2, "p_e": 30.1, "ev_ebitda": 21.0},
+                "TSLA": {"eps": 4.2, "p_e": 60.0, "ev_ebitda": 40.0},
+            }
+        )
+
+    def test_refresh_only_stale_fundamentals(self):
+        result = refresh_fundamentals(self.reader, timedelta(days=1), batch_size=2)
+        self.assertEqual(result, (2, 0, 1))
+        self.assertEqual(get_fundamentals("AAPL").p_e, 24.0)
+        self.assertEqual(get_fundamentals("MSFT").eps, 9.2)
+        self.assertEqual(get_fundamentals("TSLA").eps, 4.1)
+        self.assertIsNone(get_fundamentals("GONE").last_updated)
+
+    def test_failed_batches_stay_stale(self):
+        create_fundamentals("FAIL")
+        result = refresh_fundamentals(
+            self.reader, timedelta(days=1), batch_size=1, workers=2, rate=1000
+        )
+        self.assertEqual(result, (2, 1, 1))
+        self.assertIsNone(get_fundamentals("FAIL").last_updated)
+
+    def test_failed_tickers_stay_stale(self):
+        create_fundamentals("BAD")
+        result = refresh_fundamentals(self.reader, timedelta(days=1), rate=1000)
+        self.assertEqual(result, (2, 0, 2))
+        self.assertIsNone(get_fundamentals("BAD").last_updated)
+        self.assertEqual(get_fundamentals("AAPL").p_e, 24.0)
+
+    def test_yahoo_reader_throttles_each_request(self):
+        class Ticker:
+            def __init__(self, symbol):
+                self.symbol = symbol
+
+            @property
+            def info(self):
+                if self.symbol == "BAD":
+                    raise IOError("request failed")
+                return {"trailingPE": 20.0}
+
+        class Tickers:
+            def __init__(self, symbols):
+                self.tickers = {s: Ticker(s) for s in symbols.split()}
+
+        throttled = []
+        yfinance = type(sys)("yfinance")
+        yfinance.Tickers = Tickers
+        with patch.dict(sys.modules, {"yfinance": yfinance}):
+            result = YahooFundamentalsReader().read(
+                ["AAPL", "BAD", "MSFT"], throttle=lambda: throttled.append(1)
+            )
+        self.assertEqual(len(throttled), 3)
+        self.assertIsNone(result["BAD"])
+        self.assertEqual(result["MSFT"]["p_e"], 20.0)
+
+    def test_one_bulk_update_per_batch(self):
+        with CaptureQueriesContext(connection) as context:
+            refresh_fundamentals(
+                self.reader, timedelta(days=1), batch_size=1, rate=1000
+            )
+        queries = [q["sql"] for q in context.captured_queries]
+        updates = [sql for sql in queries if sql.startswith("UPDATE")]
+        # the batch of GONE, which the reader has no result for, is not written
+        self.assertEqual(len(updates), 2)
+
+
+class TestTokenBucket(SimpleTestCase):
+    def test_acquire_waits_for_tokens(self):
+        clock = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock[0] += seconds
+
+        bucket = TokenBucket(rate=2.0, capacity=2, clock=lambda: clock[0], sleep=sleep)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(waits, [0.5, 0.5])
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_SNAPSHOT=None)
+class TestMeasureAllEtfs(TestCase):
+    def setUp(self):
+        create_etfs(1, 2, 3)
+        create_holding(1, "AAPL", 60.0)
+        create_holding(1, "MSFT", 40.0)
+        create_holding(2, "AAPL", 50.0)
+        create_holding(2, "LOSS", 50.0)
+        create_holding(3, "NONE", 100.0)
+        create_fundamentals("AAPL", p_e=20.0, ev_ebitda=10.0)
+        create_fundamentals("MSFT", p_e=40.0, ev_ebitda=20.0)
+        create_fundamentals("LOSS", p_e=-5.0)
+
+    def test_holdings_matrix(self):
+        matrix = HoldingsMatrix.from_database()
+        self.assertEqual(list(matrix.etf_ids), [1, 2, 3])
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(list(matrix.dot(np.ones(4))), [100.0, 100.0, 100.0])
+        self.assertEqual(
+            set(matrix.ticker_ids.tolist()),
+            set(Ticker.objects.values_list("id", flat=True)),
+        )
+
+    def test_measure_all_etfs_joins_on_ticker_ids(self):
+        with CaptureQueriesContext(connection) as context:
+            measure_all_etfs()
+        for query in context.captured_queries:
+            self.assertNotIn("etfs_ticker", query["sql"])
+
+    def test_measure_all_etfs(self):
+        self.assertEqual(measure_all_etfs(), 2)
+        measurement = Measurement.objects.get(etf_id=1)
+        self.assertAlmostEqual(measurement.p_e, 100.0 / (60.0 / 20.0 + 40.0 / 40.0))
+        self.assertAlmostEqual(
+            measurement.ev_ebidta, 100.0 / (60.0 / 10.0 + 40.0 / 20.0)
+        )
+        measurement = Measurement.objects.get(etf_id=2)
+        self.assertAlmostEqual(measurement.p_e, 20.0)
+        self.assertFalse(Measurement.objects.filter(etf_id=3).exists())
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_SNAPSHOT=None)
+class TestApi(TestCase):
+    def setUp(self):
+        create_etfs(1, 2, 3)
+        for i in range(5):
+            create_holding(1, f"T{i}", 20.0)
+        for day in range(1, 4):
+            Measurement.objects.create(
+                etf_id=1,
+                date_time=datetime(2022, 11, day, tzinfo=timezone.utc),
+                p_e=20.0 + day,
+                ev_ebidta=10.0,
+            )
+
+    def test_etf_list_pagination(self):
+        response = self.client.get("/api/etfs/", {"limit": 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([etf["id"] for etf in page["results"]], [1, 2])
+        response = self.client.get("/api/etfs/", {"limit": 2, "after": page["next"]})
+        page = response.json()
+        self.assertEqual([etf["id"] for etf in page["results"]], [3])
+        self.assertIsNone(page["next"])
+
+    def test_holdings_not_modified(self):
+        response = self.client.get("/api/etfs/1/holdings/")
+        self.assertEqual(len(response.json()["results"]), 5)
+        etag = response["ETag"]
+        response = self.client.get("/api/etfs/1/holdings/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        _update_holdings(
+            1, DataFrame.from_dict({"ticker": ["T0"], "percentage": [100.0]})
+        )
+        response = self.client.get("/api/etfs/1/holdings/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 1)
+
+    def test_etf_rename_modifies(self):
+        paths = ["/api/etfs/", "/api/etfs/1/"]
+        etags = {path: self.client.get(path)["ETag"] for path in paths}
+        etf = ETF.objects.get(id=1)
+        etf.name = "Renamed"
+        etf.save()
+        for path, etag in etags.items():
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_measurements_modify(self):
+        etag = self.client.get("/api/etfs/1/measurements/")["ETag"]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                "/api/etfs/1/measurements/", HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        queries = [q["sql"] for q in context.captured_queries]
+        self.assertFalse(any("etfs_measurement" in sql for sql in queries))
+        create_fundamentals("T0", p_e=10.0, ev_ebitda=5.0)
+        measure_all_etfs()
+        response = self.client.get("/api/etfs/1/measurements/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_measurements_pagination(self):
+        response = self.client.get("/api/etfs/1/measurements/", {"limit": 2})
+        self.assertIn("Last-Modified", response)
+        page = response.json()
+        self.assertEqual([row["p_e"] for row in page["results"]], [21.0, 22.0])
+        response = self.client.get(
+            "/api/etfs/1/measurements/", {"limit": 2, "after": page["next"]}
+        )
+        rows = response.json()["results"]
+        self.assertEqual([row["p_e"] for row in rows], [23.0])
+
+    def test_missing_etf(self):
+        self.assertEqual(self.client.get("/api/etfs/9/holdings/").status_code, 404)
+
+    def test_invalid_limit(self):
+        response = self.client.get("/api/etfs/", {"limit": "many"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsafe_method(self):
+        self.assertEqual(self.client.post("/api/etfs/").status_code, 405)
+
+    def test_overview(self):
+        response = self.client.get("/api/etfs/1/overview/")
+        self.assertEqual(response.status_code, 200)
+        overview = response.json()
+        self.assertEqual(overview["id"], 1)
+        self.assertEqual(len(overview["top_holdings"]), 5)
+        self.assertEqual(overview["latest_measurement"]["p_e"], 23.0)
+        response = self.client.get(
+            "/api/etfs/1/overview/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/api/etfs/9/overview/")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_HISTORY=None, HOLDINGS_SNAPSHOT=None)
+class TestAggregateCache(TestCase):
+    def setUp(self):
+        create_etfs(1, 2)
+        create_holding(1, "AAPL", 60.0)
+        create_holding(1, "MSFT", 40.0)
+        aggregate_cache.invalidate_many([1, 2])
+
+    def test_local_and_shared_tiers(self):
+        cache = AggregateCache(max_local_entries=1)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_compute(1, "value", compute), 1)
+        self.assertEqual(cache.get_or_compute(1, "value", compute), 1)
+        cache.get_or_compute(2, "value", compute)
+        self.assertEqual(cache.get_or_compute(1, "value", compute), 1)
+        self.assertEqual(
+            cache.stats(),
+            {"hits_local": 1, "hits_shared": 1, "misses": 2, "local_entries": 1},
+        )
+        cache.invalidate(1)
+        self.assertEqual(cache.get_or_compute(1, "value", compute), 3)
+
+    def test_local_entries_are_trusted_until_they_expire(self):
+        cache = AggregateCache(local_ttl=60)
+        cache.get_or_compute(1, "value", lambda: 1)
+        AggregateCache().invalidate(1)
+        with patch.object(AggregateCache, "_version") as version:
+            self.assertEqual(cache.get_or_compute(1, "value", lambda: 2), 1)
+        version.assert_not_called()
+        later = time.monotonic() + 61
+        with patch("etfs.cache.time.monotonic", return_value=later):
+            self.assertEqual(cache.get_or_compute(1, "value", lambda: 2), 2)
+
+    def test_local_entries_expire(self):
+        cache = AggregateCache(local_ttl=0)
+        cache.get_or_compute(1, "value", lambda: 1)
+        cache.get_or_compute(1, "value", lambda: 2)
+        self.assertEqual(cache.stats()["hits_local"], 0)
+        self.assertEqual(cache.stats()["hits_shared"], 1)
+
+    def test_invalidated_by_holdings_update(self):
+        self.assertEqual(etf_summary(1)["holdings_count"], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            _update_holdings(
+                1, DataFrame.from_dict({"ticker": ["AAPL"], "percentage": [100.0]})
+            )
+        self.assertEqual(etf_summary(1)["holdings_count"], 1)
+        self.assertEqual(list(holdings_frame(1)["ticker"]), ["AAPL"])
+
+    def test_invalidated_by_measurements(self):
+        create_fundamentals("AAPL", p_e=20.0)
+        self.assertIsNone(etf_summary(1)["latest_measurement"])
+        with self.captureOnCommitCallbacks(execute=True):
+            measure_all_etfs()
+        self.assertEqual(etf_summary(1)["latest_measurement"]["p_e"], 20.0)
+
+    def test_etf_detail(self):
+        response = self.client.get("/api/etfs/1/")
+        self.assertEqual(response.json()["top_holdings"][0]["ticker"], "AAPL")
+        response = self.client.get("/api/cache/stats/")
+        self.assertIn("misses", response.json())
+
+    def test_missing_etf_is_not_summarised(self):
+        with patch("etfs.aggregates.etf_summary") as summary:
+            response = self.client.get("/api/etfs/9/")
+        self.assertEqual(response.status_code, 404)
+        summary.assert_not_called()
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestHoldingsHistory(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.history = HoldingsHistory(self.directory.name, keyframe_interval=2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, day, tickers, percentages):
+        holdings = DataFrame.from_dict({"ticker": tickers, "percentage": percentages})
+        taken_at = datetime(2022, 11, day, 18, tzinfo=timezone.utc)
+        return self.history.record(1, holdings, taken_at)
+
+    def as_of(self, day):
+        when = datetime(2022, 11, day, 23, tzinfo=timezone.utc)
+        holdings = self.history.as_of(1, when)
+        return dict(zip(holdings["ticker"], holdings["percentage"].round(4)))
+
+    def test_time_travel(self):
+        self.assertTrue(self.record(1, ["AAPL", "MSFT"], [60.0, 40.0]))
+        self.assertFalse(self.record(2, ["AAPL", "MSFT"], [60.0, 40.0]))
+        self.assertTrue(self.record(3, ["AAPL", "TSLA"], [55.5, 44.5]))
+        self.assertTrue(self.record(4, ["AAPL", "TSLA", "NVDA"], [50.0, 40.0, 10.0]))
+        self.assertTrue(self.record(5, ["NVDA"], [100.0]))
+        self.assertIsNone(
+            self.history.as_of(1, datetime(2022, 10, 1, tzinfo=timezone.utc))
+        )
+        self.assertEqual(self.as_of(2), {"AAPL": 60.0, "MSFT": 40.0})
+        self.assertEqual(self.as_of(3), {"AAPL": 55.5, "TSLA": 44.5})
+        self.assertEqual(self.as_of(4), {"AAPL": 50.0, "TSLA": 40.0, "NVDA": 10.0})
+        self.assertEqual(self.as_of(5), {"NVDA": 100.0})
+        self.assertIsNone(
+            self.history.as_of(2, datetime(2022, 11, 5, tzinfo=timezone.utc))
+        )
+
+    def test_recorded_by_update_holdings(self):
+        create_etfs(1)
+        with override_settings(HOLDINGS_HISTORY={"DIR": self.directory.name}):
+            with self.captureOnCommitCallbacks(execute=True):
+                _update_holdings(
+                    1, DataFrame.from_dict({"ticker": ["AAPL"], "percentage": [100.0]})
+                )
+            holdings = holdings_as_of(1, date.today())
+        self.assertEqual(list(holdings["ticker"]), ["AAPL"])
+
+
+class TestMeasurementSeries(TestCase):
+    def setUp(self):
+        create_etfs(1, 2)
+        for day, hour, p_e in [(1, 9, 10.0), (1, 17, 20.0), (2, 9, 30.0), (8, 9, 40.0)]:
+            Measurement.objects.create(
+                etf_id=1,
+                date_time=datetime(2022, 8, day, hour, tzinfo=timezone.utc),
+                p_e=p_e,
+                ev_ebidta=p_e / 2,
+            )
+        Measurement.objects.create(
+            etf_id=2, date_time=datetime(2022, 8, 1, tzinfo=timezone.utc), p_e=5.0
+        )
+        self.start = datetime(2022, 8, 1, tzinfo=timezone.utc)
+        self.end = datetime(2022, 9, 1, tzinfo=timezone.utc)
+
+    def test_daily_series(self):
+        series = measurement_series([1], self.start, self.end, "day")
+        self.assertEqual(list(series["samples"]), [2, 1, 1])
+        self.assertEqual(list(series["p_e_mean"]), [15.0, 30.0, 40.0])
+        self.assertEqual(list(series["p_e_last"]), [20.0, 30.0, 40.0])
+        self.assertEqual(list(series["p_e_min"]), [10.0, 30.0, 40.0])
+        self.assertEqual(str(series["bucket"].dtype), "datetime64[ns, UTC]")
+
+    def test_monthly_series(self):
+        series = measurement_series([1, 2], self.start, self.end, "month")
+        self.assertEqual(list(series["etf_id"]), [1, 2])
+        self.assertEqual(list(series["p_e_mean"]), [25.0, 5.0])
+        self.assertEqual(list(series["p_e_max"]), [40.0, 5.0])
+        self.assertEqual(list(series["ev_ebidta_last"].fillna(-1)), [20.0, -1])
+
+    def test_rollup_preserves_series(self):
+        expected = measurement_series([1, 2], self.start, self.end, "week")
+        rolled_up = rollup_measurements(datetime(2022, 8, 8, 12, tzinfo=timezone.utc))
+        self.assertEqual(rolled_up, 4)
+        self.assertEqual(Measurement.objects.count(), 1)
+        Measurement.objects.create(
+            etf_id=1, date_time=datetime(2022, 8, 2, 18, tzinfo=timezone.utc), p_e=50.0
+        )
+        self.assertEqual(
+            rollup_measurements(datetime(2022, 8, 8, tzinfo=timezone.utc)), 1
+        )
+        result = measurement_series([1, 2], self.start, self.end, "week")
+        self.assertEqual(list(result["samples"]), [4, 1, 1])
+        self.assertEqual(list(result["p_e_last"]), [50.0, 40.0, 5.0])
+        self.assertEqual(list(result["p_e_max"]), [50.0, 40.0, 5.0])
+        self.assertEqual(list(expected["p_e_min"]), list(result["p_e_min"]))
+
+    def test_weekly_rollups_are_rejected(self):
+        with self.assertRaises(ValueError):
+            rollup_measurements(datetime(2022, 8, 8, tzinfo=timezone.utc), "week")
+        self.assertEqual(Measurement.objects.count(), 5)
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_SNAPSHOT=None)
+class TestSimilarities(TestCase):
+    HOLDINGS = {
+        1: {"AAPL": 50.0, "MSFT": 50.0},
+        2: {"AAPL": 30.0, "MSFT": 30.0, "TSLA": 40.0},
+        3: {"AAPL": 10.0, "XOM": 90.0},
+        4: {"XOM": 100.0},
+    }
+
+    def setUp(self):
+        create_etfs(1, 2, 3, 4, 5)
+        for etf_id, holdings in self.HOLDINGS.items():
+            for ticker, percentage in holdings.items():
+                create_holding(etf_id, ticker, percentage)
+
+    def expected(self, etf_id, other_id):
+        a, b = self.HOLDINGS[etf_id], self.HOLDINGS[other_id]
+        overlap = sum(min(a[t], b[t]) for t in a.keys() & b.keys())
+        dot = sum(a[t] * b[t] for t in a.keys() & b.keys())
+        norm_a = sum(w * w for w in a.values()) ** 0.5
+        norm_b = sum(w * w for w in b.values()) ** 0.5
+        return overlap, dot / (norm_a * norm_b)
+
+    def assertSimilarities(self):
+        for etf_id in self.HOLDINGS:
+            for similar in similar_etfs(etf_id, k=10):
+                overlap, cosine = self.expected(etf_id, similar["etf_id"])
+                self.assertAlmostEqual(similar["overlap"], overlap)
+                self.assertAlmostEqual(similar["cosine"], cosine)
+
+    def test_full_update(self):
+        self.assertEqual(update_similarities(), 5)
+        self.assertSimilarities()
+        self.assertEqual([s["etf_id"] for s in similar_etfs(1)], [2, 3])
+        self.assertEqual(
+            [s["etf_id"] for s in similar_etfs(3, metric="cosine")], [4, 1, 2]
+        )
+        self.assertEqual(similar_etfs(5), [])
+
+    def test_incremental_update(self):
+        update_similarities()
+        self.assertEqual(update_similarities(), 0)
+        self.HOLDINGS[4] = {"XOM": 50.0, "MSFT": 50.0}
+        _update_holdings(
+            4,
+            DataFrame.from_dict(
+                {"ticker": ["XOM", "MSFT"], "percentage": [50.0, 50.0]}
             ),
+        )
+        self.assertEqual(update_similarities(), 1)
+        self.assertSimilarities()
+        self.assertIn(4, [s["etf_id"] for s in similar_etfs(1)])
+
+    def test_similar_api(self):
+        update_similarities()
+        response = self.client.get("/api/etfs/1/similar/", {"limit": 1})
+        rows = response.json()["results"]
+        self.assertEqual([row["etf_id"] for row in rows], [2])
+
+
+@override_settings(CACHES=TEST_CACHES, HOLDINGS_HISTORY=None)
+class TestTickerExposure(TestCase):
+    def setUp(self):
+        create_etfs(1, 2)
+        _update_holdings(
+            1,
+            DataFrame.from_dict({"ticker": ["AAPL", "TSLA"], "percentage": [6.0, 2.0]}),
+        )
+        _update_holdings(
+            2,
+            DataFrame.from_dict({"ticker": ["AAPL", "NVDA"], "percentage": [4.0, 3.0]}),
+        )
+
+    def test_who_holds(self):
+        self.assertEqual(who_holds("AAPL"), {1: 6.0, 2: 4.0})
+        self.assertEqual(who_holds("MSFT"), {})
+
+    def test_update_is_incremental(self):
+        _update_holdings(
+            1,
+            DataFrame.from_dict({"ticker": ["AAPL", "MSFT"], "percentage": [5.0, 1.0]}),
+        )
+        self.assertEqual(who_holds("AAPL"), {1: 5.0, 2: 4.0})
+        self.assertEqual(who_holds("MSFT"), {1: 1.0})
+        self.assertFalse(TickerExposure.objects.filter(ticker__symbol="TSLA").exists())
+
+    def test_update_query_count_is_constant(self):
+        def count_queries(size, offset):
+            tickers = [f"T{offset + i}" for i in range(size)]
+            holdings = DataFrame.from_dict(
+                {"ticker": tickers, "percentage": [1.0] * size}
+            )
+            with CaptureQueriesContext(connection) as context:
+                _update_holdings(2, holdings)
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(5, 0), count_queries(50, 100))
+
+    def test_deleted_etf_is_removed(self):
+        ETF.objects.filter(id=1).delete()
+        self.assertEqual(who_holds("AAPL"), {2: 4.0})
+        self.assertFalse(TickerExposure.objects.filter(ticker__symbol="TSLA").exists())
+        exposure = TickerExposure.objects.get(ticker__symbol="AAPL")
+        self.assertEqual(exposure.etf_count, 1)
+        self.assertAlmostEqual(exposure.total_percentage, 4.0)
+
+    def test_batch_exposures(self):
+        result = ticker_exposures(["AAPL", "NVDA", "MSFT"]).set_index("ticker")
+        self.assertEqual(sorted(result.index), ["AAPL", "NVDA"])
+        self.assertEqual(result.loc["AAPL", "etf_count"], 2)
+        self.assertAlmostEqual(result.loc["AAPL", "total_percentage"], 10.0)
+        self.assertEqual(exposure_by_etf(["AAPL", "TSLA", "NVDA"]), {1: 8.0, 2: 7.0})
+
+
+@override_settings(HOLDINGS_SNAPSHOT=None)
+class TestLookThrough(TestCase):
+    def setUp(self):
+        create_etfs(1, 2, 3)
+        Holdings.objects.bulk_create(
+            [
+                Holdings(etf_id=1, ticker=get_ticker("AAPL"), percentage=60.0),
+                Holdings(etf_id=1, ticker=get_ticker("MSFT"), percentage=40.0),
+                Holdings(etf_id=2, ticker=get_ticker("AAPL"), percentage=20.0),
+                Holdings(etf_id=2, ticker=get_ticker("NVDA"), percentage=80.0),
+            ]
+        )
+        Fundamentals.objects.bulk_create(
+            [
+                Fundamentals(ticker=get_ticker("AAPL"), p_e=20.0),
+                Fundamentals(ticker=get_ticker("MSFT"), p_e=-5.0),
+                Fundamentals(ticker=get_ticker("NVDA"), p_e=40.0),
+            ]
+        )
+
+    def test_exposures(self):
+        result = look_through({1: 0.5, 2: 0.5, 3: 0.0})
+        self.assertEqual(result.exposures["ticker"].tolist(), ["AAPL", "NVDA", "MSFT"])
+        np.testing.assert_allclose(result.exposures["percentage"], [40.0, 40.0, 20.0])
+        self.assertEqual(result.missing_etf_ids, [3])
+
+    def test_p_e_excludes_negative_earnings(self):
+        result = look_through({1: 0.5, 2: 0.5})
+        self.assertAlmostEqual(result.p_e, 80.0 / (40.0 / 20.0 + 40.0 / 40.0))
+
+    def test_uses_two_queries(self):
+        with self.assertNumQueries(2):
+            look_through({1: 0.25, 2: 0.75})
+
+    def test_command_normalises_weights(self):
+        with redirect_stdout(StringIO()) as output:
+            call_command("look_through", "--etf", "1:3", "--etf", "2:1")
+        self.assertIn("AAPL: 50.0000%", output.getvalue())
+        with redirect_stdout(StringIO()) as output:
+            call_command("look_through", "--etf", "1", "--etf", "2")
+        self.assertIn("AAPL: 40.0000%", output.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("look_through", "--etf", "1:0")
+
+
+@override_settings(
+    CACHES=TEST_CACHES, HOLDINGS_DOWNLOAD_CACHE=None, HOLDINGS_HISTORY=None
+)
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        path = Path(self.directory.name) / "holdings.csv"
+        path.write_text(ISHARES_CSV)
+        self.etf = ETF.objects.create(
+            etf_issuer="iShares",
+            name="AAA",
+            holdings_url=path.as_uri(),
+            portfolio_url=path.as_uri(),
+        )
+        self.metrics_path = Path(self.directory.name) / "etf_track.prom"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records_stages_per_etf(self):
+        config = {"ENABLED": True, "PROMETHEUS_FILE": self.metrics_path}
+        with override_settings(ETF_INSTRUMENTATION=config), self.assertLogs(
+            "etfs.instrumentation"
+        ) as logs:
+            read_all_etfs("iShares")
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["status"], "stored")
+        for stage in ["read", "download", "parse", "clean", "diff", "write"]:
+            self.assertIn(stage, record["stages"])
+        self.assertEqual(record["counters"]["bytes_downloaded"], len(ISHARES_CSV))
+        self.assertEqual(record["counters"]["rows_created"], 2)
+        self.assertGreater(record["counters"]["sql_queries"], 0)
+        metrics = self.metrics_path.read_text()
+        labels = f'etf_id="{self.etf.id}"'
+        self.assertIn(f'etf_track_stage_seconds{{{labels},stage="download"}}', metrics)
+        self.assertIn(f"etf_track_rows_created{{{labels}}} 2", metrics)
+
+    def test_disabled(self):
+        with override_settings(ETF_INSTRUMENTATION={"ENABLED": False}):
+            with self.assertNoLogs("etfs.instrumentation"):
+                read_all_etfs("iShares")
+        self.assertFalse(self.metrics_path.exists())
+        self.assertIs(instrumentation.stage("read"), instrumentation.stage("parse"))
+
+
+class TestBatchAddEtfBulk(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name) / "etfs.csv"
+        rows = [
+            "etf_issuer,name,holdings_url,portfolio_url,expense_ratio",
+            "iShares,AAA,http://a/h,http://a/p,0.1",
+            "iShares,BBB,http://b/h,http://b/p,",
+            "iShares,AAA,http://a/h,http://a/p,0.1",
+            "iShares,CCC,,http://c/p,0.2",
+            "iShares,DDD,http://d/h,http://d/p,cheap",
+            "iShares,EEE,http://e/h,http://e/p,0.3",
+        ]
+        self.path.write_text("\n".join(rows) + "\n")
+        ETF.objects.create(
+            etf_issuer="iShares", name="EEE", holdings_url="x", portfolio_url="x"
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_bulk_ingest(self):
+        output = StringIO()
+        with redirect_stdout(output), self.assertNumQueries(10):
+            call_command(
+                "batch_add_etf", input_file_path=str(self.path), bulk=True, chunk_size=3
+            )
+        self.assertEqual(
+            output.getvalue().strip(),
+            "Created 2 ETFs, skipped 2 already present, "
+            "rejected 2 invalid rows (lines 5, 6)",
+        )
+        self.assertEqual(ETF.objects.get(name="AAA").expense_ratio, 0.1)
+        self.assertIsNone(ETF.objects.get(name="BBB").expense_ratio)
+        self.assertFalse(ETF.objects.filter(name__in=["CCC", "DDD"]).exists())
+
+    def test_issuer_and_name_are_unique(self):
+        with self.assertRaises(IntegrityError):
+            ETF.objects.create(
+                etf_issuer="iShares", name="EEE", holdings_url="y", portfolio_url="y"
+            )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestRefreshScheduler(TestCase):
+    def setUp(self):
+        create_etfs(1, 2, 3)
+        self.now = datetime(2022, 10, 14, tzinfo=timezone.utc)
+        self.calls = []
+        self.failing = set()
+
+        def refresh_holdings(job):
+            self.calls.append(job.etf_id)
+            if job.etf_id in self.failing:
+                raise IOError("download failed")
+
+        def record(job):
+            self.calls.append(job.kind)
+
+        self.scheduler = RefreshScheduler(
+            workers=2,
+            tasks={
+                HOLDINGS: refresh_holdings,
+                "fundamentals": record,
+                "measurements": record,
+            },
+            clock=lambda: self.now,
+        )
+
+    def test_catalogue_tracks_new_etfs(self):
+        self.scheduler.load()
+        create_etfs(4)
+        with CaptureQueriesContext(connection) as context:
+            self.scheduler._track_new_etfs(self.now)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn("NOT", context.captured_queries[0]["sql"])
+        self.assertEqual(
+            sorted(job.etf_id for job in self.scheduler._queue if job.etf_id),
+            [1, 2, 3, 4],
+        )
+
+    def test_new_etfs_are_spread_out(self):
+        ETF.objects.filter(id=3).update(next_refresh=self.now - timedelta(days=1))
+        self.scheduler.load()
+        jobs = self.scheduler.pop_due(10)
+        self.assertEqual(
+            [(job.kind, job.etf_id) for job in jobs][:3],
+            [(HOLDINGS, 3), ("fundamentals", None), ("measurements", None)],
+        )
+        self.assertEqual([job.etf_id for job in jobs[3:]], [1])
+        self.now += timedelta(minutes=30)
+        jobs = self.scheduler.pop_due(10)
+        self.assertEqual([job.etf_id for job in jobs], [2])
+
+    def test_failures_back_off(self):
+        self.scheduler.load()
+        self.now += timedelta(hours=1)
+        due = self.scheduler.pop_due(10)
+        job = next(job for job in due if job.etf_id == 2)
+        for failures, delay in [(1, 5), (2, 10), (3, 20)]:
+            self.scheduler.complete(job, IOError("download failed"))
+            etf = ETF.objects.get(id=2)
+            self.assertEqual(etf.refresh_failures, failures)
+            self.assertEqual(etf.next_refresh, self.now + timedelta(minutes=delay))
+            self.assertIsNone(etf.holdings_checked)
+        self.scheduler.complete(job, None)
+        etf = ETF.objects.get(id=2)
+        self.assertEqual(etf.refresh_failures, 0)
+        self.assertEqual(etf.holdings_checked, self.now)
+        self.assertEqual(etf.next_refresh, self.now + timedelta(hours=24))
+
+    def test_removed_etfs_are_dropped(self):
+        self.scheduler.load()
+        self.now += timedelta(hours=1)
+        due = self.scheduler.pop_due(10)
+        job = next(job for job in due if job.etf_id == 2)
+        ETF.objects.filter(id=2).delete()
+        self.scheduler.complete(job, ETF.DoesNotExist())
+        self.assertNotIn(2, [job.etf_id for job in self.scheduler.pop_due(10)])
+
+    def test_run_until_stopped(self):
+        stop = threading.Event()
+        ETF.objects.update(next_refresh=self.now)
+        self.failing = {2}
+        original = self.scheduler.complete
+
+        def complete(job, error):
+            original(job, error)
+            if len(self.calls) == 5:
+                stop.set()
+
+        self.scheduler.complete = complete
+        self.scheduler.run(stop)
+        self.assertEqual(
+            sorted(map(str, self.calls)),
+            ["1", "2", "3", "fundamentals", "measurements"],
+        )
+        self.assertEqual(ETF.objects.get(id=2).refresh_failures, 1)
+        self.assertEqual(ETF.objects.filter(holdings_checked__isnull=False).count(), 2)
+
+    @patch("etfs.fundamentals.loader.update_fundamentals")
+    @patch("etfs.fundamentals.loader.refresh_fundamentals")
+    def test_fundamentals_use_scheduler_settings(self, refresh, update):
+        refresh.return_value.failed_batches = 0
+        scheduler = RefreshScheduler(
+            workers=3, intervals={FUNDAMENTALS: timedelta(hours=1)}
+        )
+        scheduler.tasks[FUNDAMENTALS](ScheduledJob(self.now, 1, FUNDAMENTALS))
+        _, ttl = refresh.call_args.args
+        self.assertEqual(ttl, timedelta(hours=1))
+        self.assertEqual(refresh.call_args.kwargs["workers"], 1)
+
+
+class TestStartupImports(SimpleTestCase):
+    """Short-lived commands must not import the heavy data libraries"""
+
+    HEAVY_MODULES = {"numpy", "pandas", "yfinance"}
+    MANAGE_PY = Path(__file__).resolve().parent.parent / "manage.py"
+
+    def imported_modules(self, *command):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", str(self.MANAGE_PY), *command],
+            capture_output=True,
+            text=True,
+            env=os.environ.copy(),
+        )
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        return {
+            line.rsplit("|", 1)[1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:") and line.count("|") == 2
         }
-        _add_or_update_holdings(**kwargs)
-        result = Holdings.objects.filter(etf_id=3, ticker="MSFT", percentage=19.8).exists()
-        self.assertTrue(result)
+
+    def test_commands_do_not_import_heavy_modules(self):
+        for command in [
+            ["check"],
+            ["add_etf", "--help"],
+            ["batch_add_etf", "--help"],
+            ["update_fundamentals", "--help"],
+        ]:
+            with self.subTest(command=command[0]):
+                modules = self.imported_modules(*command)
+                self.assertIn("django.core.management", modules)
+                self.assertFalse(modules & self.HEAVY_MODULES)
+
+
+@override_settings(
+    CACHES=TEST_CACHES,
+    HOLDINGS_DOWNLOAD_CACHE=None,
+    HOLDINGS_HISTORY=None,
+    HOLDINGS_SNAPSHOT=None,
+)
+@patch.dict(
+    "etfs.holdings.loader.ETF_PROVIDER_CREATOR_MAPPING", {"Stub": StubETFReaderCreator}
+)
+class TestRefreshProvider(TestCase):
+    def setUp(self):
+        self.etfs = {
+            name: ETF.objects.create(
+                etf_issuer="Stub",
+                name=name,
+                holdings_url=f"http://localhost/{name}.csv",
+                portfolio_url=f"http://localhost/{name}",
+            )
+            for name in ["AAA", "BBB", "Broken"]
+        }
+        _update_holdings(
+            self.etfs["AAA"].id,
+            DataFrame.from_dict(
+                {"ticker": ["AAPL", "TSLA"], "percentage": [60.0, 40.0]}
+            ),
+        )
+        _update_holdings(
+            self.etfs["Broken"].id,
+            DataFrame.from_dict({"ticker": ["TSLA"], "percentage": [100.0]}),
+        )
+
+    def stored_holdings(self):
+        return set(
+            Holdings.objects.values_list("etf__name", "ticker__symbol", "percentage")
+        )
+
+    def test_merges_all_etfs(self):
+        outcomes = refresh_provider("Stub", workers=3)
+        self.assertEqual(
+            {outcome.name: outcome.succeeded for outcome in outcomes},
+            {"AAA": True, "BBB": True, "Broken": False},
+        )
+        self.assertEqual(
+            self.stored_holdings(),
+            {
+                ("AAA", "AAPL", 50.0),
+                ("AAA", "AAA", 50.0),
+                ("BBB", "AAPL", 50.0),
+                ("BBB", "BBB", 50.0),
+                ("Broken", "TSLA", 100.0),
+            },
+        )
+        self.assertEqual(
+            who_holds("AAPL"), {self.etfs["AAA"].id: 50.0, self.etfs["BBB"].id: 50.0}
+        )
+        self.assertEqual(who_holds("TSLA"), {self.etfs["Broken"].id: 100.0})
+        self.assertFalse(
+            ETF.objects.filter(name="BBB", holdings_updated__isnull=True).exists()
+        )
+
+    def test_failed_merge_changes_nothing(self):
+        before = self.stored_holdings()
+        with patch("etfs.holdings.loader.update_exposures", side_effect=RuntimeError):
+            outcomes = refresh_provider("Stub")
+        self.assertFalse(any(outcome.succeeded for outcome in outcomes))
+        self.assertEqual(self.stored_holdings(), before)
+
+    def test_exports_snapshot(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "holdings.bin"
+            with override_settings(HOLDINGS_SNAPSHOT={"PATH": path}):
+                with self.captureOnCommitCallbacks(execute=True):
+                    refresh_provider("Stub")
+            tickers, _ = HoldingsSnapshot(path).holdings(self.etfs["BBB"].id)
+            self.assertEqual(sorted(tickers), ["AAPL", "BBB"])
+
+
+class TestHoldingsSnapshot(TestCase):
+    def setUp(self):
+        create_etfs(1, 2, 3)
+        Holdings.objects.bulk_create(
+            [
+                Holdings(etf_id=2, ticker=get_ticker("AAPL"), percentage=60.0),
+                Holdings(etf_id=2, ticker=get_ticker("MSFT"), percentage=40.0),
+                Holdings(etf_id=1, ticker=get_ticker("AAPL"), percentage=100.0),
+            ]
+        )
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name) / "holdings.bin"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        export_holdings_snapshot(self.path)
+        snapshot = HoldingsSnapshot(self.path)
+        self.assertIsInstance(snapshot.data, np.memmap)
+        self.assertEqual(snapshot.etf_ids.dtype, np.int32)
+        self.assertEqual(snapshot.data.dtype, np.float32)
+        tickers, weights = snapshot.holdings(2)
+        self.assertEqual(dict(zip(tickers, weights)), {"AAPL": 60.0, "MSFT": 40.0})
+        self.assertIsNone(snapshot.holdings(3))
+        np.testing.assert_allclose(
+            snapshot.to_matrix().dot(np.ones(len(snapshot.tickers))), [100.0, 100.0]
+        )
+
+    def test_reopened_after_export(self):
+        with override_settings(HOLDINGS_SNAPSHOT={"PATH": self.path}):
+            self.assertIsNone(get_holdings_snapshot())
+            export_holdings_snapshot()
+            first = get_holdings_snapshot()
+            self.assertIs(get_holdings_snapshot(), first)
+            create_holding(3, "NVDA", 100.0)
+            export_holdings_snapshot()
+            second = get_holdings_snapshot()
+        self.assertIsNot(second, first)
+        self.assertIsNone(first.holdings(3))
+        self.assertEqual(list(second.holdings(3)[0]), ["NVDA"])
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_analytics_read_snapshot(self):
+        export_holdings_snapshot(self.path)
+        Holdings.objects.filter(etf_id=2).delete()
+        with override_settings(HOLDINGS_SNAPSHOT={"PATH": self.path}):
+            result = look_through({2: 1.0})
+        self.assertEqual(result.exposures["ticker"].tolist(), ["AAPL", "MSFT"])
+        np.testing.assert_allclose(result.exposures["percentage"], [60.0, 40.0])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestTickerCache(TestCase):
+    def test_resolve_creates_missing_tickers_in_bulk(self):
+        aapl = get_ticker("AAPL")
+        tickers = TickerCache()
+        with self.assertNumQueries(3):
+            ticker_ids = tickers.resolve(["AAPL", "MSFT", "NVDA", "MSFT"])
+        self.assertEqual(ticker_ids["AAPL"], aapl.id)
+        self.assertEqual(
+            set(Ticker.objects.values_list("symbol", "id")), set(ticker_ids.items())
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(tickers.resolve(["NVDA"]), {"NVDA": ticker_ids["NVDA"]})
+
+    def test_resolve_fills_missing_details(self):
+        get_ticker("AAPL")
+        tickers = TickerCache()
+        details = ticker_details(
+            DataFrame.from_dict(
+                {
+                    "ticker": ["AAPL", "MSFT"],
+                    "percentage": [6.0, 5.0],
+                    "sector": ["Information Technology", None],
+                    "exchange": ["NASDAQ", "NASDAQ"],
+                }
+            )
+        )
+        tickers.resolve(["AAPL", "MSFT"], details)
+        self.assertEqual(
+            set(Ticker.objects.values_list("symbol", "sector", "exchange")),
+            {("AAPL", "Information Technology", "NASDAQ"), ("MSFT", None, "NASDAQ")},
+        )
+        with self.assertNumQueries(0):
+            tickers.resolve(["AAPL"], details)
+
+    def test_holdings_share_tickers(self):
+        create_etfs(1, 2)
+        holdings = DataFrame.from_dict({"ticker": ["AAPL"], "percentage": [100.0]})
+        tickers = TickerCache()
+        _update_holdings(1, holdings, tickers)
+        with CaptureQueriesContext(connection) as context:
+            _update_holdings(2, holdings, tickers)
+        ticker_queries = [
+            query["sql"]
+            for query in context.captured_queries
+            if 'FROM "etfs_ticker"' in query["sql"]
+            or 'INTO "etfs_ticker"' in query["sql"]
+        ]
+        self.assertEqual(ticker_queries, [])
+        self.assertEqual(Ticker.objects.count(), 1)
+        self.assertEqual(Holdings.objects.values("ticker").distinct().count(), 1)
@@ -0,0 +1,171 @@
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+
+from etfs.models import Ticker
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+# the number of symbols looked up per query
+LOOKUP_BATCH_SIZE = 1000
+# the descriptive fields of a Ticker, filled from the holdings files
+DETAIL_FIELDS = ["exchange", "sector", "location"]
+
+TickerDetails = Dict[str, Optional[str]]
+
+
+class TickerCache:
+    """Resolves ticker symbols to the ids of their Ticker rows, creating
+    missing rows in bulk. One cache is shared by all the ETFs of a refresh,
+    so each symbol is looked up at most once per refresh rather than once per
+    holding.
+
+    Tickers are created with the details (see DETAIL_FIELDS) given for
+    them, and details missing from existing Tickers are filled in with one
+    bulk update. Details that are already stored are kept.
+
+    Tickers are created outside any transaction that writes holdings, so
+    that a rolled back write does not leave ids of rows that no longer exist
+    in the cache.
+
+    Methods:
+        resolve
+    """
+
+    def __init__(self):
+        """Initialise an empty TickerCache object"""
+        self._ids: Dict[str, int] = {}
+        # the stored details of loaded Tickers that have a missing detail
+        self._incomplete: Dict[str, TickerDetails] = {}
+
+    def resolve(
+        self,
+        symbols: Iterable[str],
+        details: Optional[Mapping[str, TickerDetails]] = None,
+    ) -> Dict[str, int]:
+        """Return the Ticker ids of a set of symbols, creating Ticker rows
+        for symbols that have none
+
+        Arguments:
+            symbols: the symbols to resolve, which may contain duplicates
+            details: the details of some or all of the symbols, e.g. from
+                ticker_details
+
+        Returns:
+            a dictionary mapping each symbol to the id of its Ticker
+        """
+        symbols = set(symbols)
+        details = details or {}
+        missing = symbols.difference(self._ids)
+        if missing:
+            self._load(missing)
+            unknown = missing.difference(self._ids)
+            if unknown:
+                # rows created concurrently by another refresh are skipped
+                # here and picked up by the second lookup
+                Ticker.objects.bulk_create(
+                    [
+                        Ticker(symbol=symbol, **details.get(symbol, {}))
+                        for symbol in sorted(unknown)
+                    ],
+                    ignore_conflicts=True,
+                )
+                self._load(unknown)
+        self._fill_details(symbols, details)
+        return {symbol: self._ids[symbol] for symbol in symbols}
+
+    def _load(self, symbols: Iterable[str]) -> None:
+        """Look up the ids and details of existing Ticker rows in batches"""
+        for batch in _batches(sorted(symbols)):
+            rows = Ticker.objects.filter(symbol__in=batch).values_list(
+                "symbol", "id", *DETAIL_FIELDS
+            )
+            for symbol, ticker_id, *values in rows:
+                self._ids[symbol] = ticker_id
+                if None in values:
+                    self._incomplete[symbol] = dict(zip(DETAIL_FIELDS, values))
+
+    def _fill_details(
+        self, symbols: Iterable[str], details: Mapping[str, TickerDetails]
+    ) -> None:
+        """Store the given details of Tickers whose details are missing"""
+        updated = []
+        for symbol in set(symbols).intersection(self._incomplete, details):
+            stored = self._incomplete[symbol]
+            filled = {
+                field: stored[field] or details[symbol].get(field)
+                for field in DETAIL_FIELDS
+            }
+            if filled != stored:
+                updated.append(Ticker(id=self._ids[symbol], **filled))
+            if None in filled.values():
+                self._incomplete[symbol] = filled
+            else:
+                del self._incomplete[symbol]
+        if updated:
+            Ticker.objects.bulk_update(updated, DETAIL_FIELDS)
+
+
+def ticker_details(holdings: "DataFrame") -> Dict[str, TickerDetails]:
+    """Extract the details of the tickers in a holdings DataFrame
+
+    Arguments:
+        holdings: a DataFrame with the column ticker and any of the columns
+            in DETAIL_FIELDS
+
+    Returns:
+        a dictionary mapping each ticker to its details, without the fields
+        the DataFrame has no column for
+    """
+    from pandas import isna
+
+    fields = [field for field in DETAIL_FIELDS if field in holdings]
+    if not fields:
+        return {}
+    rows = holdings[["ticker", *fields]].drop_duplicates("ticker", keep="last")
+    return {
+        ticker: {
+            field: None if isna(value) else str(value)
+            for field, value in zip(fields, values)
+        }
+        for ticker, *values in rows.itertuples(index=False)
+    }
+
+
+def ticker_values(
+    ticker_ids: Iterable[int], *fields: str
+) -> Dict[int, Tuple[Any, ...]]:
+    """Look up fields of Tickers by id, e.g. their symbols for display,
+    in batches
+
+    Arguments:
+        ticker_ids: the ids of the Tickers
+        fields: the fields to look up, which may span relations, e.g.
+            ``fundamentals__p_e``
+
+    Returns:
+        a dictionary mapping each Ticker id to a tuple of the field values
+    """
+    values = {}
+    for batch in _batches(ticker_ids):
+        for ticker_id, *row in Ticker.objects.filter(id__in=batch).values_list(
+            "id", *fields
+        ):
+            values[ticker_id] = tuple(row)
+    return values
+
+
+def _batches(values: Iterable[Any]) -> Iterator[List[Any]]:
+    """Split values into lists of up to LOOKUP_BATCH_SIZE items"""
+    values = iter(values)
+    return iter(lambda: list(islice(values, LOOKUP_BATCH_SIZE)), [])
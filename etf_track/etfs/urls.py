@@ -0,0 +1,19 @@
+from django.urls import path
+
+from . import views
+
+app_name = "etfs"
+
+urlpatterns = [
+    path("etfs/", views.etf_list, name="etf-list"),
+    path("etfs/<int:etf_id>/", views.etf_detail, name="etf-detail"),
+    path("etfs/<int:etf_id>/overview/", views.etf_overview, name="etf-overview"),
+    path("etfs/<int:etf_id>/holdings/", views.etf_holdings, name="etf-holdings"),
+    path(
+        "etfs/<int:etf_id>/measurements/",
+        views.etf_measurements,
+        name="etf-measurements",
+    ),
+    path("etfs/<int:etf_id>/similar/", views.etf_similar, name="etf-similar"),
+    path("cache/stats/", views.cache_stats, name="cache-stats"),
+]
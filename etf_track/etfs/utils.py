@@ -1,8 +1,40 @@
-from collections import defaultdict
 from datetime import datetime
+from itertools import islice
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
+from django.db.models import Field
+from django.db.models.constants import LOOKUP_SEP
 from django.db.models.query import QuerySet
-from pandas import DataFrame
+
+# numpy and pandas are imported by the functions that use them, so that
+# commands which only need the rest of this module start quickly
+if TYPE_CHECKING:
+    import numpy as np
+    from pandas import DataFrame, Series
+
+# numpy dtypes for the internal types of non-nullable model fields
+FIELD_DTYPES = {
+    "AutoField": "int64",
+    "BigAutoField": "int64",
+    "SmallAutoField": "int64",
+    "IntegerField": "int64",
+    "BigIntegerField": "int64",
+    "SmallIntegerField": "int64",
+    "PositiveIntegerField": "int64",
+    "PositiveBigIntegerField": "int64",
+    "PositiveSmallIntegerField": "int64",
+    "FloatField": "float64",
+    "BooleanField": "bool",
+}
+
+NUMPY_DTYPES = {"int64", "float64", "bool"}
+
+# pandas dtypes for the internal types of nullable model fields
+NULLABLE_FIELD_DTYPES = {
+    **{internal_type: "Int64" for internal_type in FIELD_DTYPES},
+    "FloatField": "float64",
+    "BooleanField": "boolean",
+}
 
 
 def get_current_datetime(self) -> datetime:
@@ -17,23 +49,111 @@ def get_current_datetime(self) -> datetime:
 
 
 def convert_queryset_to_dataframe(
-    queryset: QuerySet, *, exclude_id: bool = False
-) -> DataFrame:
+    queryset: QuerySet,
+    *,
+    fields: Optional[Sequence[str]] = None,
+    exclude_id: bool = False,
+    chunk_size: Optional[int] = None,
+) -> "DataFrame":
     """Convert a QuerySet to a pandas DataFrame
 
+    Only the requested columns are selected with ``values_list`` and the
+    DataFrame is built column by column, with a dtype derived from the type of
+    each model field. If ``chunk_size`` is given, rows are streamed from the
+    database (using a server-side cursor where the backend supports it) and
+    converted one chunk at a time.
+
     Arguments:
         queryset: the QuerySet object to convert
+        fields: the names of the fields to include, defaults to all concrete
+            fields of the model. Fields of related models can be included
+            with lookups that span relations, e.g. ``ticker__symbol``, which
+            also name their columns.
+        exclude_id: whether to exclude the primary key
+        chunk_size: the number of rows to convert at a time
 
     Returns:
         A DataFrame object containing the data of the QuerySet
     """
-    result = defaultdict(list)
-
-    for row in queryset:
-        for field in vars(row):
-            if field == "_state":
-                continue
-            if exclude_id and field == "id":
-                continue
-            result[field].append(getattr(row, field))
-    return DataFrame.from_dict(result)
+    import numpy as np
+    from pandas import DataFrame
+
+    selected = _select_columns(queryset, fields, exclude_id)
+    names = [name for name, _, _ in selected]
+    rows = queryset.values_list(*names)
+    if chunk_size is None:
+        chunks = [list(rows)]
+    else:
+        iterator = rows.iterator(chunk_size=chunk_size)
+        chunks = iter(lambda: list(islice(iterator, chunk_size)), [])
+
+    dtypes = [_field_dtype(field, null) for _, field, null in selected]
+    chunk_dtypes = [dtype if dtype in NUMPY_DTYPES else object for dtype in dtypes]
+    arrays: Dict[str, List["np.ndarray"]] = {name: [] for name in names}
+    for chunk in chunks:
+        for name, dtype, values in zip(names, chunk_dtypes, zip(*chunk)):
+            arrays[name].append(np.array(values, dtype=dtype))
+
+    return DataFrame(
+        {
+            name: _concatenate_column(arrays[name], dtype)
+            for name, dtype in zip(names, dtypes)
+        },
+        columns=names,
+    )
+
+
+def _select_columns(
+    queryset: QuerySet, fields: Optional[Sequence[str]], exclude_id: bool
+) -> List[Tuple[str, Field, bool]]:
+    """Return the columns selected for a QuerySet conversion
+
+    Returns:
+        a list of (name, model field, nullable) tuples, one per column
+    """
+    meta = queryset.model._meta
+    if fields is None:
+        columns = [(field.attname, field, field.null) for field in meta.concrete_fields]
+    else:
+        columns = [_resolve_lookup(meta, name) for name in fields]
+    if exclude_id:
+        columns = [column for column in columns if not column[1].primary_key]
+    return columns
+
+
+def _resolve_lookup(meta, name: str) -> Tuple[str, Field, bool]:
+    """Resolve a field name, or a lookup spanning relations, to a column.
+    A column reached through a nullable relation is nullable.
+    """
+    *relations, field_name = name.split(LOOKUP_SEP)
+    null = False
+    for relation in relations:
+        field = meta.get_field(relation)
+        null = null or field.null
+        meta = field.related_model._meta
+    field = meta.get_field(field_name)
+    return (name if relations else field.attname), field, null or field.null
+
+
+def _field_dtype(field: Field, null: bool) -> str:
+    """Return the DataFrame dtype that matches a model field"""
+    internal_type = (
+        field.target_field.get_internal_type()
+        if field.is_relation
+        else field.get_internal_type()
+    )
+    if internal_type == "DateTimeField":
+        return "datetime64[ns, UTC]"
+    dtypes = NULLABLE_FIELD_DTYPES if null else FIELD_DTYPES
+    return dtypes.get(internal_type, "object")
+
+
+def _concatenate_column(chunks: List["np.ndarray"], dtype: str) -> "Series":
+    """Concatenate the chunks of a column and convert them to a dtype"""
+    import numpy as np
+    from pandas import Series, to_datetime
+
+    values = np.concatenate(chunks) if chunks else np.array([], dtype=object)
+    if dtype == "datetime64[ns, UTC]":
+        return Series(to_datetime(values, utc=True))
+    return Series(values, dtype=dtype)
@@ -1,3 +1,252 @@
-from django.shortcuts import render
+import hashlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
 
-# Create your views here.
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpRequest, JsonResponse
+from django.views.decorators.http import condition, require_safe
+
+from etfs.cache import aggregate_cache
+from etfs.models import ETF, Holdings, Measurement
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+ETF_FIELDS = ["id", "etf_issuer", "name", "sector", "expense_ratio", "holdings_updated"]
+HOLDINGS_FIELDS = ["id", "ticker__symbol", "percentage"]
+MEASUREMENT_FIELDS = ["id", "date_time", "p_e", "ev_ebidta"]
+TOP_HOLDINGS = 10
+
+
+class BadRequest(Exception):
+    """Raised when the query parameters of a request are invalid"""
+
+
+def _page_size(request: HttpRequest) -> int:
+    """Read the page size from the limit query parameter"""
+    try:
+        limit = int(request.GET.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def _id_cursor(request: HttpRequest) -> Optional[int]:
+    """Read an id cursor from the after query parameter"""
+    after = request.GET.get("after")
+    if after is None:
+        return None
+    try:
+        return int(after)
+    except ValueError:
+        raise BadRequest("after must be an integer")
+
+
+def _measurement_cursor(request: HttpRequest) -> Optional[Tuple[datetime, int]]:
+    """Read a (date_time, id) cursor, encoded as
+    '<microseconds since the epoch>_<id>', from the after query parameter
+    """
+    after = request.GET.get("after")
+    if after is None:
+        return None
+    try:
+        timestamp, measurement_id = (int(part) for part in after.split("_"))
+    except ValueError:
+        raise BadRequest("after must be a cursor returned in next")
+    date_time = datetime.fromtimestamp(timestamp / 10**6, tz=timezone.utc)
+    return date_time, measurement_id
+
+
+def _encode_measurement_cursor(row: Dict[str, Any]) -> str:
+    """Encode the keyset cursor of a measurement row"""
+    timestamp = round(row["date_time"].timestamp() * 10**6)
+    return f"{timestamp}_{row['id']}"
+
+
+def _page(rows: List[Dict[str, Any]], limit: int, cursor: Any) -> JsonResponse:
+    """Build a page response from up to limit + 1 rows, using the extra row
+    to decide whether there is a next page
+    """
+    next_cursor = cursor(rows[limit - 1]) if len(rows) > limit else None
+    return JsonResponse({"results": rows[:limit], "next": next_cursor})
+
+
+def _validators(request: HttpRequest, etf_id: Optional[int] = None) -> Dict[str, Any]:
+    """Compute the latest ETF, holdings and measurement update times that
+    the ETag and Last-Modified headers of a response are derived from. Only
+    the ETF table is read, which is a primary key lookup for a single ETF.
+    The result is stored on the request, because it is needed for both
+    headers.
+    """
+    if not hasattr(request, "_etf_validators"):
+        etfs = ETF.objects.all()
+        if etf_id is not None:
+            etfs = etfs.filter(id=etf_id)
+        request._etf_validators = etfs.aggregate(
+            etf_count=Count("id", distinct=True),
+            latest_etf_id=Max("id"),
+            holdings_updated=Max("holdings_updated"),
+            measurements_updated=Max("measurements_updated"),
+            updated_at=Max("updated_at"),
+        )
+    return request._etf_validators
+
+
+def _last_modified(
+    request: HttpRequest, etf_id: Optional[int] = None
+) -> Optional[datetime]:
+    """Return the time of the latest ETF, holdings or measurement update"""
+    validators = _validators(request, etf_id)
+    updates = [
+        validators["holdings_updated"],
+        validators["measurements_updated"],
+        validators["updated_at"],
+    ]
+    updates = [update for update in updates if update is not None]
+    return max(updates) if updates else None
+
+
+def _etag(request: HttpRequest, etf_id: Optional[int] = None) -> Optional[str]:
+    """Return an ETag derived from the latest holdings and measurement
+    updates and the query parameters of the request
+    """
+    validators = _validators(request, etf_id)
+    if not validators["etf_count"]:
+        return None
+    key = repr((request.path, sorted(request.GET.items()), sorted(validators.items())))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def _bad_request_as_json(view):
+    """Turn BadRequest exceptions raised by a view into 400 responses"""
+
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as error:
+            return JsonResponse({"error": str(error)}, status=400)
+
+    return wrapper
+
+
+@require_safe
+@_bad_request_as_json
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def etf_list(request: HttpRequest) -> JsonResponse:
+    """List ETFs ordered by id, paginated with an id cursor"""
+    limit = _page_size(request)
+    after = _id_cursor(request)
+    etfs = ETF.objects.order_by("id")
+    if after is not None:
+        etfs = etfs.filter(id__gt=after)
+    rows = list(etfs.values(*ETF_FIELDS)[: limit + 1])
+    return _page(rows, limit, lambda row: str(row["id"]))
+
+
+@require_safe
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def etf_detail(request: HttpRequest, etf_id: int) -> JsonResponse:
+    """Return an ETF with its cached aggregate statistics"""
+    # imported here so that loading the URLconf does not import pandas
+    from etfs.aggregates import etf_summary
+
+    etf = ETF.objects.filter(id=etf_id).values(*ETF_FIELDS).first()
+    if etf is None:
+        raise Http404("ETF not found")
+    return JsonResponse({**etf, **etf_summary(etf_id)})
+
+
+@require_safe
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def etf_overview(request: HttpRequest, etf_id: int) -> JsonResponse:
+    """Return an ETF with its largest holdings and latest measurement. The
+    holdings are read through the cached holdings frame of the ETF, which
+    comes from the holdings snapshot when one is exported.
+    """
+    # imported here so that loading the URLconf does not import pandas
+    from etfs.aggregates import holdings_frame
+
+    etf = ETF.objects.filter(id=etf_id).values(*ETF_FIELDS).first()
+    if etf is None:
+        raise Http404("ETF not found")
+    top_holdings = holdings_frame(etf_id).head(TOP_HOLDINGS).to_dict("records")
+    latest_measurement = (
+        Measurement.objects.filter(etf_id=etf_id)
+        .order_by("-date_time")
+        .values("date_time", "p_e", "ev_ebidta")
+        .first()
+    )
+    return JsonResponse(
+        {**etf, "top_holdings": top_holdings, "latest_measurement": latest_measurement}
+    )
+
+
+def _holding(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Rename the ticker__symbol key of a holdings row to ticker"""
+    return {
+        ("ticker" if key == "ticker__symbol" else key): value
+        for key, value in row.items()
+    }
+
+
+@require_safe
+@_bad_request_as_json
+def etf_similar(request: HttpRequest, etf_id: int) -> JsonResponse:
+    """List the ETFs most similar to an ETF by holdings overlap or cosine
+    similarity
+    """
+    # imported here so that loading the URLconf does not import numpy
+    from etfs.holdings.similarity import METRICS, similar_etfs
+
+    limit = _page_size(request)
+    metric = request.GET.get("metric", "overlap")
+    if metric not in METRICS:
+        raise BadRequest(f"metric must be one of {', '.join(METRICS)}")
+    return JsonResponse({"results": similar_etfs(etf_id, k=limit, metric=metric)})
+
+
+@require_safe
+def cache_stats(request: HttpRequest) -> JsonResponse:
+    """Return the aggregate cache hit and miss counters of this process"""
+    return JsonResponse(aggregate_cache.stats())
+
+
+@require_safe
+@_bad_request_as_json
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def etf_holdings(request: HttpRequest, etf_id: int) -> JsonResponse:
+    """List the holdings of an ETF ordered by id, paginated with an id
+    cursor
+    """
+    if not _validators(request, etf_id)["etf_count"]:
+        raise Http404("ETF not found")
+    limit = _page_size(request)
+    after = _id_cursor(request)
+    holdings = Holdings.objects.filter(etf_id=etf_id).order_by("id")
+    if after is not None:
+        holdings = holdings.filter(id__gt=after)
+    rows = [_holding(row) for row in holdings.values(*HOLDINGS_FIELDS)[: limit + 1]]
+    return _page(rows, limit, lambda row: str(row["id"]))
+
+
+@require_safe
+@_bad_request_as_json
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def etf_measurements(request: HttpRequest, etf_id: int) -> JsonResponse:
+    """List the measurements of an ETF in chronological order, paginated
+    with a (date_time, id) cursor
+    """
+    if not _validators(request, etf_id)["etf_count"]:
+        raise Http404("ETF not found")
+    limit = _page_size(request)
+    after = _measurement_cursor(request)
+    measurements = Measurement.objects.filter(etf_id=etf_id).order_by("date_time", "id")
+    if after is not None:
+        date_time, measurement_id = after
+        measurements = measurements.filter(
+            Q(date_time__gt=date_time) | Q(date_time=date_time, id__gt=measurement_id)
+        )
+    rows = list(measurements.values(*MEASUREMENT_FIELDS)[: limit + 1])
+    return _page(rows, limit, _encode_measurement_cursor)